@@ -0,0 +1,243 @@
+"""asyncio version of :class:`dmutils.s3.S3`
+
+Requires Python 3.6+ and the optional ``aiobotocore`` package (install ``dto-digitalmarketplace-utils[async]``),
+which provides a pooled async HTTP client for S3. Use it as an async context manager so the client's connections
+are closed when you're done::
+
+    async with AsyncS3('digitalmarketplace-documents-dev-dev') as s3:
+        keys = await s3.list('g-cloud-9/')
+
+"""
+import asyncio
+import datetime
+import heapq
+import logging
+import mimetypes
+import os
+from operator import attrgetter
+
+import pytz
+from botocore.exceptions import ClientError
+
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+except ImportError:
+    get_session = None
+
+from .formats import DATETIME_FORMAT
+from .s3 import default_move_prefix, parse_timestamp, KeyRecord, TIMESTAMP_LOAD_WORKERS
+
+logger = logging.getLogger(__name__)
+
+MAX_POOL_CONNECTIONS = 10
+
+
+class AsyncS3(object):
+    def __init__(self, bucket_name, endpoint_url=None, region_name=None,
+                 max_pool_connections=MAX_POOL_CONNECTIONS, client=None):
+        """
+        :param endpoint_url:         S3 endpoint, by default ``AWS_S3_URL`` from the environment
+        :param max_pool_connections: number of connections to S3 kept open for concurrent requests
+        :param client:               an already open aiobotocore S3 client to use instead of creating one
+        """
+        self.bucket_name = bucket_name
+        self.endpoint_url = endpoint_url or os.getenv('AWS_S3_URL')
+        self.region_name = region_name
+        self.max_pool_connections = max_pool_connections
+        self._client = client
+        self._client_context = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        if self._client is not None:
+            return
+        if get_session is None:
+            raise RuntimeError("AsyncS3 requires the aiobotocore package")
+
+        self._client_context = get_session().create_client(
+            's3',
+            endpoint_url=self.endpoint_url,
+            region_name=self.region_name,
+            config=AioConfig(max_pool_connections=self.max_pool_connections),
+        )
+        self._client = await self._client_context.__aenter__()
+
+    async def close(self):
+        if self._client_context is not None:
+            await self._client_context.__aexit__(None, None, None)
+            self._client_context = None
+            self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            raise RuntimeError("AsyncS3 must be opened before use")
+        return self._client
+
+    async def save(self, path, file, acl='public-read', move_prefix=None, timestamp=None, download_filename=None,
+                   archive_existing=True):
+        """Save a file in an S3 bucket
+
+        :param path:        location in S3 bucket at which to save the file
+        :param file:        bytes or file object to be saved in S3
+        :param acl:         S3 canned ACL
+        :param move_prefix: Prefix to give to existing file when moving it out of the way
+        :param timestamp:   Timestamp to set for this file rather than using utcnow
+        :param archive_existing: copy any existing file at ``path`` out of the way before overwriting it
+
+        :return: the S3 PutObject response
+        """
+        path = path.lstrip('/')
+
+        if archive_existing:
+            await self._move_existing(path, move_prefix)
+
+        timestamp = timestamp or datetime.datetime.utcnow()
+        params = {
+            'Bucket': self.bucket_name,
+            'Key': path,
+            'Body': file,
+            'ACL': acl,
+            'Metadata': {'timestamp': timestamp.strftime(DATETIME_FORMAT)},
+        }
+        content_type = _get_mimetype(path)
+        if content_type:
+            params['ContentType'] = content_type
+        if download_filename:
+            params['ContentDisposition'] = 'attachment; filename="{}"'.format(download_filename)
+
+        response = await self.client.put_object(**params)
+        logger.info(
+            "Uploaded file {filepath} with acl {fileacl}",
+            extra={
+                "filepath": path,
+                "fileacl": acl,
+            })
+
+        return response
+
+    async def path_exists(self, path):
+        return await self._head_object(path) is not None
+
+    async def get_signed_url(self, path, expires_in=30):
+        """Create a signed S3 document URL
+
+        :return: signed URL or ``None`` if object was not found
+        """
+        if await self.path_exists(path):
+            return await self.client.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': self.bucket_name, 'Key': path},
+                ExpiresIn=expires_in,
+            )
+
+    async def get_key(self, path):
+        head = await self._head_object(path)
+        if head is not None:
+            return _key_record(path, head['ContentLength'], head['LastModified'],
+                               head.get('Metadata', {}).get('timestamp')).to_dict()
+
+    async def delete_key(self, path):
+        await self._move_existing(path, None)
+        await self.client.delete_object(Bucket=self.bucket_name, Key=path)
+
+    async def list(self, prefix='', delimiter='', load_timestamps=False, limit=None,
+                   max_concurrency=TIMESTAMP_LOAD_WORKERS):
+        """
+        return a list of file keys (ordered by last_modified date) from an s3 bucket
+
+        Every page of the listing is read into memory before the keys are sorted, even when
+        ``limit`` is set, so use a narrow ``prefix`` for large buckets.
+
+        :param prefix:          filter by files whose names begin with the prefix
+        :param delimiter:       filter out files whose names contain the delimiter
+        :param load_timestamps: load custom timestamps (one extra request per key)
+        :param limit:           only return the ``limit`` most recently modified files
+        :param max_concurrency: number of timestamp requests made at the same time
+        :return: list
+        """
+        objects = []
+        paginator = self.client.get_paginator('list_objects')
+        async for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix, Delimiter=delimiter):
+            objects.extend(
+                obj for obj in page.get('Contents', [])
+                if not (obj['Size'] == 0 and obj['Key'].endswith('/'))
+            )
+
+        if load_timestamps:
+            semaphore = asyncio.Semaphore(max_concurrency)
+
+            async def load_timestamp(obj):
+                async with semaphore:
+                    head = await self._head_object(obj['Key'])
+                if head is None:
+                    return _key_record(obj['Key'], obj['Size'], obj['LastModified'])
+                return _key_record(obj['Key'], head['ContentLength'], head['LastModified'],
+                                   head.get('Metadata', {}).get('timestamp'))
+
+            keys = await asyncio.gather(*[load_timestamp(obj) for obj in objects])
+        else:
+            keys = [_key_record(obj['Key'], obj['Size'], obj['LastModified']) for obj in objects]
+
+        if limit is not None:
+            keys = heapq.nlargest(limit, keys, key=_timestamp)
+
+        return [key.to_dict() for key in sorted(keys, key=_timestamp)]
+
+    async def _head_object(self, path):
+        try:
+            return await self.client.head_object(Bucket=self.bucket_name, Key=path)
+        except ClientError as e:
+            if _is_not_found(e):
+                return None
+            raise
+
+    async def _move_existing(self, existing_path, move_prefix=None):
+        if move_prefix is None:
+            move_prefix = default_move_prefix()
+
+        path, name = os.path.split(existing_path)
+        try:
+            await self.client.copy_object(
+                Bucket=self.bucket_name,
+                Key=os.path.join(path, '{}-{}'.format(move_prefix, name)),
+                CopySource={'Bucket': self.bucket_name, 'Key': existing_path},
+            )
+        except ClientError as e:
+            if not _is_not_found(e):
+                raise
+
+
+def _is_not_found(error):
+    return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+
+def _get_mimetype(filename):
+    mimetype, _ = mimetypes.guess_type(filename)
+    return mimetype
+
+
+def _key_record(path, size, last_modified, timestamp=None):
+    """Make a ``KeyRecord`` for an S3 object, the same way as :meth:`dmutils.s3.S3.list`
+
+    :param last_modified: the object's ``LastModified`` datetime
+    :param timestamp:     custom timestamp from the object's metadata, used instead if it's set
+    """
+    filename, ext = os.path.splitext(os.path.basename(path))
+    if timestamp:
+        last_modified = parse_timestamp(timestamp)
+    elif last_modified.tzinfo is not None:
+        # custom timestamps are naive UTC datetimes, so they can be compared with these
+        last_modified = last_modified.astimezone(pytz.utc).replace(tzinfo=None)
+
+    return KeyRecord(path, filename, ext[1:], last_modified, size)
+
+
+_timestamp = attrgetter('timestamp')
@@ -0,0 +1,126 @@
+"""Shared boto3 clients and resources
+
+Creating a boto3 client or resource resolves credentials and endpoints and loads the
+service model, which is slow and allocates a lot of memory. The ``registry`` creates them
+once per process, and is emptied when it's first used after a fork so worker processes
+don't share connections with their parent.
+
+boto3 clients are thread-safe and are shared between threads. Resources are not, so each
+thread gets its own.
+"""
+from __future__ import absolute_import
+
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+
+class Boto3Registry(object):
+    def __init__(self):
+        self.endpoint_urls = {}
+        self.max_pool_connections = None
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._session = None
+        self._clients = {}
+        self._local = threading.local()
+
+    def init_app(self, app):
+        """Configure the registry from the app config
+
+        ``AWS_S3_URL`` sets the S3 endpoint (otherwise the ``AWS_S3_URL`` environment variable is used)
+        and ``DM_AWS_MAX_POOL_CONNECTIONS`` the number of connections each client keeps open.
+        """
+        if app.config.get('AWS_S3_URL'):
+            self.endpoint_urls['s3'] = app.config['AWS_S3_URL']
+        self.max_pool_connections = app.config.get('DM_AWS_MAX_POOL_CONNECTIONS', self.max_pool_connections)
+        self.clear()
+
+    def client(self, service_name, **kwargs):
+        """Return a shared client, creating it if needed
+
+        :param kwargs: passed on to ``boto3.Session.client``. A client is created for each
+                       different set of arguments.
+        """
+        self._check_pid()
+        cache_key = _cache_key(service_name, kwargs)
+        client = self._clients.get(cache_key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(cache_key)
+                if client is None:
+                    client = self._clients[cache_key] = self._get_session().client(
+                        service_name, config=self._config(), **kwargs
+                    )
+        return client
+
+    def resource(self, service_name, **kwargs):
+        """Return a resource for the current thread, creating it if needed
+
+        :param kwargs: passed on to ``boto3.Session.resource``
+        """
+        self._check_pid()
+        resources = self._local.__dict__.setdefault('resources', {})
+        cache_key = _cache_key(service_name, kwargs)
+        resource = resources.get(cache_key)
+        if resource is None:
+            with self._lock:
+                resource = resources[cache_key] = self._get_session().resource(
+                    service_name, config=self._config(), **kwargs
+                )
+        return resource
+
+    def s3_client(self):
+        return self.client('s3', endpoint_url=self.s3_endpoint_url())
+
+    def s3_resource(self):
+        return self.resource('s3', endpoint_url=self.s3_endpoint_url())
+
+    def ses_client(self):
+        """Return the shared SES client for the region, credentials and endpoint set in the environment"""
+        return self.client(
+            'ses',
+            region_name=os.getenv('AWS_REGION'),
+            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+            endpoint_url=os.getenv('AWS_SES_URL'),
+        )
+
+    def s3_endpoint_url(self):
+        return self.endpoint_urls.get('s3') or os.getenv('AWS_S3_URL')
+
+    def clear(self):
+        with self._lock:
+            self._session = None
+            self._clients.clear()
+            self._local = threading.local()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _get_session(self):
+        # sessions aren't thread-safe, so this is only called while holding the lock
+        if self._session is None:
+            self._session = boto3.session.Session()
+        return self._session
+
+    def _config(self):
+        if self.max_pool_connections:
+            return Config(max_pool_connections=self.max_pool_connections)
+
+
+def _cache_key(service_name, kwargs):
+    return (service_name,) + tuple(sorted(kwargs.items()))
+
+
+registry = Boto3Registry()
+
+
+def init_app(app):
+    registry.init_app(app)
@@ -1,18 +1,51 @@
 import os
+import re
+import sys
 import datetime
+import zipfile
+import tempfile
+import logging
+import itertools
+import threading
+import mimetypes
+from collections import deque, namedtuple
+from contextlib import contextmanager
+
+import pytz
 import rollbar
-import boto3
+import six
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, wait
+from monotonic import monotonic
 
 try:
     import urlparse
 except ImportError:
     import urllib.parse as urlparse
 
-from .s3 import S3ResponseError, get_file_size_up_to_maximum, FILE_SIZE_LIMIT
+from . import aws
+from .metrics import Metric
+from .s3 import S3ResponseError, get_file_size, get_file_size_up_to_maximum, FILE_SIZE_LIMIT, KeyCache
 
+logger = logging.getLogger(__name__)
 
 BAD_SUPPLIER_NAME_CHARACTERS = ['#', '%', '&', '{', '}', '\\', '<', '>', '*', '?', '/', '$',
                                 '!', "'", '"', ':', '@', '+', '`', '|', '=', ',', '.']
+# sanitise_supplier_name works on the ASCII-encoded name, where bytes.translate is much faster than str.translate
+_SUPPLIER_NAME_TRANSLATION = bytearray(range(256))
+_SUPPLIER_NAME_TRANSLATION[ord(' ')] = ord('_')
+_SUPPLIER_NAME_TRANSLATION = bytes(_SUPPLIER_NAME_TRANSLATION)
+_SUPPLIER_NAME_DELETIONS = ''.join(BAD_SUPPLIER_NAME_CHARACTERS).encode('ascii')
+_ASCII_WHITESPACE = b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f'  # what str.strip removes
+_REPEATED_UNDERSCORES = re.compile(br'_{2,}')
+
+ID_TO_FILE_NAME_SUFFIX = {
+    'serviceDefinitionDocumentURL': 'service-definition-document',
+    'termsAndConditionsDocumentURL': 'terms-and-conditions',
+    'sfiaRateDocumentURL': 'sfia-rate-card',
+    'pricingDocumentURL': 'pricing-document',
+    'attachedDocumentURL': 'attachment'
+}
 
 RESULT_LETTER_FILENAME = 'result-letter.pdf'
 AGREEMENT_FILENAME = 'framework-agreement.pdf'
@@ -20,6 +53,55 @@ SIGNED_AGREEMENT_PREFIX = 'signed-framework-agreement'
 COUNTERSIGNED_AGREEMENT_FILENAME = 'countersigned-framework-agreement.pdf'
 SIGNATURE_PAGE_FILENAME = 'signature-page.pdf'
 
+SIGNED_URL_EXPIRES_IN = 120
+SIGNED_URL_SAFETY_MARGIN = 30  # seconds before expiry when a cached signed URL is no longer used
+UPLOAD_POLICY_EXPIRES_IN = 600
+ALL_USERS_GRANTEE = 'http://acs.amazonaws.com/groups/global/AllUsers'
+
+UPLOAD_METRIC_PREFIX = 'documents.upload'
+
+ZIP_FETCH_WORKERS = 4
+ZIP_CHUNK_SIZE = 64 * 1024
+ZIP_SPOOL_MAX_MEMORY = 5 * 1024 * 1024
+
+OPEN_DOCUMENT_FORMAT_EXTENSIONS = [".pdf", ".pda", ".odt", ".ods", ".odp"]
+
+FileInfo = namedtuple('FileInfo', ['empty', 'size', 'extension'])
+StageTiming = namedtuple('StageTiming', ['stage', 'field', 'duration', 'size'])
+FILE_INFO_ATTRIBUTE = '_dmutils_file_info'
+
+HEADER_READ_SIZE = 4096
+FILE_TYPE_ATTRIBUTE = '_dmutils_file_type'
+# file signatures, checked in order. ODF documents are zip files, see _is_open_document
+FILE_SIGNATURES = [
+    (b'%PDF-', 'pdf'),
+    (b'PK\x03\x04', 'zip'),
+    (b'PK\x05\x06', 'zip'),  # empty zip
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+]
+EXTENSION_FILE_TYPES = {
+    '.pdf': ('pdf',),
+    '.pda': ('pdf',),
+    '.odt': ('odf',),
+    '.ods': ('odf',),
+    '.odp': ('odf',),
+    '.zip': ('zip', 'odf'),
+    '.jpg': ('jpeg',),
+    '.jpeg': ('jpeg',),
+    '.png': ('png',),
+    '.csv': ('text',),
+}
+# bytes that can appear in text files: printable ASCII, tab, newlines, form feed and anything non-ASCII
+TEXT_BYTES = bytes(bytearray([9, 10, 12, 13]) + bytearray(range(32, 127)) + bytearray(range(128, 256)))
+
+_SIGNATURES_BY_PREFIX = {}
+for _signature, _file_type in FILE_SIGNATURES:
+    _SIGNATURES_BY_PREFIX.setdefault(_signature[:2], []).append((_signature, _file_type))
+_UNKNOWN = object()
+
+_signed_url_cache = KeyCache(maxsize=4096, ttl=SIGNED_URL_EXPIRES_IN - SIGNED_URL_SAFETY_MARGIN)
+
 
 def filter_empty_files(files):
     """Remove any empty files from the list.
@@ -37,10 +119,11 @@ def filter_empty_files(files):
     return result
 
 
-def validate_documents(files):
+def validate_documents(files, check_content=False):
     """Validate document files for size and format
 
     :param files: a dictionary of file attachments
+    :param check_content: also check that the first bytes of each file match its extension
 
     :return: a dictionary of errors, where keys match
              the keys from the ``files`` argument and
@@ -53,15 +136,18 @@ def validate_documents(files):
     errors = {}
     for field in files.keys():
         for x in files[field]:
-            if not file_is_open_document_format(x):
+            info = inspect_file(x)
+            if info.extension not in OPEN_DOCUMENT_FORMAT_EXTENSIONS:
+                errors[field] = 'file_is_open_document_format'
+            elif check_content and not file_content_matches_extension(x):
                 errors[field] = 'file_is_open_document_format'
-            elif not file_is_less_than_5mb(x):
+            elif info.size >= FILE_SIZE_LIMIT:
                 errors[field] = 'file_is_less_than_5mb'
 
     return errors
 
 
-def upload_document(uploader, documents_url, service, field, file_contents, public=True):
+def upload_document(uploader, documents_url, service, field, file_contents, public=True, instrumentation=None):
     """Upload the document to S3 bucket and return the document URL
 
     :param uploader: S3 uploader object
@@ -74,11 +160,14 @@ def upload_document(uploader, documents_url, service, field, file_contents, publ
     :param file_contents: attached file object
     :param public: if True, set file permission to 'public-read'. Otherwise file
                    is private.
+    :param instrumentation: ``UploadInstrumentation`` to record the upload time
 
     :return: generated document URL or ``False`` if document upload
              failed
 
     """
+    timed = instrumentation.stage if instrumentation else _untimed
+    framework_slug = service['frameworkSlug']
 
     file_path = generate_file_name(
         service['frameworkSlug'],
@@ -91,8 +180,10 @@ def upload_document(uploader, documents_url, service, field, file_contents, publ
 
     acl = 'public-read' if public else 'private'
 
+    size = inspect_file(file_contents).size if instrumentation else None
     try:
-        uploader.upload_fileobj(file_contents, file_path, {'ACL': acl})
+        with timed('upload', framework_slug, field=field, size=size):
+            uploader.upload_fileobj(file_contents, file_path, {'ACL': acl})
     except S3ResponseError:
         rollbar.report_exc_info()
         return False
@@ -105,99 +196,338 @@ def upload_document(uploader, documents_url, service, field, file_contents, publ
     return full_url
 
 
-def upload_service_documents(bucket, documents_url, service, request_files, section, public=True):
+def upload_service_documents(bucket, documents_url, service, request_files, section, public=True,
+                             max_workers=None, start_timeout=None, instrumentation=None):
+    """Validate and upload the documents for a service
 
-    files = {field: request_files.getlist(field) for field in section.get_question_ids(type="upload")
-             if field in request_files}
-    files = filter_empty_files(files)
-    errors = validate_documents(files)
-    s3 = boto3.resource(
-        's3',
-        endpoint_url=os.getenv('AWS_S3_URL')
-    )
-    uploader = s3.Bucket(bucket)
+    :param max_workers: if set, upload up to this many files at the same time, through the shared
+                        S3 client
+    :param start_timeout: when uploading files concurrently, the number of seconds to wait for uploads
+                          to start. Files that haven't started uploading in time are reported as errors.
+                          Uploads that have started are always waited for, so this doesn't limit how
+                          long the call takes.
+    :param instrumentation: ``UploadInstrumentation`` to record how long each stage takes
+
+    :return: a ``(files, errors)`` tuple, where ``files`` maps fields to lists of document URLs
+             and ``errors`` maps fields to validator names, as returned by ``validate_documents``
+    """
+    try:
+        return _upload_service_documents(bucket, documents_url, service, request_files, section, public,
+                                         max_workers, start_timeout, instrumentation)
+    finally:
+        if instrumentation is not None:
+            instrumentation.flush()
+
+
+def _upload_service_documents(bucket, documents_url, service, request_files, section, public,
+                              max_workers, start_timeout, instrumentation):
+    timed = instrumentation.stage if instrumentation else _untimed
+    framework_slug = service['frameworkSlug']
+
+    with timed('validate', framework_slug):
+        files = {field: request_files.getlist(field) for field in section.get_question_ids(type="upload")
+                 if field in request_files}
+        files = filter_empty_files(files)
+        errors = validate_documents(files)
     if errors:
         return None, errors
 
     if len(files) == 0:
         return {}, {}
 
+    with timed('connect', framework_slug):
+        if max_workers is None:
+            uploader = aws.registry.s3_resource().Bucket(bucket)
+        else:
+            # resources aren't thread-safe, but the client is, and is shared by every request
+            uploader = _ClientUploader(aws.registry.s3_client(), bucket)
+
+    uploads = []
     for field, contents in files.items():
         for i, content in enumerate(contents):
             file_service = service.copy()
             file_service['id'] = "{}-{}".format(service['id'], i)
-            url = upload_document(
-                uploader, documents_url, file_service, field, content,
-                public=public)
-
-            if not url:
-                errors[field] = 'file_can_be_saved'
-            else:
-                files[field][i] = url
+            uploads.append((field, i, file_service, content))
+
+    with timed('total', framework_slug, size=sum(inspect_file(content).size for _, _, _, content in uploads)):
+        if max_workers is None:
+            urls = [
+                upload_document(uploader, documents_url, file_service, field, content, public=public,
+                                instrumentation=instrumentation)
+                for field, i, file_service, content in uploads
+            ]
+        else:
+            urls = _upload_documents_concurrently(uploader, documents_url, uploads, public, max_workers,
+                                                  start_timeout, instrumentation)
+
+    for (field, i, file_service, content), url in zip(uploads, urls):
+        if not url:
+            errors[field] = 'file_can_be_saved'
+        else:
+            files[field][i] = url
 
     return files, errors
 
 
+def _upload_documents_concurrently(uploader, documents_url, uploads, public, max_workers, start_timeout,
+                                   instrumentation=None):
+    """Upload documents from a pool of threads
+
+    Uploads that haven't started after ``start_timeout`` seconds are cancelled and reported as
+    failed. The ones that have started are waited for, so every document that ends up in the
+    bucket is reported to the caller.
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = []
+    try:
+        futures.extend(
+            executor.submit(upload_document, uploader, documents_url, file_service, field, content, public=public,
+                            instrumentation=instrumentation)
+            for field, i, file_service, content in uploads
+        )
+        wait(futures, timeout=start_timeout)
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+    return [False if future.cancelled() else future.result() for future in futures]
+
+
+class _ClientUploader(object):
+    """Uploads to a bucket through an S3 client, with the same call as a boto3 ``Bucket``"""
+    def __init__(self, client, bucket):
+        self.client = client
+        self.bucket = bucket
+
+    def upload_fileobj(self, fileobj, key, extra_args=None):
+        self.client.upload_fileobj(fileobj, self.bucket, key, ExtraArgs=extra_args)
+
+
+class UploadInstrumentation(object):
+    """Records how long each stage of ``upload_service_documents`` takes
+
+    The stages are ``validate`` (reading and checking the files), ``connect`` (getting the
+    S3 resource or client), ``upload`` (for each file) and ``total`` (all the uploads). Each
+    one is kept in ``timings`` and logged. If there is a metrics client, they're sent together
+    as ``<prefix>.<stage>`` timers with a ``framework`` dimension once the documents have been
+    uploaded, along with the number of bytes as ``<prefix>.<stage>.bytes`` for the stages that
+    have a size, so throughput can be worked out per framework::
+
+        instrumentation = UploadInstrumentation(metrics.client)
+        files, errors = upload_service_documents(..., instrumentation=instrumentation)
+
+    :param metrics_client: ``dmutils.metrics.CloudWatchClient``, or ``None`` to only log timings
+    """
+    def __init__(self, metrics_client=None, prefix=UPLOAD_METRIC_PREFIX, logger=logger):
+        self.metrics_client = metrics_client
+        self.prefix = prefix
+        self.logger = logger
+        self.timings = []
+        self._unsent = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, stage, framework_slug, field=None, size=None):
+        start = monotonic()
+        yield
+        self.record(stage, framework_slug, monotonic() - start, field=field, size=size)
+
+    def record(self, stage, framework_slug, duration, field=None, size=None):
+        self.logger.info(
+            "Document upload stage {stage} took {duration}ms",
+            extra={
+                "stage": stage,
+                "framework": framework_slug,
+                "field": field,
+                "duration": int(duration * 1000),
+                "size": size,
+            })
+
+        # concurrent uploads record from many threads
+        with self._lock:
+            self.timings.append(StageTiming(stage, field, duration, size))
+            self._unsent.append((stage, framework_slug, duration, size))
+
+    def flush(self):
+        """Send the timings recorded since the last flush to the metrics client, in as few requests as possible"""
+        with self._lock:
+            unsent, self._unsent = self._unsent, []
+
+        if self.metrics_client is None or not unsent:
+            return
+        metrics = []
+        for stage, framework_slug, duration, size in unsent:
+            name = '{}.{}'.format(self.prefix, stage)
+            dimensions = {'framework': framework_slug}
+            metrics.append(Metric(name, int(duration * 1000), 'Milliseconds', dimensions))
+            if size is not None:
+                metrics.append(Metric(name + '.bytes', size, 'Bytes', dimensions))
+        self.metrics_client.put_metrics(metrics)
+
+
+@contextmanager
+def _untimed(*args, **kwargs):
+    yield
+
+
+def inspect_file(file_contents):
+    """Find the size, emptiness and extension of an uploaded file in a single pass
+
+    The size is measured with seek/tell, or taken from the Content-Length of the upload,
+    and the file is only read (up to ``FILE_SIZE_LIMIT``) if neither is available. The
+    result is cached on the file object so validating a file more than once is free.
+
+    :return: ``FileInfo(empty, size, extension)``
+    """
+    info = getattr(file_contents, '__dict__', {}).get(FILE_INFO_ATTRIBUTE)
+    if info is None:
+        size = get_file_size(file_contents)
+        if size is None:
+            size = _content_length(file_contents)
+        if size is None:
+            size = get_file_size_up_to_maximum(file_contents)
+
+        info = FileInfo(size == 0, size, get_extension(getattr(file_contents, 'filename', None) or ''))
+        try:
+            setattr(file_contents, FILE_INFO_ATTRIBUTE, info)
+        except AttributeError:
+            pass
+
+    return info
+
+
+def _content_length(file_contents):
+    content_length = getattr(file_contents, 'content_length', None)
+    if isinstance(content_length, six.integer_types) and content_length > 0:
+        return content_length
+
+
 def file_is_not_empty(file_contents):
     return not file_is_empty(file_contents)
 
 
 def file_is_empty(file_contents):
-    empty = len(file_contents.read(1)) == 0
-    file_contents.seek(0)
-    return empty
+    return inspect_file(file_contents).empty
 
 
 def file_is_less_than_5mb(file_contents):
-    return get_file_size_up_to_maximum(file_contents) < FILE_SIZE_LIMIT
+    return inspect_file(file_contents).size < FILE_SIZE_LIMIT
 
 
-def file_is_open_document_format(file_object):
-    return get_extension(file_object.filename) in [
-        ".pdf", ".pda", ".odt", ".ods", ".odp"
-    ]
+def file_is_open_document_format(file_object, check_content=False):
+    """Checks file extension as being an open document format (or PDF).
+
+    :param check_content: also check that the file content matches its extension
+    """
+    return _file_has_type(file_object, OPEN_DOCUMENT_FORMAT_EXTENSIONS, check_content)
 
 
-def file_is_pdf(file_object):
+def file_is_pdf(file_object, check_content=False):
     """Checks file extension as being PDF."""
-    return get_extension(file_object.filename) in [
+    return _file_has_type(file_object, [
         ".pdf", ".pda"
-    ]
+    ], check_content)
 
 
-def file_is_csv(file_object):
+def file_is_csv(file_object, check_content=False):
     """Checks file extension as being CSV."""
-    return get_extension(file_object.filename) in [
+    return _file_has_type(file_object, [
         ".csv"
-    ]
+    ], check_content)
 
 
-def file_is_zip(file_object):
+def file_is_zip(file_object, check_content=False):
     """Checks file extension as being ZIP."""
-    return get_extension(file_object.filename) in [
+    return _file_has_type(file_object, [
         ".zip"
-    ]
+    ], check_content)
 
 
-def file_is_image(file_object):
+def file_is_image(file_object, check_content=False):
     """Checks file extension as being JPG. or PNG."""
-    return get_extension(file_object.filename) in [
+    return _file_has_type(file_object, [
         ".jpg", ".jpeg", ".png"
-    ]
+    ], check_content)
+
+
+def _file_has_type(file_object, extensions, check_content):
+    extension = get_extension(file_object.filename)
+    if extension not in extensions:
+        return False
+
+    return not check_content or file_content_matches_extension(file_object)
+
+
+def file_content_matches_extension(file_object):
+    """Checks that the first bytes of a file match the type its extension claims it is.
+
+    Files with extensions we don't know the content of never match.
+    """
+    expected_types = EXTENSION_FILE_TYPES.get(get_extension(file_object.filename), ())
+    return detect_file_type(file_object) in expected_types
+
+
+def detect_file_type(file_object):
+    """Detects the type of a file from its first ``HEADER_READ_SIZE`` bytes.
+
+    The result is cached on the file object, and the stream is rewound after reading.
+
+    :return: one of 'pdf', 'odf', 'zip', 'png', 'jpeg' or 'text', or ``None`` if the
+             type isn't recognised
+    """
+    file_type = getattr(file_object, '__dict__', {}).get(FILE_TYPE_ATTRIBUTE, _UNKNOWN)
+    if file_type is _UNKNOWN:
+        file_type = detect_header_type(_read_header(file_object))
+        try:
+            setattr(file_object, FILE_TYPE_ATTRIBUTE, file_type)
+        except AttributeError:
+            pass
+
+    return file_type
+
+
+def detect_header_type(header):
+    """Detects the type of a file from its first bytes, see ``detect_file_type``"""
+    for signature, file_type in _SIGNATURES_BY_PREFIX.get(header[:2], ()):
+        if header.startswith(signature):
+            if file_type == 'zip' and _is_open_document(header):
+                return 'odf'
+            return file_type
+
+    # PDF readers accept the signature anywhere in the first 1024 bytes
+    if b'%PDF-' in header[:1024]:
+        return 'pdf'
+
+    if header and not header.translate(None, TEXT_BYTES):
+        return 'text'
+
+
+def _is_open_document(header):
+    # an ODF package starts with an uncompressed "mimetype" entry holding the document's MIME type
+    return header[30:38] == b'mimetype' and header[38:73] == b'application/vnd.oasis.opendocument.'
+
+
+def _read_header(file_object):
+    try:
+        position = file_object.tell()
+    except (AttributeError, IOError, ValueError):
+        position = 0
+    if not isinstance(position, six.integer_types):
+        position = 0
+
+    header = file_object.read(HEADER_READ_SIZE)
+    file_object.seek(position)
+
+    if isinstance(header, six.text_type):
+        header = header.encode('utf-8')
+    return header
 
 
 def generate_file_name(framework_slug, bucket_short_name, supplier_code, service_id, field, filename, suffix=None):
     if suffix is None:
         suffix = default_file_suffix()
 
-    ID_TO_FILE_NAME_SUFFIX = {
-        'serviceDefinitionDocumentURL': 'service-definition-document',
-        'termsAndConditionsDocumentURL': 'terms-and-conditions',
-        'sfiaRateDocumentURL': 'sfia-rate-card',
-        'pricingDocumentURL': 'pricing-document',
-        'attachedDocumentURL': 'attachment'
-    }
-
     return '{}/{}/{}/{}-{}-{}{}'.format(
         framework_slug,
         bucket_short_name,
@@ -209,6 +539,43 @@ def generate_file_name(framework_slug, bucket_short_name, supplier_code, service
     )
 
 
+def generate_file_names(framework_slug, bucket_short_name, supplier_codes, service_ids, fields, filenames,
+                        suffix=None):
+    """Generate the paths for many documents, as ``generate_file_name`` does
+
+    ``supplier_codes``, ``service_ids``, ``fields`` and ``filenames`` are columns of equal length,
+    one entry per document. All the paths share the same timestamp ``suffix``.
+
+    :return: list of paths, in the same order as the columns
+    :raises ValueError: if the columns aren't all the same length
+    """
+    columns = _equal_length_columns(
+        supplier_codes=supplier_codes, service_ids=service_ids, fields=fields, filenames=filenames
+    )
+    if suffix is None:
+        suffix = default_file_suffix()
+
+    prefix = '{}/{}/'.format(framework_slug, bucket_short_name)
+    return [
+        prefix + '{}/{}-{}-{}{}'.format(
+            supplier_code, service_id, ID_TO_FILE_NAME_SUFFIX[field], suffix, get_extension(filename)
+        )
+        for supplier_code, service_id, field, filename in zip(
+            columns['supplier_codes'], columns['service_ids'], columns['fields'], columns['filenames']
+        )
+    ]
+
+
+def _equal_length_columns(**columns):
+    columns = {name: list(column) for name, column in columns.items()}
+    lengths = {name: len(column) for name, column in columns.items()}
+    if len(set(lengths.values())) > 1:
+        raise ValueError("Columns have different lengths: {}".format(
+            ', '.join('{} {}'.format(name, length) for name, length in sorted(lengths.items()))
+        ))
+    return columns
+
+
 def default_file_suffix():
     return datetime.datetime.utcnow().strftime("%Y-%m-%d-%H%M")
 
@@ -219,17 +586,149 @@ def get_extension(filename):
 
 
 def get_signed_url(bucket, path, base_url):
-    s3 = boto3.client(
-        's3',
-        endpoint_url=os.getenv('AWS_S3_URL')
+    """Create a signed URL for a document, valid for ``SIGNED_URL_EXPIRES_IN`` seconds
+
+    URLs are cached and reused until they are within ``SIGNED_URL_SAFETY_MARGIN`` seconds of expiring.
+
+    :param base_url: if set, the scheme and host of the URL are replaced with the ones from ``base_url``
+    """
+    url = _signed_url_cache.get(bucket, (path, base_url), default=None)
+    if url is None:
+        url = aws.registry.s3_client().generate_presigned_url(
+            'get_object', Params={'Bucket': bucket, 'Key': path}, ExpiresIn=SIGNED_URL_EXPIRES_IN
+        )
+        if url is not None:
+            if base_url is not None:
+                url = _replace_base_url(url, urlparse.urlparse(base_url))
+            _signed_url_cache.set(bucket, (path, base_url), url)
+    return url
+
+
+def get_signed_urls(bucket, paths, base_url):
+    """Create signed URLs for several documents, see ``get_signed_url``
+
+    :return: dictionary of signed URLs by path
+    """
+    return {path: get_signed_url(bucket, path, base_url) for path in paths}
+
+
+def generate_upload_policy(bucket, path, max_size=FILE_SIZE_LIMIT, expires_in=UPLOAD_POLICY_EXPIRES_IN):
+    """Create a presigned POST policy that lets a browser upload a file straight to S3
+
+    The policy only allows a private upload to ``path``, of less than ``max_size`` bytes, with
+    the Content-Type matching the path's extension. Check the upload with ``verify_document_upload``
+    once the browser reports that it has finished, which makes it public if it's valid.
+
+    :return: dictionary with the form ``url`` and the ``fields`` to submit with the file
+    """
+    fields = {'acl': 'private'}
+    conditions = [{'acl': 'private'}, ['content-length-range', 1, max_size - 1]]
+
+    content_type, _ = mimetypes.guess_type(path)
+    if content_type:
+        fields['Content-Type'] = content_type
+        conditions.append({'Content-Type': content_type})
+
+    return aws.registry.s3_client().generate_presigned_post(
+        Bucket=bucket, Key=path, Fields=fields, Conditions=conditions, ExpiresIn=expires_in
     )
-    url = s3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': path}, ExpiresIn=120)
-    if url is not None:
-        if base_url is not None:
-            url = urlparse.urlparse(url)
-            base_url = urlparse.urlparse(base_url)
-            url = url._replace(netloc=base_url.netloc, scheme=base_url.scheme).geturl()
-        return url
+
+
+def generate_document_upload_policy(bucket, service, field, filename,
+                                    allowed_extensions=OPEN_DOCUMENT_FORMAT_EXTENSIONS,
+                                    expires_in=UPLOAD_POLICY_EXPIRES_IN):
+    """Create a presigned POST policy for uploading a service document straight to S3
+
+    The document path is generated the same way as ``upload_document`` does.
+
+    :return: dictionary with the document ``path``, and the form ``url`` and ``fields``,
+             or ``None`` if the file extension isn't allowed
+    """
+    if get_extension(filename) not in allowed_extensions:
+        return None
+
+    path = generate_file_name(
+        service['frameworkSlug'],
+        'documents',
+        service['supplierCode'],
+        service['id'],
+        field,
+        filename
+    )
+    policy = generate_upload_policy(bucket, path, expires_in=expires_in)
+    policy['path'] = path
+    return policy
+
+
+def verify_document_upload(bucket, service, field, path, max_size=FILE_SIZE_LIMIT, check_content=True, public=True,
+                           allowed_extensions=OPEN_DOCUMENT_FORMAT_EXTENSIONS,
+                           expires_in=UPLOAD_POLICY_EXPIRES_IN):
+    """Check a document uploaded straight to S3 for a service, and publish it or delete it
+
+    ``path`` usually comes back from the browser, so it's only accepted if it's a path that
+    ``generate_document_upload_policy`` could have created for ``service`` and ``field``, and
+    the object there is private and was uploaded in the last ``expires_in`` seconds. Anything
+    else is refused and left alone. Only the object metadata, its ACL and the first
+    ``HEADER_READ_SIZE`` bytes are fetched. Uploads that fail the checks are deleted, so
+    they're never served.
+
+    :param check_content: check that the first bytes of the document match its extension
+    :param public: make the document publicly readable if it's valid
+    :param expires_in: how long the upload policy was valid for, in seconds
+    :return: the name of the failed validator, as used by ``validate_documents``, or
+             ``None`` if the upload is valid
+    """
+    extension = get_extension(path)
+    if extension not in allowed_extensions:
+        return 'file_is_open_document_format'
+
+    prefix = '{}/documents/{}/{}-{}-'.format(
+        service['frameworkSlug'], service['supplierCode'], service['id'], ID_TO_FILE_NAME_SUFFIX[field]
+    )
+    if not path.startswith(prefix) or '/' in path[len(prefix):]:
+        return 'file_can_be_saved'
+
+    s3 = aws.registry.s3_client()
+    try:
+        head = s3.head_object(Bucket=bucket, Key=path)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return 'file_can_be_saved'
+        raise
+
+    # an object that's older than the policy or already public wasn't uploaded with it
+    uploaded_after = datetime.datetime.now(pytz.utc) - datetime.timedelta(seconds=expires_in)
+    if head['LastModified'] < uploaded_after or _is_public(s3.get_object_acl(Bucket=bucket, Key=path)):
+        return 'file_can_be_saved'
+
+    error = None
+    if head['ContentLength'] >= max_size:
+        error = 'file_is_less_than_5mb'
+    elif check_content:
+        header = s3.get_object(
+            Bucket=bucket, Key=path, Range='bytes=0-{}'.format(HEADER_READ_SIZE - 1)
+        )['Body'].read()
+        if detect_header_type(header) not in EXTENSION_FILE_TYPES.get(extension, ()):
+            error = 'file_is_open_document_format'
+
+    if error:
+        s3.delete_object(Bucket=bucket, Key=path)
+    elif public:
+        s3.put_object_acl(Bucket=bucket, Key=path, ACL='public-read')
+
+    return error
+
+
+def _is_public(acl):
+    return any(
+        grant.get('Grantee', {}).get('URI') == ALL_USERS_GRANTEE
+        and grant.get('Permission') in ('READ', 'FULL_CONTROL')
+        for grant in acl.get('Grants', [])
+    )
+
+
+def _replace_base_url(url, base_url):
+    return urlparse.urlparse(url)._replace(netloc=base_url.netloc, scheme=base_url.scheme).geturl()
 
 
 # this method is deprecated
@@ -250,12 +749,181 @@ def get_document_path(framework_slug, supplier_code, bucket_category, document_n
     )
 
 
+def get_agreement_document_paths(framework_slug, supplier_codes, document_name):
+    """Return ``get_agreement_document_path`` for each of ``supplier_codes``"""
+    return get_document_paths(framework_slug, supplier_codes, 'agreements', document_name)
+
+
+def get_document_paths(framework_slug, supplier_codes, bucket_category, document_name):
+    """Return ``get_document_path`` for each of ``supplier_codes``
+
+    :param document_name: a single document name used for every supplier, or a list
+                          of names, one for each supplier
+    :raises ValueError: if there's a list of names that isn't the same length as ``supplier_codes``
+    """
+    if isinstance(document_name, six.string_types):
+        supplier_codes = list(supplier_codes)
+        document_names = itertools.repeat(document_name)
+    else:
+        columns = _equal_length_columns(supplier_codes=supplier_codes, document_names=document_name)
+        supplier_codes, document_names = columns['supplier_codes'], columns['document_names']
+
+    prefix = '{}/{}/'.format(framework_slug, bucket_category)
+    return [
+        prefix + '{0}/{0}-{1}'.format(supplier_code, name)
+        for supplier_code, name in zip(supplier_codes, document_names)
+    ]
+
+
+def stream_zip(bucket, paths, names=None, max_workers=ZIP_FETCH_WORKERS, compression=zipfile.ZIP_STORED,
+               chunk_size=ZIP_CHUNK_SIZE, max_memory=ZIP_SPOOL_MAX_MEMORY):
+    """Stream a zip archive of documents from an S3 bucket
+
+    Up to ``max_workers`` documents are downloaded at the same time, each into a temporary
+    file that is kept in memory until it's bigger than ``max_memory`` bytes. They are added
+    to the archive in order, and the archive is generated in chunks as it's written, so it
+    is never held in memory. The result can be returned as a streaming response::
+
+        return Response(stream_with_context(stream_zip(bucket, paths)), mimetype='application/zip')
+
+    :param paths: S3 keys of the documents
+    :param names: names of the documents in the archive, by default the last part of each path.
+                  Repeated names are made unique by adding a number, as in ``foo-2.pdf``.
+    :param compression: ``zipfile`` compression method. Documents are usually compressed already,
+                        so by default they are stored as they are.
+    :return: iterator of bytes
+    :raises ValueError: if there isn't a name for each path
+    """
+    paths = list(paths)
+    names = list(names) if names is not None else [os.path.basename(path) for path in paths]
+    if len(names) != len(paths):
+        raise ValueError("Got {} names for {} paths".format(len(names), len(paths)))
+
+    return _stream_zip(bucket, paths, _unique_names(names), max_workers, compression, chunk_size, max_memory)
+
+
+def _stream_zip(bucket, paths, names, max_workers, compression, chunk_size, max_memory):
+    s3 = aws.registry.s3_client()
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    downloads = deque()
+    pending = iter(paths)
+    stream = _ZipStream()
+    try:
+        for path in itertools.islice(pending, max_workers):
+            downloads.append(executor.submit(_download_to_spool, s3, bucket, path, chunk_size, max_memory))
+
+        with zipfile.ZipFile(stream, 'w', compression) as archive:
+            for name in names:
+                download = downloads.popleft()
+                for path in itertools.islice(pending, 1):
+                    downloads.append(executor.submit(_download_to_spool, s3, bucket, path, chunk_size, max_memory))
+
+                with download.result() as spool:
+                    for chunk in _write_to_zip(archive, stream, name, spool, chunk_size):
+                        yield chunk
+
+        yield stream.drain()
+    finally:
+        for download in downloads:
+            if not download.cancel():
+                download.add_done_callback(_close_spool)
+        executor.shutdown(wait=False)
+
+
+class _ZipStream(object):
+    """A write-only, non-seekable file that zipfile can write an archive to, emptied with ``drain``"""
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _download_to_spool(s3, bucket, path, chunk_size, max_memory):
+    body = s3.get_object(Bucket=bucket, Key=path)['Body']
+    spool = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    try:
+        for chunk in iter(lambda: body.read(chunk_size), b''):
+            spool.write(chunk)
+    except Exception:
+        spool.close()
+        raise
+    finally:
+        body.close()
+
+    spool.seek(0)
+    return spool
+
+
+def _unique_names(names):
+    seen = set(names)
+    used = set()
+    unique = []
+    for name in names:
+        if name in used:
+            root, ext = os.path.splitext(name)
+            name = next(
+                candidate for candidate in ('{}-{}{}'.format(root, i, ext) for i in itertools.count(2))
+                if candidate not in seen
+            )
+            seen.add(name)
+        used.add(name)
+        unique.append(name)
+    return unique
+
+
+def _write_to_zip(archive, stream, name, spool, chunk_size):
+    """Add a file to the archive, yielding the archive data written to ``stream`` after each chunk"""
+    if sys.version_info >= (3, 6):
+        with archive.open(name, 'w') as entry:
+            for chunk in iter(lambda: spool.read(chunk_size), b''):
+                entry.write(chunk)
+                data = stream.drain()
+                if data:
+                    yield data
+    else:
+        # before Python 3.6 entries can only be written in one go
+        archive.writestr(name, spool.read())
+
+    data = stream.drain()
+    if data:
+        yield data
+
+
+def _close_spool(download):
+    if download.exception() is None:
+        download.result().close()
+
+
 def sanitise_supplier_name(supplier_name):
     """Replace ampersands with 'and' and spaces with a single underscore."""
-    sanitised_supplier_name = supplier_name.encode("ascii", errors="ignore").decode("ascii").strip()
-    sanitised_supplier_name = sanitised_supplier_name.replace(' ', '_').replace('&', 'and')
-    for bad_char in BAD_SUPPLIER_NAME_CHARACTERS:
-        sanitised_supplier_name = sanitised_supplier_name.replace(bad_char, '')
-    while '__' in sanitised_supplier_name:
-        sanitised_supplier_name = sanitised_supplier_name.replace('__', '_')
-    return sanitised_supplier_name
+    sanitised_supplier_name = supplier_name.encode("ascii", errors="ignore").strip(_ASCII_WHITESPACE)
+    sanitised_supplier_name = sanitised_supplier_name.replace(b'&', b'and').translate(
+        _SUPPLIER_NAME_TRANSLATION, _SUPPLIER_NAME_DELETIONS
+    )
+    if b'__' in sanitised_supplier_name:
+        sanitised_supplier_name = _REPEATED_UNDERSCORES.sub(b'_', sanitised_supplier_name)
+    return sanitised_supplier_name.decode("ascii")
+
+
+def sanitise_supplier_names(supplier_names):
+    """Sanitise each of an iterable of supplier names, as in ``sanitise_supplier_name``
+
+    :return: list of sanitised names, in the same order
+    """
+    return [sanitise_supplier_name(supplier_name) for supplier_name in supplier_names]
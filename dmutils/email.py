@@ -3,6 +3,7 @@ from __future__ import \
     absolute_import
 
 import base64
+from collections import namedtuple
 from datetime import datetime, timedelta
 import hashlib
 import json
@@ -11,24 +12,49 @@ import struct
 import sys
 import codecs
 import textwrap
+import threading
+import time
+import weakref
 
-import boto3
 import botocore.exceptions
 from flask import current_app
 from flask._compat import string_types
-from os import getenv
 
 import pendulum
-from cryptography.fernet import Fernet, InvalidToken
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+from jinja2.utils import LRUCache
+from monotonic import monotonic
+
+from . import aws
 
 
 ONE_DAY_IN_SECONDS = 86400
 
+SES_MAX_SEND_RATE = 14  # emails per second, the SES default
+BULK_EMAIL_WORKERS = 10
+THROTTLING_RETRIES = 3
+THROTTLING_BACKOFF = 0.5  # seconds before the first retry, doubled for each one after
+
+EmailResult = namedtuple('EmailResult', ['to_email_addresses', 'message_id', 'error'])
+
+# compiled email templates for each Jinja environment, see get_email_template
+_email_templates = weakref.WeakKeyDictionary()
+EMAIL_TEMPLATE_CACHE_SIZE = 50
+
+# Fernet objects for each secret key, see get_fernet
+_fernets = {}
+
 
 class EmailError(Exception):
     pass
 
 
+class EmailThrottlingError(EmailError):
+    """SES refused to send an email because the sending rate was exceeded"""
+    pass
+
+
 def to_bytes(x):
     if isinstance(x, six.string_types):
         return x.encode('utf-8')
@@ -74,13 +100,7 @@ Reply-To: {reply_to}
         email_body = to_bytes(email_body)
         subject = to_bytes(subject)
 
-        email_client = boto3.client(
-            'ses',
-            region_name=getenv('AWS_REGION'),
-            aws_access_key_id=getenv('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=getenv('AWS_SECRET_ACCESS_KEY'),
-            endpoint_url=getenv('AWS_SES_URL')
-        )
+        email_client = aws.registry.ses_client()
 
         destination_addresses = {
             'ToAddresses': to_email_addresses,
@@ -110,12 +130,159 @@ Reply-To: {reply_to}
         )
     except botocore.exceptions.ClientError as e:
         current_app.logger.error("An SES error occurred: {error}", extra={'error': e.response['Error']['Message']})
+        if e.response['Error'].get('Code') == 'Throttling':
+            raise EmailThrottlingError(e.response['Error']['Message'])
         raise EmailError(e.response['Error']['Message'])
 
     current_app.logger.info("Sent email: id={id}, email={email_hash}",
                             extra={'id': result['ResponseMetadata']['RequestId'],
                                    'email_hash': hash_email(to_email_addresses[0])})
 
+    return result.get('MessageId')
+
+
+def send_bulk_emails(messages, max_rate_per_sec=SES_MAX_SEND_RATE, workers=BULK_EMAIL_WORKERS,
+                     retries=THROTTLING_RETRIES, backoff=THROTTLING_BACKOFF):
+    """Send many emails at the same time, without going over the SES sending rate
+
+    Emails are sent by a pool of ``workers`` threads, at most ``max_rate_per_sec`` a second.
+    Emails that SES refuses because of throttling are retried up to ``retries`` times, waiting
+    ``backoff`` seconds before the first retry and twice as long before each one after that.
+
+    Must be called in an app context, which is pushed in each worker thread.
+
+    :param messages: iterable of dictionaries of ``send_email`` arguments
+    :return: list of ``EmailResult(to_email_addresses, message_id, error)``, one for each message
+             in the same order. ``error`` is the exception if the email couldn't be sent. No emails
+             are still being sent when this returns or raises.
+    """
+    app = current_app._get_current_object()
+    rate_limit = TokenBucket(max_rate_per_sec)
+
+    def send(message):
+        with app.app_context():
+            return _send_with_retries(message, rate_limit, retries, backoff)
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = []
+    try:
+        futures.extend(executor.submit(send, message) for message in messages)
+        return [future.result() for future in futures]
+    finally:
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _send_with_retries(message, rate_limit, retries, backoff):
+    to_email_addresses = message.get('to_email_addresses') if isinstance(message, dict) else None
+    for attempt in range(retries + 1):
+        rate_limit.acquire()
+        try:
+            return EmailResult(to_email_addresses, send_email(**message), None)
+        except EmailThrottlingError as e:
+            if attempt == retries:
+                return EmailResult(to_email_addresses, None, e)
+            time.sleep(backoff * 2 ** attempt)
+        except EmailError as e:
+            return EmailResult(to_email_addresses, None, e)
+        except Exception as e:
+            current_app.logger.exception("Failed to send email in bulk: {error}", extra={'error': repr(e)})
+            return EmailResult(to_email_addresses, None, e)
+
+
+class TokenBucket(object):
+    """Thread-safe rate limiter allowing ``rate`` calls to ``acquire`` a second
+
+    Up to ``capacity`` calls (by default one second's worth) can be made in a burst after a pause.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting until one is available"""
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def get_email_template(source):
+    """Return the compiled template for ``source``, compiling it the first time it's used
+
+    Templates are compiled with the app's Jinja environment. The ``EMAIL_TEMPLATE_CACHE_SIZE`` most
+    recently used are kept, like Jinja's own template cache, for as long as the environment exists.
+    """
+    jinja_env = current_app.jinja_env
+    templates = _email_templates.get(jinja_env)
+    if templates is None:
+        templates = _email_templates.setdefault(jinja_env, LRUCache(EMAIL_TEMPLATE_CACHE_SIZE))
+
+    template = templates.get(source)
+    if template is None:
+        template = templates[source] = jinja_env.from_string(source)
+    return template
+
+
+def render_email(source, **context):
+    """Render an email body from a template string, like ``render_template_string`` without recompiling it"""
+    return _render(get_email_template(source), context)
+
+
+def render_emails(source, contexts):
+    """Render an email body from a template string for each of ``contexts``
+
+    The template is compiled once, and the time taken to render all the emails is logged.
+
+    :param contexts: iterable of dictionaries of template variables
+    :return: list of rendered email bodies, in the same order
+    """
+    start = monotonic()
+    template = get_email_template(source)
+    bodies = [_render(template, context) for context in contexts]
+
+    current_app.logger.info("Rendered {email_count} emails in {duration}ms",
+                            extra={'email_count': len(bodies), 'duration': int((monotonic() - start) * 1000)})
+    return bodies
+
+
+def _render(template, context):
+    context = dict(context)
+    current_app.update_template_context(context)
+    return template.render(context)
+
+
+def get_fernet(secret_key):
+    """Return a ``Fernet`` for ``secret_key``, creating it the first time the key is used
+
+    :param secret_key: a key, or a list of keys to support key rotation. Tokens are encrypted with
+                       the first key, and can be decrypted with any of them.
+    """
+    if isinstance(secret_key, (list, tuple)):
+        cache_key = tuple(to_bytes(key) for key in secret_key)
+    else:
+        cache_key = to_bytes(secret_key)
+
+    fernet = _fernets.get(cache_key)
+    if fernet is None:
+        if isinstance(cache_key, tuple):
+            fernet = MultiFernet([Fernet(key) for key in cache_key])
+        else:
+            fernet = Fernet(cache_key)
+        _fernets[cache_key] = fernet
+    return fernet
+
 
 def generate_token(data, secret_key, salt):
     """
@@ -123,12 +290,27 @@ def generate_token(data, secret_key, salt):
 
     The "salt" isn't a cryptographic salt.  Use a different salt for different handlers to avoid replay attacks
     (e.g., a token created for /create-buyer-user being sent by an attacker to /give-user-admin-rights)
+
+    :param secret_key: a key, or a list of keys, as in ``get_fernet``
     """
+    return _encrypt(get_fernet(secret_key), data, to_bytes(salt))
+
+
+def generate_tokens(batch, secret_key, salt):
+    """Generate a token for each of ``batch``, as ``generate_token`` does
+
+    :return: list of tokens, in the same order
+    """
+    fernet = get_fernet(secret_key)
+    salt = to_bytes(salt)
+    return [_encrypt(fernet, data, salt) for data in batch]
+
+
+def _encrypt(fernet, data, salt):
     json_data = json.dumps(data)
-    fernet = Fernet(to_bytes(secret_key))
     bytestring = b'\0'.join(
         [
-            to_bytes(salt),
+            salt,
             to_bytes(json_data)
         ]
     )
@@ -136,7 +318,11 @@ def generate_token(data, secret_key, salt):
 
 
 def decode_token(token, secret_key, salt, max_age_in_seconds=ONE_DAY_IN_SECONDS):
-    fernet = Fernet(to_bytes(secret_key))
+    """Decode a token made by ``generate_token``
+
+    :param secret_key: a key, or a list of keys, as in ``get_fernet``
+    """
+    fernet = get_fernet(secret_key)
     cleartext = fernet.decrypt(token, ttl=max_age_in_seconds)
     token_salt, json_data = cleartext.split(b'\0', 1)
     if token_salt != to_bytes(salt):
@@ -144,6 +330,17 @@ def decode_token(token, secret_key, salt, max_age_in_seconds=ONE_DAY_IN_SECONDS)
     return json.loads(json_data.decode('utf-8'))
 
 
+def _decoding_keys(config_key):
+    """The key from the app config, followed by any previous keys tokens may still use
+
+    Previous keys are listed in the ``DM_PREVIOUS_<config_key>S`` setting, e.g. ``DM_PREVIOUS_SECRET_KEYS``.
+    """
+    previous_keys = current_app.config.get('DM_PREVIOUS_{}S'.format(config_key))
+    if previous_keys:
+        return [current_app.config[config_key]] + list(previous_keys)
+    return current_app.config[config_key]
+
+
 def hash_email(email):
     m = hashlib.sha256()
     m.update(to_bytes(email))
@@ -171,7 +368,7 @@ def decode_password_reset_token(token, data_api_client):
     try:
         decoded = decode_token(
             token,
-            current_app.config["SECRET_KEY"],
+            _decoding_keys("SECRET_KEY"),
             current_app.config["RESET_PASSWORD_SALT"],
             ONE_DAY_IN_SECONDS
         )
@@ -197,7 +394,7 @@ def decode_invitation_token(encoded_token, role):
     try:
         token = decode_token(
             encoded_token,
-            current_app.config['SHARED_EMAIL_KEY'],
+            _decoding_keys('SHARED_EMAIL_KEY'),
             current_app.config['INVITE_EMAIL_SALT'],
             7 * ONE_DAY_IN_SECONDS
         )
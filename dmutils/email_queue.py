@@ -0,0 +1,304 @@
+"""Send emails from background threads, so requests don't wait for SES
+
+Install a queue on the app, and ``notify_team`` and anything else that looks for
+``app.extensions['email_queue']`` will send through it::
+
+    email_queue = EmailQueue()
+    email_queue.init_app(app)
+
+    email_queue.send_email(to_email_addresses, email_body, subject, from_email, from_name)
+
+Emails are held in a bounded in-memory queue and sent by a few worker threads, which are
+started when the queue is first used in each process, so it works under forking servers.
+
+If ``DM_EMAIL_SPOOL_PATH`` is set, emails that can't be queued or sent straight away (because
+the queue is full, sending failed, or the app is shutting down) are written to a sqlite file
+there, which can be shared by several processes. Spooled emails are leased by a queue when
+it has room for them, and only removed from the spool once they have been sent. If a process
+dies while holding a lease, its emails are picked up by another queue when the lease expires.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing, contextmanager
+
+from monotonic import monotonic
+from six.moves import queue
+
+from .email import send_email, to_text, EmailError, EmailThrottlingError
+
+logger = logging.getLogger(__name__)
+
+EMAIL_QUEUE_SIZE = 1000
+EMAIL_QUEUE_WORKERS = 2
+EMAIL_QUEUE_DRAIN_TIMEOUT = 10  # seconds to keep sending queued emails for when shutting down
+EMAIL_SPOOL_RETRY_INTERVAL = 30  # seconds the queue is idle for before spooled emails are retried
+EMAIL_SPOOL_LEASE = 300  # seconds a queue has to send the spooled emails it takes before others can
+EMAIL_SPOOL_BATCH_SIZE = 100  # most spooled emails taken at once when the queue has no size limit
+
+_STOP = object()
+
+
+class EmailQueue(object):
+    def __init__(self, app=None, sender=send_email):
+        """
+        :param sender: function called to send each email, with the arguments of ``send_email``
+        """
+        self.sender = sender
+        self.app = None
+        self.spool = None
+        self.maxsize = EMAIL_QUEUE_SIZE
+        self.workers = EMAIL_QUEUE_WORKERS
+        self._lock = threading.Lock()
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._owner = uuid.uuid4().hex
+        self._queue = None
+        self._workers = []
+        self._stopping = False
+        self._draining = True
+
+    def init_app(self, app):
+        app.config.setdefault('DM_EMAIL_QUEUE_SIZE', EMAIL_QUEUE_SIZE)
+        app.config.setdefault('DM_EMAIL_QUEUE_WORKERS', EMAIL_QUEUE_WORKERS)
+        app.config.setdefault('DM_EMAIL_SPOOL_PATH', None)
+
+        self.app = app
+        self.maxsize = app.config['DM_EMAIL_QUEUE_SIZE']
+        self.workers = app.config['DM_EMAIL_QUEUE_WORKERS']
+        if app.config['DM_EMAIL_SPOOL_PATH']:
+            self.spool = EmailSpool(app.config['DM_EMAIL_SPOOL_PATH'])
+        app.extensions['email_queue'] = self
+
+        atexit.register(self.shutdown)
+
+    def start(self):
+        """Start the worker threads if they aren't running in this process, and queue spooled emails
+
+        Called when the queue is first used, so the threads are started in each forked worker
+        process rather than in the parent.
+        """
+        if self._queue is not None and self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # the parent's threads and queued emails weren't copied into this process
+                self._reset()
+            if self._queue is not None or self._stopping:
+                return
+
+            self._queue = queue.Queue(self.maxsize)
+            self._workers = [
+                threading.Thread(target=self._work, name='email-queue-{}'.format(i)) for i in range(self.workers)
+            ]
+            for worker in self._workers:
+                worker.daemon = True
+                worker.start()
+
+        self.requeue_spooled()
+
+    def requeue_spooled(self):
+        """Lease as many spooled emails as there is room for in the queue"""
+        if self.spool is None:
+            return
+
+        limit = self.maxsize - self._queue.qsize() if self.maxsize > 0 else EMAIL_SPOOL_BATCH_SIZE
+        for spool_id, message in self.spool.lease(self._owner, limit, EMAIL_SPOOL_LEASE):
+            try:
+                self._queue.put_nowait((spool_id, message))
+            except queue.Full:
+                self.spool.release(spool_id, self._owner)
+
+    def send_email(self, to_email_addresses, email_body, subject, from_email, from_name, reply_to=None):
+        """Queue an email to be sent in the background
+
+        Takes the same arguments as ``dmutils.email.send_email``. If the queue is full the email is
+        written to the spool, or if there isn't one this waits until there's space in the queue.
+        """
+        self._put({
+            'to_email_addresses': to_email_addresses,
+            'email_body': to_text(email_body),
+            'subject': to_text(subject),
+            'from_email': from_email,
+            'from_name': from_name,
+            'reply_to': reply_to,
+        })
+
+    def join(self):
+        """Wait until every queued email has been sent"""
+        self.start()
+        if self._queue is not None:
+            self._queue.join()
+
+    def shutdown(self, timeout=EMAIL_QUEUE_DRAIN_TIMEOUT):
+        """Stop accepting emails, and send the ones already queued
+
+        Emails that haven't been sent after ``timeout`` seconds are left in the spool.
+        """
+        if self._pid != os.getpid() or self._stopping:
+            return
+        self._stopping = True
+        if self._queue is None:
+            return
+
+        deadline = monotonic() + timeout
+        try:
+            for worker in self._workers:
+                self._queue.put(_STOP, timeout=max(deadline - monotonic(), 0))
+        except queue.Full:
+            pass
+        for worker in self._workers:
+            worker.join(max(deadline - monotonic(), 0))
+
+        self._draining = False
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                self._save(item)
+            self._queue.task_done()
+
+    def _put(self, message):
+        self.start()
+        if self._stopping:
+            self._save((None, message))
+            return
+
+        if self.spool is None:
+            self._queue.put((None, message))
+            return
+
+        try:
+            self._queue.put_nowait((None, message))
+        except queue.Full:
+            self.spool.append(message)
+
+    def _work(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=EMAIL_SPOOL_RETRY_INTERVAL)
+            except queue.Empty:
+                if not self._stopping:
+                    self.requeue_spooled()
+                continue
+
+            try:
+                if item is _STOP:
+                    return
+                if self._draining:
+                    self._send(item)
+                else:
+                    self._save(item)
+            finally:
+                self._queue.task_done()
+
+    def _send(self, item):
+        spool_id, message = item
+        with self.app.app_context():
+            try:
+                self.sender(**message)
+            except EmailThrottlingError:
+                self._save(item)
+                return
+            except EmailError:
+                # already logged by send_email, and sending again won't help
+                pass
+            except Exception:
+                logger.exception("Failed to send queued email")
+                self._save(item)
+                return
+
+        if spool_id is not None:
+            self.spool.delete(spool_id)
+
+    def _save(self, item):
+        """Keep an email that hasn't been sent in the spool, to be sent later"""
+        spool_id, message = item
+        if self.spool is None:
+            logger.error("Dropped queued email with subject {subject}, no spool configured",
+                         extra={'subject': message['subject']})
+        elif spool_id is None:
+            self.spool.append(message)
+        else:
+            self.spool.release(spool_id, self._owner)
+
+
+class EmailSpool(object):
+    """Emails waiting to be sent, stored in a sqlite database so they survive restarts
+
+    Emails are leased by a queue while it sends them, and deleted once they've been sent.
+    """
+    def __init__(self, path):
+        self.path = path
+        with self._transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS emails ('
+                       'id INTEGER PRIMARY KEY, message TEXT NOT NULL, lease_owner TEXT, lease_expires REAL)')
+
+    def append(self, message):
+        with self._transaction() as db:
+            db.execute('INSERT INTO emails (message) VALUES (?)', (json.dumps(message),))
+
+    def lease(self, owner, limit, duration=EMAIL_SPOOL_LEASE):
+        """Take up to ``limit`` emails that aren't leased, or whose lease has expired, oldest first
+
+        :return: list of ``(id, message)`` tuples
+        """
+        if limit <= 0:
+            return []
+
+        now = time.time()
+        with self._transaction() as db:
+            rows = db.execute(
+                'SELECT id, message FROM emails WHERE lease_expires IS NULL OR lease_expires < ? ORDER BY id LIMIT ?',
+                (now, limit)
+            ).fetchall()
+            db.executemany(
+                'UPDATE emails SET lease_owner = ?, lease_expires = ? WHERE id = ?',
+                [(owner, now + duration, spool_id) for spool_id, _ in rows]
+            )
+        return [(spool_id, json.loads(message)) for spool_id, message in rows]
+
+    def release(self, spool_id, owner):
+        """Give up the lease on an email that hasn't been sent, so it can be sent later"""
+        with self._transaction() as db:
+            db.execute('UPDATE emails SET lease_owner = NULL, lease_expires = NULL WHERE id = ? AND lease_owner = ?',
+                       (spool_id, owner))
+
+    def delete(self, spool_id):
+        """Remove an email that has been sent"""
+        with self._transaction() as db:
+            db.execute('DELETE FROM emails WHERE id = ?', (spool_id,))
+
+    def __len__(self):
+        with closing(self._connect()) as db:
+            return db.execute('SELECT COUNT(*) FROM emails').fetchone()[0]
+
+    @contextmanager
+    def _transaction(self):
+        # sqlite connections can't be shared between threads, so each operation opens its own.
+        # BEGIN IMMEDIATE takes the write lock straight away, so two processes can't lease the same rows.
+        with closing(self._connect()) as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, isolation_level=None)
@@ -1,9 +1,15 @@
 import os
-import boto3
+import tempfile
 from werkzeug.utils import secure_filename
 from flask import current_app
 from io import BytesIO
 
+from . import aws
+from .documents import generate_upload_policy
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+SPOOL_MAX_MEMORY = 5 * 1024 * 1024
+
 
 def allowed_file(filename):
     return filename.lower().rsplit('.', 1)[1] in current_app.config.get('ALLOWED_EXTENSIONS')
@@ -26,27 +32,103 @@ def s3_upload_fileObj(fileObj, path=''):
         raise Exception('Invalid file extension: {}'.format(fileObj.filename))
 
     filename = secure_filename(fileObj.filename)
-    s3 = boto3.resource(
-        's3',
-        endpoint_url=os.getenv('AWS_S3_URL')
-    )
-    bucket = s3.Bucket(current_app.config.get('S3_BUCKET_NAME'))
+    bucket = aws.registry.s3_resource().Bucket(current_app.config.get('S3_BUCKET_NAME'))
 
     bucket.upload_fileobj(fileObj, os.path.join(path, filename))
 
     return filename
 
 
-def s3_download_file(file, path):
+def s3_generate_upload_policy(filename, path=''):
+    """Create a presigned POST policy for uploading a file straight to the app's S3 bucket
+
+    The browser posts the file to S3 instead of ``s3_upload_file_from_request``.
+
+    :return: dictionary with the saved ``filename``, and the form ``url`` and ``fields``
+    """
+    if not allowed_file(filename):
+        raise Exception('Invalid file extension: {}'.format(filename))
+
+    filename = secure_filename(filename)
+    policy = generate_upload_policy(current_app.config.get('S3_BUCKET_NAME'), os.path.join(path, filename))
+    policy['filename'] = filename
+
+    return policy
+
+
+def s3_download_file(file, path, byte_range=None):
+    """Download a file into memory
+
+    Use ``s3_stream_file`` or ``s3_download_file_to_tempfile`` for large files.
+
+    :param byte_range: ``(start, end)`` tuple to only download part of the file, see ``s3_stream_file``
+    :return: the file contents as bytes
+    """
+    if byte_range is not None:
+        return b''.join(s3_stream_file(file, path, byte_range=byte_range))
+
     filename = secure_filename(file)
 
-    s3 = boto3.resource(
-        's3',
-        endpoint_url=os.getenv('AWS_S3_URL')
-    )
-    bucket = s3.Bucket(current_app.config.get('S3_BUCKET_NAME'))
+    bucket = aws.registry.s3_resource().Bucket(current_app.config.get('S3_BUCKET_NAME'))
 
     data = BytesIO()
     bucket.download_fileobj(os.path.join(path, filename), data)
 
     return data.getvalue()
+
+
+def s3_stream_file(file, path, chunk_size=DOWNLOAD_CHUNK_SIZE, byte_range=None):
+    """Download a file as an iterator of chunks, without holding it all in memory
+
+    The request to S3 is made straight away, so missing files raise an error here rather
+    than while iterating. The result can be returned as a streaming response::
+
+        return Response(stream_with_context(s3_stream_file('export.csv', 'exports')), mimetype='text/csv')
+
+    :param chunk_size: size in bytes of each chunk
+    :param byte_range: ``(start, end)`` tuple of the first and last bytes to download, inclusive.
+                       If ``end`` is ``None`` the rest of the file is downloaded.
+    :return: iterator of bytes
+    """
+    filename = secure_filename(file)
+
+    bucket = aws.registry.s3_resource().Bucket(current_app.config.get('S3_BUCKET_NAME'))
+
+    params = {}
+    if byte_range is not None:
+        start, end = byte_range
+        params['Range'] = 'bytes={}-{}'.format(start, '' if end is None else end)
+
+    body = bucket.Object(os.path.join(path, filename)).get(**params)['Body']
+
+    return _iter_chunks(body, chunk_size)
+
+
+def _iter_chunks(body, chunk_size):
+    try:
+        while True:
+            chunk = body.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        body.close()
+
+
+def s3_download_file_to_tempfile(file, path, max_memory=SPOOL_MAX_MEMORY, byte_range=None):
+    """Download a file into a temporary file, which is kept in memory until it's bigger than ``max_memory`` bytes
+
+    :param byte_range: ``(start, end)`` tuple to only download part of the file, see ``s3_stream_file``
+    :return: ``tempfile.SpooledTemporaryFile`` positioned at the start of the file. Close it when you're
+             done to remove any file written to disk.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    try:
+        for chunk in s3_stream_file(file, path, byte_range=byte_range):
+            spool.write(chunk)
+    except Exception:
+        spool.close()
+        raise
+
+    spool.seek(0)
+    return spool
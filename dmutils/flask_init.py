@@ -9,7 +9,7 @@ except ImportError:
     from urllib.parse import quote  # Python 3+
 
 import flask_featureflags
-from . import config, logging, force_https, request_id, formats, filters, rollbar_agent
+from . import aws, config, logging, force_https, request_id, formats, filters, rollbar_agent
 from flask import Markup, redirect, request, session, current_app, abort
 from flask_script import Manager, Server
 from flask_login import current_user
@@ -46,6 +46,7 @@ def init_app(
     request_id.init_app(application)
     force_https.init_app(application)
     rollbar_agent.init_app(application)
+    aws.init_app(application)
 
     flask_featureflags.FeatureFlag(application)
 
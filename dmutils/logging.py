@@ -7,10 +7,10 @@ from itertools import product
 import requests
 import rollbar
 
-from flask import request, current_app, render_template_string
+from flask import request, current_app
 from flask.ctx import has_request_context
 
-from dmutils.email import send_email, EmailError
+from dmutils.email import send_email, render_email, EmailError
 
 from pythonjsonlogger.jsonlogger import JsonFormatter as BaseJSONFormatter
 
@@ -18,6 +18,9 @@ LOG_FORMAT = '%(asctime)s %(app_name)s %(name)s %(levelname)s ' \
              '%(request_id)s "%(message)s" [in %(pathname)s:%(lineno)d]'
 TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
+NOTIFY_TEAM_EMAIL_TEMPLATE = \
+    '<p>{{ body }}</p>{% if more_info_url %}<a href="{{ more_info_url }}">More info</a>{% endif %}'
+
 logger = logging.getLogger(__name__)
 
 
@@ -187,12 +190,12 @@ def notify_team(subject, body, more_info_url=None):
             current_app.logger.error(msg)
 
     if current_app.config.get('DM_TEAM_EMAIL', None):
-        email_body = render_template_string(
-            '<p>{{ body }}</p>{% if more_info_url %}<a href="{{ more_info_url }}">More info</a>{% endif %}',
-            body=body, more_info_url=more_info_url
-        )
+        email_body = render_email(NOTIFY_TEAM_EMAIL_TEMPLATE, body=body, more_info_url=more_info_url)
+        # send through the app's background queue if it has one, see dmutils.email_queue
+        email_queue = current_app.extensions.get('email_queue')
+        send = email_queue.send_email if email_queue is not None else send_email
         try:
-            send_email(
+            send(
                 current_app.config['DM_TEAM_EMAIL'],
                 email_body,
                 subject,
@@ -1,4 +1,5 @@
 import copy
+from collections import namedtuple
 from datetime import datetime
 
 from boto.ec2.cloudwatch import connect_to_region
@@ -6,6 +7,10 @@ from flask import current_app, _app_ctx_stack as stack
 from contextlib2 import ContextDecorator
 from monotonic import monotonic
 
+MAX_METRICS_PER_REQUEST = 20  # the most datapoints CloudWatch accepts in one PutMetricData request
+
+Metric = namedtuple('Metric', ['name', 'value', 'unit', 'dimensions'])
+
 
 def flask_client():
     return CloudWatchFlaskClient()
@@ -65,21 +70,54 @@ class CloudWatchClient(object):
             dimensions=self.dimensions(dimensions),
             statistics=statistics)
 
-    def timer(self, name):
-        return Timer(self, name)
+    def put_metrics(self, metrics, timestamp=None):
+        """Record several values at once, sending up to ``MAX_METRICS_PER_REQUEST`` in each request
+
+        :param metrics: iterable of ``Metric(name, value, unit, dimensions)``
+        """
+        metrics = list(metrics)
+        if timestamp is None:
+            timestamp = datetime.utcnow()
+        for start in range(0, len(metrics), MAX_METRICS_PER_REQUEST):
+            batch = metrics[start:start + MAX_METRICS_PER_REQUEST]
+            self._conn.put_metric_data(
+                namespace=self.namespace,
+                name=[metric.name for metric in batch],
+                value=[metric.value for metric in batch],
+                timestamp=timestamp,
+                unit=[metric.unit for metric in batch],
+                dimensions=[self.dimensions(metric.dimensions) for metric in batch],
+                statistics=None)
+
+    def timer(self, name, dimensions=None):
+        return Timer(self, name, dimensions)
+
+    def timing(self, name, seconds, dimensions=None):
+        """Record a duration measured elsewhere, the same way a ``timer`` does"""
+        self._put_metric(
+            name,
+            int(seconds * 1000),
+            unit="Milliseconds",
+            dimensions=dimensions)
+
+    def size(self, name, num_bytes, dimensions=None):
+        """Record a number of bytes, such as the size of an upload"""
+        self._put_metric(
+            name,
+            num_bytes,
+            unit="Bytes",
+            dimensions=dimensions)
 
 
 class Timer(ContextDecorator):
-    def __init__(self, client, name):
+    def __init__(self, client, name, dimensions=None):
         self.client = client
         self.name = name
+        self.dimensions = dimensions
 
     def __enter__(self):
         self.start = monotonic()
 
     def __exit__(self, *exc):
-        elapsed = monotonic() - self.start
-        self.client._put_metric(
-            self.name,
-            int(elapsed * 1000),
-            unit="Milliseconds")
+        self.elapsed = monotonic() - self.start
+        self.client.timing(self.name, self.elapsed, self.dimensions)
@@ -4,9 +4,19 @@ import re
 import boto
 import boto.exception
 import datetime
+import heapq
+import itertools
 import mimetypes
 import logging
+import threading
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from io import BytesIO
+
+import pytz
+import six
 from dateutil.parser import parse as parse_time
+from monotonic import monotonic
 
 from boto.exception import S3ResponseError  # noqa
 
@@ -15,17 +25,210 @@ from .formats import DATETIME_FORMAT
 logger = logging.getLogger(__name__)
 
 FILE_SIZE_LIMIT = 5400000  # approximately 5Mb
+TIMESTAMP_LOAD_WORKERS = 10
+TIMESTAMP_LOAD_BATCH_SIZE = 1000  # the size of an S3 listing page
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024  # S3 requires parts of at least 5MB
+MULTIPART_WORKERS = 4
+BATCH_WORKERS = 10
+MULTI_DELETE_BATCH_SIZE = 1000  # the most keys S3 accepts in one multi-object delete request
 BUCKET_SHORT_NAME_PATTERN = re.compile(
     r'^digitalmarketplace-([^\-]+)-([^\-]+)-(\2)$'
 )
+# ISO 8601 timestamps used in listings and by DATETIME_FORMAT, eg 2015-08-17T14:00:00.000Z
+ISO_TIMESTAMP_PATTERN = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?Z$'
+)
+# RFC 1123 timestamps returned in Last-Modified headers, eg Mon, 17 Aug 2015 14:00:00 GMT
+RFC1123_TIMESTAMP_PATTERN = re.compile(
+    r'^\w{3}, (\d{2}) (\w{3}) (\d{4}) (\d{2}):(\d{2}):(\d{2}) GMT$'
+)
+MONTHS = dict((month, number) for number, month in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1
+))
 
 
-class S3(object):
-    def __init__(self, bucket_name=None, host='s3-eu-west-1.amazonaws.com'):
-        conn = boto.connect_s3(host=host)
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+SaveResult = namedtuple('SaveResult', ['path', 'key', 'error'])
+
+_MISSING = object()
+
+
+class KeyCache(object):
+    """Thread-safe LRU cache of S3 key metadata, with entries expiring after ``ttl`` seconds.
+
+    Entries are stored per ``(bucket_name, path)`` so a single cache can be shared between
+    ``S3`` instances. Keys that don't exist are cached too, as ``None``.
+    """
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, bucket_name, path, metadata=False, default=_MISSING):
+        """Return the cached key for ``path``, or ``default`` if it isn't cached.
+
+        :param metadata: only count listed keys as a hit if they were loaded with a HEAD
+                         request and so include user metadata such as custom timestamps
+        """
+        cache_key = (bucket_name, path)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None:
+                key, has_metadata, expires_at = entry
+                if expires_at <= monotonic():
+                    del self._entries[cache_key]
+                elif has_metadata or not metadata:
+                    self._entries[cache_key] = self._entries.pop(cache_key)
+                    self.hits += 1
+                    return key
+            self.misses += 1
+            return default
+
+    def set(self, bucket_name, path, key, metadata=True):
+        cache_key = (bucket_name, path)
+        with self._lock:
+            self._entries.pop(cache_key, None)
+            self._entries[cache_key] = (key, metadata or key is None, monotonic() + self.ttl)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, bucket_name, path):
+        with self._lock:
+            self._entries.pop((bucket_name, path), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+
+class KeyRecord(object):
+    """A compact, read-only alternative to the dicts returned by ``S3.list``.
+
+    Items can be looked up like dict keys, and ``last_modified`` is only formatted when
+    it's used. ``timestamp`` is the parsed datetime, which is cheaper to sort by.
+    """
+    __slots__ = ('path', 'filename', 'ext', 'timestamp', 'size')
+
+    def __init__(self, path, filename, ext, timestamp, size):
+        self.path = path
+        self.filename = filename
+        self.ext = ext
+        self.timestamp = timestamp
+        self.size = size
+
+    @classmethod
+    def from_key(cls, key, timestamp=None):
+        """
+        :param key:       http://boto.readthedocs.org/en/latest/ref/s3.html#boto.s3.key.Key
+        :param timestamp: custom timestamp to use instead of the key's last modified time
+        """
+        filename, ext = os.path.splitext(os.path.basename(key.name))
+        return cls(key.name, filename, ext[1:], parse_timestamp(timestamp or key.last_modified), key.size)
+
+    @property
+    def last_modified(self):
+        return self.timestamp.strftime(DATETIME_FORMAT)
+
+    def __getitem__(self, name):
+        if name not in self.__slots__ and name != 'last_modified':
+            raise KeyError(name)
+        return getattr(self, name)
 
+    def __eq__(self, other):
+        return isinstance(other, KeyRecord) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'KeyRecord({!r})'.format(self.to_dict())
+
+    def to_dict(self):
+        return {
+            'path': self.path,
+            'filename': self.filename,
+            'ext': self.ext,
+            'last_modified': self.last_modified,
+            'size': self.size
+        }
+
+
+# guards the fork check, so that only one thread in a new process replaces the registry's state
+_bucket_registry_reset_lock = threading.Lock()
+
+
+class BucketRegistry(object):
+    """Process-wide registry of boto connections and buckets, keyed by host and bucket name.
+
+    The registry is emptied when it is first used after a fork, so worker processes
+    never share sockets with their parent. A bucket first fetched with ``validate=False``
+    is validated when it's next asked for with ``validate=True``.
+    """
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._buckets = {}
+
+    def get_bucket(self, host, bucket_name, validate=True):
+        self._check_pid()
+
+        with self._lock:
+            bucket, validated = self._buckets.get((host, bucket_name), (None, False))
+            if bucket is None or (validate and not validated):
+                conn = self._connections.get(host)
+                if conn is None:
+                    conn = self._connections[host] = boto.connect_s3(host=host)
+                bucket = conn.get_bucket(bucket_name, validate=validate)
+                self._buckets[(host, bucket_name)] = (bucket, validate)
+
+            return bucket
+
+    def clear(self):
+        with self._lock:
+            self._connections.clear()
+            self._buckets.clear()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            with _bucket_registry_reset_lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+
+bucket_registry = BucketRegistry()
+
+
+class S3(object):
+    def __init__(self, bucket_name=None, host='s3-eu-west-1.amazonaws.com', key_cache=None,
+                 validate=True, shared_connection=False):
+        """
+        :param key_cache:         optional ``KeyCache`` used to avoid repeated metadata requests
+                                  for the same keys. It can be shared between instances.
+        :param validate:          check that the bucket exists when connecting. If False
+                                  a missing bucket is only reported by the first request.
+        :param shared_connection: reuse this process's connection to the bucket from the
+                                  ``bucket_registry`` instead of opening a new one
+        """
         self.bucket_name = bucket_name
-        self.bucket = conn.get_bucket(bucket_name)
+        if shared_connection:
+            self.bucket = bucket_registry.get_bucket(host, bucket_name, validate=validate)
+        else:
+            conn = boto.connect_s3(host=host)
+            self.bucket = conn.get_bucket(bucket_name, validate=validate)
+        self.key_cache = key_cache
 
     @property
     def bucket_short_name(self):
@@ -36,7 +239,8 @@ class S3(object):
 
         return match.group(1)
 
-    def save(self, path, file, acl='public-read', move_prefix=None, timestamp=None, download_filename=None):
+    def save(self, path, file, acl='public-read', move_prefix=None, timestamp=None, download_filename=None,
+             multipart_threshold=MULTIPART_THRESHOLD, archive_existing=True):
         """Save a file in an S3 bucket
 
         canned ACL list: https://docs.aws.amazon.com/AmazonS3/latest/dev/acl-overview.html#canned-acl
@@ -46,25 +250,43 @@ class S3(object):
         :param acl:         S3 canned ACL
         :param move_prefix: Prefix to give to existing file when moving it out of the way
         :param timestamp:   Timestamp to set for this file rather than using utcnow
+        :param archive_existing: copy any existing file at ``path`` out of the way before overwriting it
+        :param multipart_threshold: files larger than this many bytes are uploaded in parallel
+                                    parts of ``MULTIPART_CHUNKSIZE``. Only used for files that
+                                    support seek/tell, as their size is known without reading them.
 
         :return: S3 Key
         """
         path = path.lstrip('/')
 
-        self._move_existing(path, move_prefix)
+        if archive_existing:
+            self._move_existing(path, move_prefix)
 
         key = self.bucket.new_key(path)
-        filesize = get_file_size_up_to_maximum(file)
+        # the whole file is uploaded, wherever the caller left its position
+        try:
+            file.seek(0)
+        except (AttributeError, IOError, ValueError):
+            pass
+        filesize = get_file_size(file)
+        multipart = filesize is not None and filesize > multipart_threshold
+        if filesize is None:
+            filesize = get_file_size_up_to_maximum(file)
         timestamp = timestamp or datetime.datetime.utcnow()
         key.set_metadata('timestamp', timestamp.strftime(DATETIME_FORMAT))
         headers = {'Content-Type': self._get_mimetype(key.name)}
         if download_filename:
             headers['Content-Disposition'] = 'attachment; filename="{}"'.format(download_filename).encode('utf-8')
-        key.set_contents_from_file(
-            file,
-            headers=headers
-        )
-        key.set_acl(acl)
+        # the ACL and metadata are sent as headers of the upload request itself
+        if multipart:
+            self._save_multipart(key, file, headers, acl)
+        else:
+            key.set_contents_from_file(
+                file,
+                headers=headers,
+                policy=acl
+            )
+        self._invalidate(path)
         logger.info(
             "Uploaded file {filepath} of size {filesize} with acl {fileacl}",
             extra={
@@ -75,8 +297,62 @@ class S3(object):
 
         return key
 
+    def _save_multipart(self, key, file, headers, acl):
+        """Upload a file in ``MULTIPART_CHUNKSIZE`` parts, ``MULTIPART_WORKERS`` at a time.
+
+        At most twice as many parts as there are workers are read into memory at once.
+        """
+        upload = self.bucket.initiate_multipart_upload(key.name, headers=headers, metadata=key.metadata, policy=acl)
+        executor = ThreadPoolExecutor(max_workers=MULTIPART_WORKERS)
+        try:
+            pending = set()
+            part_num = 0
+            while True:
+                chunk = file.read(MULTIPART_CHUNKSIZE)
+                if not chunk:
+                    break
+                part_num += 1
+                pending.add(executor.submit(upload.upload_part_from_file, BytesIO(chunk), part_num))
+                if len(pending) >= 2 * MULTIPART_WORKERS:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+            for future in pending:
+                future.result()
+            upload.complete_upload()
+        except Exception:
+            for future in pending:
+                future.cancel()
+            upload.cancel_upload()
+            raise
+        finally:
+            executor.shutdown(wait=False)
+
+    def save_many(self, files, max_workers=BATCH_WORKERS, **kwargs):
+        """Save several files in an S3 bucket concurrently
+
+        :param files:       iterable of ``(path, file)`` pairs
+        :param max_workers: number of files to upload at the same time
+        :param kwargs:      passed on to ``save`` for every file
+
+        :return: list of ``SaveResult(path, key, error)`` in the same order as ``files``, where
+                 ``error`` is the exception raised when saving the file, or ``None``
+        """
+        def save(path, file):
+            try:
+                return SaveResult(path, self.save(path, file, **kwargs), None)
+            except Exception as e:
+                logger.error(
+                    "Failed to upload file {filepath}: {error}",
+                    extra={"filepath": path, "error": e})
+                return SaveResult(path, None, e)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(save, path, file) for path, file in files]
+            return [future.result() for future in futures]
+
     def path_exists(self, path):
-        return bool(self.bucket.get_key(path))
+        return bool(self._lookup_key(path))
 
     def get_signed_url(self, path, expires_in=30):
         """Create a signed S3 document URL
@@ -89,20 +365,53 @@ class S3(object):
 
         """
 
-        key = self.bucket.get_key(path)
+        key = self._lookup_key(path)
         if key:
             return key.generate_url(expires_in)
 
     def get_key(self, path):
-        key = self.bucket.get_key(path)
+        key = self._lookup_key(path, metadata=True)
         if key:
             return self._format_key(key, False, key.get_metadata('timestamp'))
 
     def delete_key(self, path):
         self._move_existing(path, None)
         self.bucket.delete_key(path)
+        self._invalidate(path)
 
-    def list(self, prefix='', delimiter='', load_timestamps=False):
+    def delete_keys(self, paths, archive=True, move_prefix=None, max_workers=BATCH_WORKERS):
+        """Delete several keys using multi-object delete requests of up to 1000 keys each
+
+        :param paths:       paths of the keys to delete
+        :param archive:     copy each key out of the way first, like ``delete_key`` does.
+                            The copies are made concurrently.
+        :param move_prefix: prefix given to the archived copies, by default the current time
+        :param max_workers: number of archive copies to make at the same time
+
+        :return: list of paths that could not be deleted
+        """
+        paths = list(paths)
+        if archive:
+            move_prefix = move_prefix or default_move_prefix()
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for future in [executor.submit(self._move_existing, path, move_prefix) for path in paths]:
+                    future.result()
+
+        failed = []
+        for batch in _batches(paths, MULTI_DELETE_BATCH_SIZE):
+            result = self.bucket.delete_keys(batch)
+            for error in result.errors:
+                logger.error(
+                    "Failed to delete file {filepath}: {code} {error}",
+                    extra={"filepath": error.key, "code": error.code, "error": error.message})
+                failed.append(error.key)
+            for path in batch:
+                self._invalidate(path)
+
+        return failed
+
+    def list(self, prefix='', delimiter='', load_timestamps=False, limit=None,
+             max_workers=TIMESTAMP_LOAD_WORKERS, timeout=None, records=False):
         """
         return a list of file keys (ordered by last_modified date) from an s3 bucket
 
@@ -111,15 +420,98 @@ class S3(object):
         :param delimiter:      filter out files whose names contain the delimiter
         :param load_timestamp: by default custom timestamps are not loaded as they require an extra API call.
                                If you need to show the timestamp set this to True.
+        :param limit:          only return the ``limit`` most recently modified files. The full listing is
+                               never sorted, only a bounded heap of ``limit`` keys is kept.
+        :param max_workers:    number of concurrent requests used to load custom timestamps
+        :param timeout:        seconds to wait for each timestamp request before giving up
+        :param records:        return ``KeyRecord`` objects rather than dicts
         :return: list
         """
+        keys = self._iter_records(prefix, delimiter, load_timestamps, max_workers, timeout)
+        if limit is not None:
+            keys = sorted(heapq.nlargest(limit, keys, key=_timestamp), key=_timestamp)
+        else:
+            keys = sorted(keys, key=_timestamp)
+
+        if records:
+            return keys
+        return [key.to_dict() for key in keys]
+
+    def iter_keys(self, prefix='', delimiter='', load_timestamps=False,
+                  max_workers=TIMESTAMP_LOAD_WORKERS, timeout=None, records=False):
+        """
+        iterate over file keys from an s3 bucket in the order they are returned by S3
+
+        Keys are formatted as they arrive, one result page at a time, so the listing is never
+        held in memory as a whole. Use ``list`` if you need the keys ordered by date.
+
+        :param prefix:         filter by files whose names begin with the prefix
+        :param delimiter:      filter out files whose names contain the delimiter
+        :param load_timestamp: load custom timestamps (one extra API call per key, made
+                               concurrently for each page of results)
+        :param max_workers:    number of concurrent requests used to load custom timestamps
+        :param timeout:        seconds to wait for each timestamp request before giving up
+        :param records:        yield ``KeyRecord`` objects rather than dicts
+        :return: generator of dicts
+        """
+        keys = self._iter_records(prefix, delimiter, load_timestamps, max_workers, timeout)
+        if records:
+            return keys
+        return (key.to_dict() for key in keys)
+
+    def _iter_records(self, prefix, delimiter, load_timestamps, max_workers, timeout):
         # http://boto.readthedocs.org/en/latest/ref/s3.html#boto.s3.bucket.Bucket.list
-        list_of_keys = self.bucket.list(prefix, delimiter)
-        return sorted([
-            self._format_key(key, load_timestamps)
-            for key in list_of_keys
+        keys = (
+            key for key in self.bucket.list(prefix, delimiter)
             if not (key.size == 0 and key.name[-1] == '/')
-        ], key=lambda key: key['last_modified'])
+        )
+
+        if not load_timestamps:
+            for key in keys:
+                self._cache_key(key.name, key, metadata=False)
+                yield KeyRecord.from_key(key)
+            return
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            for batch in _batches(keys, TIMESTAMP_LOAD_BATCH_SIZE):
+                for key in self._load_keys(executor, batch, timeout):
+                    yield KeyRecord.from_key(key, key.get_metadata('timestamp'))
+        finally:
+            executor.shutdown(wait=False)
+
+    def _load_keys(self, executor, keys, timeout=None):
+        """Fetch full key metadata (one HEAD request per key) concurrently.
+
+        Keys that have been deleted since they were listed are returned as they were listed.
+
+        :raises concurrent.futures.TimeoutError: if a request takes longer than ``timeout`` seconds
+        """
+        futures = [executor.submit(self._lookup_key, key.name, True) for key in keys]
+        try:
+            return [future.result(timeout=timeout) or key for key, future in zip(keys, futures)]
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def _lookup_key(self, path, metadata=False):
+        if self.key_cache is None:
+            return self.bucket.get_key(path)
+
+        key = self.key_cache.get(self.bucket_name, path, metadata)
+        if key is _MISSING:
+            key = self.bucket.get_key(path)
+            self.key_cache.set(self.bucket_name, path, key)
+
+        return key
+
+    def _cache_key(self, path, key, metadata=True):
+        if self.key_cache is not None:
+            self.key_cache.set(self.bucket_name, path, key, metadata)
+
+    def _invalidate(self, path):
+        if self.key_cache is not None:
+            self.key_cache.invalidate(self.bucket_name, path)
 
     def _format_key(self, key, load_timestamps, timestamp=None):
         """
@@ -130,39 +522,95 @@ class S3(object):
                                If you need to show the timestamp set this to True.
         :return:    dict
         """
-        filename, ext = os.path.splitext(os.path.basename(key.name))
         if load_timestamps:
             key = self.bucket.get_key(key.name)
             timestamp = key.get_metadata('timestamp')
 
-        timestamp = timestamp or key.last_modified
-        timestamp = parse_time(timestamp)
-
-        return {
-            'path': key.name,
-            'filename': filename,
-            'ext': ext[1:],
-            'last_modified': timestamp.strftime(DATETIME_FORMAT),
-            'size': key.size
-        }
+        return KeyRecord.from_key(key, timestamp).to_dict()
 
     def _move_existing(self, existing_path, move_prefix=None):
         if move_prefix is None:
             move_prefix = default_move_prefix()
 
-        if self.bucket.get_key(existing_path):
-            path, name = os.path.split(existing_path)
+        # copying a missing key fails, so there's no need to check that it exists first. The key
+        # cache isn't consulted, as another process may have created the key since it was cached.
+        path, name = os.path.split(existing_path)
+        archive_path = os.path.join(path, '{}-{}'.format(move_prefix, name))
+        try:
             self.bucket.copy_key(
-                os.path.join(path, '{}-{}'.format(move_prefix, name)),
+                archive_path,
                 self.bucket_name,
                 existing_path
             )
+        except S3ResponseError as e:
+            if e.status != 404:
+                raise
+            self._cache_key(existing_path, None)
+        else:
+            self._invalidate(archive_path)
 
     def _get_mimetype(self, filename):
         mimetype, _ = mimetypes.guess_type(filename)
         return mimetype
 
 
+def _timestamp(key):
+    return key.timestamp
+
+
+def parse_timestamp(value):
+    """Parse a timestamp from S3 into a naive UTC datetime
+
+    The formats that S3 and ``DATETIME_FORMAT`` use are matched directly, anything else
+    falls back to dateutil. Timestamps with another UTC offset are converted to UTC.
+    """
+    match = ISO_TIMESTAMP_PATTERN.match(value)
+    if match:
+        year, month, day, hour, minute, second, fraction = match.groups()
+        return datetime.datetime(
+            int(year), int(month), int(day), int(hour), int(minute), int(second),
+            int((fraction or '').ljust(6, '0'))
+        )
+
+    match = RFC1123_TIMESTAMP_PATTERN.match(value)
+    if match and match.group(2) in MONTHS:
+        day, month, year, hour, minute, second = match.groups()
+        return datetime.datetime(int(year), MONTHS[month], int(day), int(hour), int(minute), int(second))
+
+    timestamp = parse_time(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(pytz.utc)
+    return timestamp.replace(tzinfo=None)
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def get_file_size(file_contents):
+    """Return the number of bytes left to read in a file, using seek/tell rather than reading it.
+
+    :return: the size, or ``None`` if the file doesn't support seek/tell
+    """
+    try:
+        position = file_contents.tell()
+        file_contents.seek(0, os.SEEK_END)
+        end = file_contents.tell()
+        file_contents.seek(position)
+    except (AttributeError, IOError, ValueError):
+        return None
+
+    if not isinstance(position, six.integer_types) or not isinstance(end, six.integer_types):
+        return None
+
+    return end - position
+
+
 def get_file_size_up_to_maximum(file_contents):
     size = len(file_contents.read(FILE_SIZE_LIMIT))
     file_contents.seek(0)
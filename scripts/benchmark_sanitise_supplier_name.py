@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Compare sanitise_supplier_name with the previous implementation
+
+Checks that both give the same results for a corpus of supplier names, then times them.
+
+Usage:
+    python scripts/benchmark_sanitise_supplier_name.py [<number-of-names>]
+"""
+from __future__ import print_function
+
+import itertools
+import sys
+import timeit
+
+from dmutils.documents import BAD_SUPPLIER_NAME_CHARACTERS, sanitise_supplier_name, sanitise_supplier_names
+
+NAMES = [
+    u'Kev\'s Butties', u'   Supplier A   ', u'Kev & Sons. | Ltd', u'Smith & Jones (UK) Ltd.', u'A&B Consulting',
+    u'Acme  Cloud   Services, Inc.', u'O\'Reilly & O\'Brien', u'Digital #1 Agency! {Beta}', u'Café Digital Ltd',
+    u'100% Solutions + Partners = Success', u'Data@Scale: "The" `Company`', u'Ψ is a silly character',
+]
+
+
+def legacy_sanitise_supplier_name(supplier_name):
+    sanitised_supplier_name = supplier_name.encode("ascii", errors="ignore").decode("ascii").strip()
+    sanitised_supplier_name = sanitised_supplier_name.replace(' ', '_').replace('&', 'and')
+    for bad_char in BAD_SUPPLIER_NAME_CHARACTERS:
+        sanitised_supplier_name = sanitised_supplier_name.replace(bad_char, '')
+    while '__' in sanitised_supplier_name:
+        sanitised_supplier_name = sanitised_supplier_name.replace('__', '_')
+    return sanitised_supplier_name
+
+
+def main(count):
+    corpus = [u'{} {}'.format(name, i) for i, name in zip(range(count), itertools.cycle(NAMES))]
+
+    expected = [legacy_sanitise_supplier_name(name) for name in corpus]
+    if sanitise_supplier_names(corpus) != expected:
+        sys.exit("Results differ from the previous implementation")
+
+    legacy = min(timeit.repeat(lambda: [legacy_sanitise_supplier_name(name) for name in corpus], number=1, repeat=5))
+    single = min(timeit.repeat(lambda: [sanitise_supplier_name(name) for name in corpus], number=1, repeat=5))
+    batch = min(timeit.repeat(lambda: sanitise_supplier_names(corpus), number=1, repeat=5))
+
+    print("{} names, results match".format(count))
+    print("previous implementation: {:.1f}ms".format(legacy * 1000))
+    print("sanitise_supplier_name:  {:.1f}ms".format(single * 1000))
+    print("sanitise_supplier_names: {:.1f}ms".format(batch * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
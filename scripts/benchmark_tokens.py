@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Time generating and decoding invitation tokens
+
+Compares creating a new Fernet for each token, as generate_token and decode_token used to,
+with the cached Fernets and generate_tokens.
+
+Usage:
+    python scripts/benchmark_tokens.py [<number-of-tokens>]
+"""
+from __future__ import print_function
+
+import json
+import sys
+import timeit
+
+from cryptography.fernet import Fernet
+
+from dmutils.email import decode_token, generate_token, generate_tokens, to_bytes
+
+SECRET_KEY = Fernet.generate_key()
+SALT = 'InviteSalt'
+
+
+def uncached_generate_token(data, secret_key, salt):
+    fernet = Fernet(to_bytes(secret_key))
+    return fernet.encrypt(b'\0'.join([to_bytes(salt), to_bytes(json.dumps(data))]))
+
+
+def uncached_decode_token(token, secret_key, salt):
+    cleartext = Fernet(to_bytes(secret_key)).decrypt(token)
+    token_salt, json_data = cleartext.split(b'\0', 1)
+    return json.loads(json_data.decode('utf-8'))
+
+
+def best_of(function):
+    return min(timeit.repeat(function, number=1, repeat=5)) * 1000
+
+
+def main(count):
+    batch = [
+        {'email_address': 'user{}@example.com'.format(i), 'supplier_code': i, 'supplier_name': 'Supplier {}'.format(i)}
+        for i in range(count)
+    ]
+    tokens = generate_tokens(batch, SECRET_KEY, SALT)
+    if [decode_token(token, SECRET_KEY, SALT) for token in tokens] != batch:
+        sys.exit("Tokens don't decode to their data")
+
+    print("{} tokens".format(count))
+    print("generate, new Fernet each time: {:.1f}ms".format(
+        best_of(lambda: [uncached_generate_token(data, SECRET_KEY, SALT) for data in batch])))
+    print("generate_token:                 {:.1f}ms".format(
+        best_of(lambda: [generate_token(data, SECRET_KEY, SALT) for data in batch])))
+    print("generate_tokens:                {:.1f}ms".format(
+        best_of(lambda: generate_tokens(batch, SECRET_KEY, SALT))))
+    print("decode, new Fernet each time:   {:.1f}ms".format(
+        best_of(lambda: [uncached_decode_token(token, SECRET_KEY, SALT) for token in tokens])))
+    print("decode_token:                   {:.1f}ms".format(
+        best_of(lambda: [decode_token(token, SECRET_KEY, SALT) for token in tokens])))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
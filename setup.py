@@ -19,6 +19,7 @@ setup(
         'boto',
         'boto3',
         'contextlib2',
+        'futures; python_version < "3"',
         'cryptography',
         'Flask',
         'six',
@@ -38,5 +39,9 @@ setup(
         'pendulum',
         'rollbar',
         'blinker'
-    ]
+    ],
+    extras_require={
+        # generate_presigned_url is a coroutine from aiobotocore 1.0
+        'async': ['aiobotocore>=1.0.0; python_version >= "3.6"'],
+    }
 )
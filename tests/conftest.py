@@ -1,3 +1,4 @@
+import sys
 import tempfile
 
 import pytest
@@ -35,3 +36,7 @@ def os_environ(request):
     request.addfinalizer(env_patch.stop)
 
     return env_patch.start()
+
+
+if sys.version_info < (3, 5):
+    collect_ignore = ['test_async_s3.py']
@@ -0,0 +1,257 @@
+import asyncio
+import datetime
+
+import mock
+import pytest
+import pytz
+from botocore.exceptions import ClientError
+from freezegun import freeze_time
+
+from dmutils.async_s3 import AsyncS3
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def not_found(operation):
+    return ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, operation)
+
+
+class FakePaginator(object):
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        self.kwargs = kwargs
+        self._pages = iter(self.pages)
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._pages)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeS3Client(object):
+    """A stand-in for an aiobotocore S3 client, storing objects in memory."""
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+        self.requests = []
+
+    async def head_object(self, Bucket, Key):
+        self.requests.append(('HEAD', Key))
+        if Key not in self.objects:
+            raise not_found('HeadObject')
+        return self.objects[Key]
+
+    async def put_object(self, Bucket, Key, **params):
+        self.requests.append(('PUT', Key))
+        self.objects[Key] = dict(
+            params, ContentLength=len(params['Body']), LastModified=datetime.datetime(2015, 10, 10)
+        )
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+    async def copy_object(self, Bucket, Key, CopySource):
+        self.requests.append(('COPY', Key))
+        if CopySource['Key'] not in self.objects:
+            raise not_found('CopyObject')
+        self.objects[Key] = self.objects[CopySource['Key']]
+
+    async def delete_object(self, Bucket, Key):
+        self.requests.append(('DELETE', Key))
+        self.objects.pop(Key, None)
+
+    async def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return 'https://example/{}?expires={}'.format(Params['Key'], ExpiresIn)
+
+    def get_paginator(self, operation):
+        self.paginator = FakePaginator([
+            {'Contents': [
+                {'Key': key, 'Size': obj['ContentLength'], 'LastModified': obj['LastModified']}
+                for key, obj in sorted(self.objects.items())
+            ]},
+        ])
+        return self.paginator
+
+
+def fake_object(size=1, last_modified=datetime.datetime(2015, 8, 17, 14), timestamp=None):
+    return {
+        'ContentLength': size,
+        'LastModified': last_modified,
+        'Metadata': {'timestamp': timestamp} if timestamp else {},
+    }
+
+
+class FakeClientContext(object):
+    """A stand-in for the context manager returned by aiobotocore's ``create_client``."""
+    def __init__(self, client):
+        self.client = client
+        self.closed = False
+
+    async def __aenter__(self):
+        return self.client
+
+    async def __aexit__(self, *exc):
+        self.closed = True
+
+
+class TestAsyncS3(object):
+    def setup(self):
+        self.client = FakeS3Client()
+        self.s3 = AsyncS3('test-bucket', client=self.client)
+
+    @freeze_time('2015-10-10')
+    def test_save(self):
+        run(self.s3.save('/folder/test-file.pdf', b'blah', download_filename='new-test-file.pdf'))
+
+        saved = self.client.objects['folder/test-file.pdf']
+        assert saved['ACL'] == 'public-read'
+        assert saved['ContentType'] == 'application/pdf'
+        assert saved['ContentDisposition'] == 'attachment; filename="new-test-file.pdf"'
+        assert saved['Metadata'] == {'timestamp': '2015-10-10T00:00:00.000000Z'}
+
+    def test_save_moves_existing_file(self):
+        self.client.objects['folder/test-file.pdf'] = fake_object()
+
+        run(self.s3.save('folder/test-file.pdf', b'blah', move_prefix='OLD'))
+
+        assert set(self.client.objects) == set(['folder/test-file.pdf', 'folder/OLD-test-file.pdf'])
+
+    def test_path_exists(self):
+        self.client.objects['foo'] = fake_object()
+
+        assert run(self.s3.path_exists('foo')) is True
+        assert run(self.s3.path_exists('bar')) is False
+
+    def test_path_exists_raises_other_errors(self):
+        async def head_object(**kwargs):
+            raise ClientError({'Error': {'Code': '403', 'Message': 'Forbidden'}}, 'HeadObject')
+        self.client.head_object = head_object
+
+        with pytest.raises(ClientError):
+            run(self.s3.path_exists('foo'))
+
+    def test_get_signed_url(self):
+        self.client.objects['documents/file.pdf'] = fake_object()
+
+        assert run(self.s3.get_signed_url('documents/file.pdf', 10)) == 'https://example/documents/file.pdf?expires=10'
+        assert run(self.s3.get_signed_url('documents/missing.pdf')) is None
+
+    def test_get_key(self):
+        self.client.objects['dir/file1.pdf'] = fake_object(timestamp='2015-10-10T15:00:00.0000Z')
+
+        assert run(self.s3.get_key('dir/file1.pdf')) == {
+            'path': 'dir/file1.pdf',
+            'filename': 'file1',
+            'ext': 'pdf',
+            'last_modified': '2015-10-10T15:00:00.000000Z',
+            'size': 1,
+        }
+
+    @freeze_time('2015-10-10')
+    def test_delete_key(self):
+        self.client.objects['folder/test-file.pdf'] = fake_object()
+
+        run(self.s3.delete_key('folder/test-file.pdf'))
+
+        assert set(self.client.objects) == set(['folder/2015-10-10T00:00:00-test-file.pdf'])
+
+    def test_list(self):
+        self.client.objects.update({
+            'dir/': fake_object(size=0),
+            'dir/file 1.odt': fake_object(last_modified=datetime.datetime(2015, 8, 17, 14)),
+            'dir/file 2.odt': fake_object(last_modified=datetime.datetime(2014, 8, 17, 14)),
+        })
+
+        results = run(self.s3.list('dir/'))
+
+        assert [key['filename'] for key in results] == ['file 2', 'file 1']
+        assert results[1]['last_modified'] == '2015-08-17T14:00:00.000000Z'
+        assert self.client.paginator.kwargs == {'Bucket': 'test-bucket', 'Prefix': 'dir/', 'Delimiter': ''}
+
+    def test_list_with_limit(self):
+        self.client.objects.update({
+            'dir/file 1.odt': fake_object(last_modified=datetime.datetime(2015, 8, 17, 14)),
+            'dir/file 2.odt': fake_object(last_modified=datetime.datetime(2014, 8, 17, 14)),
+            'dir/file 3.odt': fake_object(last_modified=datetime.datetime(2016, 8, 17, 14)),
+        })
+
+        assert [key['filename'] for key in run(self.s3.list(limit=2))] == ['file 1', 'file 3']
+
+    def test_list_with_loading_custom_timestamps(self):
+        self.client.objects.update({
+            'dir/file 1.odt': fake_object(timestamp='2015-12-10T15:00:00.0000Z'),
+            'dir/file 2.odt': fake_object(timestamp='2015-11-10T15:00:00.0000Z'),
+        })
+
+        results = run(self.s3.list(load_timestamps=True))
+
+        assert [key['last_modified'] for key in results] == [
+            '2015-11-10T15:00:00.000000Z',
+            '2015-12-10T15:00:00.000000Z',
+        ]
+
+    def test_list_sorts_timezone_aware_and_custom_timestamps_together(self):
+        self.client.objects.update({
+            'dir/file 1.odt': fake_object(last_modified=datetime.datetime(2015, 12, 10, 16, tzinfo=pytz.utc)),
+            'dir/file 2.odt': fake_object(timestamp='2015-12-10T15:00:00.0000Z'),
+            'dir/file 3.odt': fake_object(last_modified=pytz.timezone('Australia/Sydney').localize(
+                datetime.datetime(2015, 12, 11, 1, 30))),
+        })
+
+        results = run(self.s3.list(load_timestamps=True))
+
+        assert [(key['filename'], key['last_modified']) for key in results] == [
+            ('file 3', '2015-12-10T14:30:00.000000Z'),
+            ('file 2', '2015-12-10T15:00:00.000000Z'),
+            ('file 1', '2015-12-10T16:00:00.000000Z'),
+        ]
+
+    def test_client_must_be_opened(self):
+        with pytest.raises(RuntimeError):
+            AsyncS3('test-bucket').client
+
+    def test_open_and_close(self):
+        context = FakeClientContext(self.client)
+        s3 = AsyncS3('test-bucket', endpoint_url='http://localhost:4569', region_name='ap-southeast-2',
+                     max_pool_connections=5)
+
+        async def use():
+            async with s3:
+                assert s3.client is self.client
+                assert not context.closed
+
+        with mock.patch('dmutils.async_s3.get_session') as get_session, \
+                mock.patch('dmutils.async_s3.AioConfig', create=True) as config:
+            get_session.return_value.create_client.return_value = context
+            run(use())
+
+        get_session.return_value.create_client.assert_called_once_with(
+            's3', endpoint_url='http://localhost:4569', region_name='ap-southeast-2', config=config.return_value
+        )
+        config.assert_called_once_with(max_pool_connections=5)
+        assert context.closed
+        with pytest.raises(RuntimeError):
+            s3.client
+
+    def test_open_with_a_client_does_not_create_one(self):
+        with mock.patch('dmutils.async_s3.get_session') as get_session:
+            run(self.s3.open())
+            run(self.s3.close())
+
+        assert not get_session.called
+        assert self.s3.client is self.client
+
+    def test_open_requires_aiobotocore(self):
+        with mock.patch('dmutils.async_s3.get_session', None):
+            with pytest.raises(RuntimeError):
+                run(AsyncS3('test-bucket').open())
@@ -0,0 +1,81 @@
+import threading
+
+import mock
+import pytest
+
+from dmutils.aws import Boto3Registry
+
+
+@pytest.fixture
+def session():
+    with mock.patch('dmutils.aws.boto3.session.Session') as session:
+        session.return_value.client.side_effect = lambda *args, **kwargs: mock.Mock()
+        session.return_value.resource.side_effect = lambda *args, **kwargs: mock.Mock()
+        yield session
+
+
+def test_client_is_shared(session):
+    registry = Boto3Registry()
+
+    client = registry.client('s3', endpoint_url='http://localhost')
+
+    assert registry.client('s3', endpoint_url='http://localhost') is client
+    assert registry.client('s3') is not client
+    assert session.call_count == 1
+    session.return_value.client.assert_called_with('s3', config=None)
+
+
+def test_client_is_shared_between_threads(session):
+    registry = Boto3Registry()
+    clients = []
+
+    threads = [threading.Thread(target=lambda: clients.append(registry.client('s3'))) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(map(id, clients))) == 1
+
+
+def test_resource_is_not_shared_between_threads(session):
+    registry = Boto3Registry()
+    resource = registry.resource('s3')
+    other_thread_resources = []
+
+    thread = threading.Thread(target=lambda: other_thread_resources.append(registry.resource('s3')))
+    thread.start()
+    thread.join()
+
+    assert registry.resource('s3') is resource
+    assert other_thread_resources[0] is not resource
+
+
+def test_registry_is_reset_after_fork(session):
+    registry = Boto3Registry()
+    client = registry.client('s3')
+
+    with mock.patch('dmutils.aws.os.getpid', return_value=-1):
+        assert registry.client('s3') is not client
+
+    assert session.call_count == 2
+
+
+def test_init_app_configures_s3_endpoint_and_pool_size(app, session):
+    app.config['AWS_S3_URL'] = 'http://localhost:4569'
+    app.config['DM_AWS_MAX_POOL_CONNECTIONS'] = 20
+    registry = Boto3Registry()
+    registry.init_app(app)
+
+    registry.s3_client()
+
+    session.return_value.client.assert_called_once_with(
+        's3', endpoint_url='http://localhost:4569', config=mock.ANY
+    )
+    assert session.return_value.client.call_args[1]['config'].max_pool_connections == 20
+
+
+def test_s3_endpoint_defaults_to_environment(os_environ):
+    os_environ['AWS_S3_URL'] = 'http://localhost:4569'
+
+    assert Boto3Registry().s3_endpoint_url() == 'http://localhost:4569'
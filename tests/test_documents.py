@@ -1,24 +1,36 @@
 # coding: utf-8
+import datetime
+import threading
 import unittest
+import zipfile
+from io import BytesIO
 
 import mock
 from mock import patch
 import pytest
+import pytz
 from freezegun import freeze_time
+from botocore.exceptions import ClientError
 from werkzeug.datastructures import ImmutableMultiDict
 
 from .helpers import mock_file
 from dmutils.s3 import S3ResponseError
 
+from dmutils import aws, documents, metrics
+from dmutils.metrics import Metric
 from dmutils.documents import (
     generate_file_name, get_extension,
     file_is_not_empty, file_is_empty, filter_empty_files,
     file_is_less_than_5mb,
     file_is_open_document_format,
     validate_documents,
-    upload_document, upload_service_documents,
-    get_signed_url, get_agreement_document_path, get_document_path,
-    sanitise_supplier_name, file_is_pdf, file_is_zip, file_is_image,
+    upload_document, upload_service_documents, UploadInstrumentation,
+    inspect_file, FileInfo, detect_file_type, detect_header_type, file_content_matches_extension,
+    get_signed_url, get_signed_urls,
+    generate_upload_policy, generate_document_upload_policy, verify_document_upload,
+    get_agreement_document_path, get_document_path, generate_file_names,
+    get_agreement_document_paths, get_document_paths, stream_zip,
+    sanitise_supplier_name, sanitise_supplier_names, file_is_pdf, file_is_zip, file_is_image,
     file_is_csv)
 
 
@@ -32,6 +44,38 @@ class TestGenerateFilename(unittest.TestCase):
                 suffix='123'
             ))
 
+    def test_batch_filename_format(self):
+        self.assertEquals(
+            [
+                'slug/documents/2/1-pricing-document-123.pdf',
+                'slug/documents/3/4-sfia-rate-card-123.odt',
+            ],
+            generate_file_names(
+                'slug', 'documents', [2, 3], [1, 4],
+                ['pricingDocumentURL', 'sfiaRateDocumentURL'], ['test.pdf', 'TEST.ODT'],
+                suffix='123'
+            ))
+
+    @freeze_time('2015-10-04 14:36:05')
+    def test_batch_filenames_share_the_default_suffix(self):
+        with patch('dmutils.documents.default_file_suffix', wraps=documents.default_file_suffix) as suffix:
+            paths = generate_file_names(
+                'slug', 'documents', [2, 3], [1, 4], ['pricingDocumentURL', 'attachedDocumentURL'], ['a.pdf', 'b.pdf']
+            )
+
+        assert paths == [
+            'slug/documents/2/1-pricing-document-2015-10-04-1436.pdf',
+            'slug/documents/3/4-attachment-2015-10-04-1436.pdf',
+        ]
+        assert suffix.call_count == 1
+
+    def test_batch_filenames_need_columns_of_the_same_length(self):
+        with pytest.raises(ValueError) as e:
+            generate_file_names(
+                'slug', 'documents', [2, 3], [1], ['pricingDocumentURL', 'attachedDocumentURL'], ['a.pdf', 'b.pdf']
+            )
+        assert 'service_ids 1' in str(e.value)
+
     def test_default_suffix_is_datetime(self):
         with freeze_time('2015-01-02 03:04:05'):
             self.assertEquals(
@@ -71,6 +115,31 @@ class TestValidateDocuments(unittest.TestCase):
             {'f1': [file1], 'f3': [file3]}
         )
 
+    def test_inspect_file_uses_seek_and_tell(self):
+        file_contents = BytesIO(b'*' * 10)
+        file_contents.filename = 'file1.PDF'
+
+        assert inspect_file(file_contents) == FileInfo(empty=False, size=10, extension='.pdf')
+        assert file_contents.tell() == 0
+
+    def test_inspect_file_uses_content_length(self):
+        file_contents = mock.Mock(spec=['filename', 'content_length', 'read'], filename='file1.pdf', content_length=7)
+
+        assert inspect_file(file_contents) == FileInfo(empty=False, size=7, extension='.pdf')
+        assert not file_contents.read.called
+
+    def test_inspect_file_reads_file_without_seek_and_tell(self):
+        assert inspect_file(mock_file('file1.pdf', 0)) == FileInfo(empty=True, size=0, extension='.pdf')
+
+    def test_file_is_only_read_once_when_validating(self):
+        file_contents = mock_file('file1.pdf', 10)
+
+        files = filter_empty_files({'f1': [file_contents]})
+        assert validate_documents(files) == {}
+        assert file_is_less_than_5mb(file_contents)
+
+        file_contents.read.assert_called_once_with(5400000)
+
     def test_file_is_less_than_5mb(self):
         self.assertTrue(file_is_less_than_5mb(mock_file('file1', 1)))
 
@@ -139,6 +208,77 @@ class TestValidateDocuments(unittest.TestCase):
         )
 
 
+def named_file(filename, content):
+    file_object = BytesIO(content)
+    file_object.filename = filename
+    return file_object
+
+
+ODT_HEADER = b'PK\x03\x04' + b'\x00' * 26 + b'mimetypeapplication/vnd.oasis.opendocument.text'
+
+
+@pytest.mark.parametrize('header,expected', [
+    (b'%PDF-1.4\n%\xe2\xe3\xcf\xd3', 'pdf'),
+    (b'\r\n%PDF-1.4', 'pdf'),
+    (ODT_HEADER, 'odf'),
+    (b'PK\x03\x04\x14\x00\x00\x00\x08\x00', 'zip'),
+    (b'PK\x05\x06' + b'\x00' * 18, 'zip'),
+    (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR', 'png'),
+    (b'\xff\xd8\xff\xe0\x00\x10JFIF', 'jpeg'),
+    (b'name,price\r\nKev\xe2\x80\x99s Butties,1.50\r\n', 'text'),
+    (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', None),  # MS Office 97
+    (b'', None),
+])
+def test_detect_header_type(header, expected):
+    assert detect_header_type(header) == expected
+
+
+class TestDetectFileType(unittest.TestCase):
+    def test_only_reads_the_header_and_rewinds(self):
+        file_object = named_file('file.pdf', b'%PDF-1.4' + b'*' * 10000)
+        file_object.read = mock.Mock(wraps=file_object.read)
+
+        assert detect_file_type(file_object) == 'pdf'
+        file_object.read.assert_called_once_with(4096)
+        assert file_object.tell() == 0
+
+    def test_result_is_cached(self):
+        file_object = named_file('file.pdf', b'%PDF-1.4')
+        detect_file_type(file_object)
+        file_object.read = mock.Mock()
+
+        assert detect_file_type(file_object) == 'pdf'
+        assert not file_object.read.called
+
+    def test_file_content_matches_extension(self):
+        assert file_content_matches_extension(named_file('file.pdf', b'%PDF-1.4'))
+        assert file_content_matches_extension(named_file('file.odt', ODT_HEADER))
+        assert file_content_matches_extension(named_file('file.zip', ODT_HEADER))
+        assert file_content_matches_extension(named_file('file.csv', b'a,b\n1,2\n'))
+        assert not file_content_matches_extension(named_file('file.pdf', b'MZ\x90\x00'))
+        assert not file_content_matches_extension(named_file('file.ods', b'%PDF-1.4'))
+        assert not file_content_matches_extension(named_file('file.doc', b'%PDF-1.4'))
+
+    def test_file_type_checks_with_content(self):
+        assert file_is_pdf(named_file('file.pdf', b'%PDF-1.4'), check_content=True)
+        assert not file_is_pdf(named_file('file.pdf', b'GIF89a'), check_content=True)
+        assert file_is_pdf(named_file('file.pdf', b'GIF89a'))
+        assert file_is_image(named_file('file.png', b'\x89PNG\r\n\x1a\n'), check_content=True)
+        assert not file_is_image(named_file('file.jpg', b'\x89PNG\r\n\x1a\n'), check_content=True)
+        assert file_is_zip(named_file('file.zip', b'PK\x03\x04'), check_content=True)
+        assert file_is_csv(named_file('file.csv', b'a,b'), check_content=True)
+        assert not file_is_csv(named_file('file.csv', b'a,b\x00'), check_content=True)
+
+    def test_validate_documents_checking_content(self):
+        self.assertEqual(
+            validate_documents({
+                'file1': [named_file('file1.pdf', b'%PDF-1.4')],
+                'file2': [named_file('file2.odt', b'%PDF-1.4')],
+            }, check_content=True),
+            {'file2': 'file_is_open_document_format'}
+        )
+
+
 class TestUploadDocument(unittest.TestCase):
     def test_document_upload(self):
         uploader = mock.Mock(bucket_short_name="documents")
@@ -244,6 +384,174 @@ class TestUploadServiceDocuments(object):
         assert 'pricingDocumentURL' in files
         assert len(errors) == 0
 
+    def test_upload_service_documents_concurrently(self):
+        request_files = ImmutableMultiDict([('pricingDocumentURL', mock_file('q1.pdf', 100)),
+                                            ('pricingDocumentURL', mock_file('q2.odt', 100))])
+
+        with freeze_time('2015-10-04 14:36:05'):
+            with patch('dmutils.documents.aws.registry.s3_client') as s3_client:
+                files, errors = upload_service_documents(
+                    'bucket', self.documents_url, self.service,
+                    request_files, self.section, max_workers=2)
+
+        s3_client.return_value.upload_fileobj.assert_any_call(
+            request_files.getlist('pricingDocumentURL')[0], 'bucket',
+            'g-cloud-7/documents/12345/654321-0-pricing-document-2015-10-04-1436.pdf',
+            ExtraArgs={'ACL': 'public-read'}
+        )
+
+        assert files == {'pricingDocumentURL': [
+            'http://localhost/g-cloud-7/documents/12345/654321-0-pricing-document-2015-10-04-1436.pdf',
+            'http://localhost/g-cloud-7/documents/12345/654321-1-pricing-document-2015-10-04-1436.odt',
+        ]}
+        assert errors == {}
+
+    def test_concurrent_upload_errors_are_mapped_to_fields(self):
+        self.section.get_question_ids.return_value = ['pricingDocumentURL', 'serviceDefinitionDocumentURL']
+        request_files = ImmutableMultiDict([('pricingDocumentURL', mock_file('q1.pdf', 100)),
+                                            ('serviceDefinitionDocumentURL', mock_file('q2.pdf', 100))])
+
+        def upload_document(uploader, documents_url, service, field, file_contents, public=True, instrumentation=None):
+            return field == 'pricingDocumentURL' and 'http://localhost/{}'.format(file_contents.filename)
+
+        with patch('dmutils.documents.upload_document', side_effect=upload_document):
+            files, errors = upload_service_documents(
+                'bucket', self.documents_url, self.service,
+                request_files, self.section, max_workers=2)
+
+        assert files['pricingDocumentURL'] == ['http://localhost/q1.pdf']
+        assert errors == {'serviceDefinitionDocumentURL': 'file_can_be_saved'}
+
+    def test_concurrent_uploads_that_miss_the_deadline_are_errors(self):
+        self.section.get_question_ids.return_value = ['pricingDocumentURL', 'serviceDefinitionDocumentURL']
+        request_files = ImmutableMultiDict([('pricingDocumentURL', mock_file('q1.pdf', 100)),
+                                            ('serviceDefinitionDocumentURL', mock_file('q2.pdf', 100))])
+        release = threading.Event()
+        started = []
+
+        def upload_document(uploader, documents_url, service, field, file_contents, public=True, instrumentation=None):
+            started.append(field)
+            release.wait(0.1)
+            return 'http://localhost/{}'.format(file_contents.filename)
+
+        with patch('dmutils.documents.upload_document', side_effect=upload_document):
+            files, errors = upload_service_documents(
+                'bucket', self.documents_url, self.service,
+                request_files, self.section, max_workers=1, start_timeout=0.01)
+
+        # the upload that had started was waited for, and the one that hadn't was cancelled
+        assert started == ['pricingDocumentURL']
+        assert files['pricingDocumentURL'] == ['http://localhost/q1.pdf']
+        assert errors == {'serviceDefinitionDocumentURL': 'file_can_be_saved'}
+
+    def test_concurrent_uploads_share_the_client(self):
+        request_files = ImmutableMultiDict([('pricingDocumentURL', mock_file('q1.pdf', 100)),
+                                            ('pricingDocumentURL', mock_file('q2.pdf', 100))])
+
+        with patch('dmutils.documents.aws.registry.s3_resource') as s3_resource, \
+                patch('dmutils.documents.aws.registry.s3_client') as s3_client:
+            files, errors = upload_service_documents(
+                'bucket', self.documents_url, self.service,
+                request_files, self.section, max_workers=2)
+
+        assert errors == {}
+        assert not s3_resource.called
+        s3_client.assert_called_once_with()
+        assert s3_client.return_value.upload_fileobj.call_count == 2
+
+    @pytest.mark.parametrize('max_workers', [None, 2])
+    def test_upload_service_documents_with_instrumentation(self, max_workers):
+        request_files = ImmutableMultiDict([('pricingDocumentURL', mock_file('q1.pdf', 100)),
+                                            ('pricingDocumentURL', mock_file('q2.odt', 200))])
+        metrics_client = mock.Mock()
+        logger = mock.Mock()
+        instrumentation = UploadInstrumentation(metrics_client, logger=logger)
+
+        with patch('boto3.s3.inject.bucket_upload_fileobj'), patch('dmutils.documents.aws.registry.s3_client'):
+            upload_service_documents(
+                'bucket', self.documents_url, self.service,
+                request_files, self.section, max_workers=max_workers, instrumentation=instrumentation)
+
+        assert [timing.stage for timing in instrumentation.timings[:2]] == ['validate', 'connect']
+        assert instrumentation.timings[-1].stage == 'total'
+        assert instrumentation.timings[-1].size == 300
+        assert sorted(
+            (timing.stage, timing.size) for timing in instrumentation.timings if timing.stage in ('connect', 'upload')
+        ) == [('connect', None), ('upload', 100), ('upload', 200)]
+        assert logger.info.call_count == 5
+
+        metrics_client.put_metrics.assert_called_once_with(mock.ANY)
+        metrics, = metrics_client.put_metrics.call_args[0]
+        assert len(metrics) == 8
+        assert metrics[0] == Metric('documents.upload.validate', mock.ANY, 'Milliseconds', {'framework': 'g-cloud-7'})
+        assert Metric('documents.upload.upload.bytes', 200, 'Bytes', {'framework': 'g-cloud-7'}) in metrics
+
+    def test_instrumentation_sends_metrics_after_the_uploads(self, cloudwatch):
+        request_files = ImmutableMultiDict({'pricingDocumentURL': mock_file('q1.pdf', 100)})
+        instrumentation = UploadInstrumentation(metrics.client('region', 'namespace'), logger=mock.Mock())
+
+        def upload_fileobj(*args, **kwargs):
+            assert not cloudwatch.put_metric_data.called
+
+        with patch('boto3.s3.inject.bucket_upload_fileobj', side_effect=upload_fileobj):
+            upload_service_documents(
+                'bucket', self.documents_url, self.service,
+                request_files, self.section, instrumentation=instrumentation)
+
+        assert cloudwatch.put_metric_data.call_count == 1
+        assert cloudwatch.put_metric_data.call_args[1]['name'] == [
+            'documents.upload.validate', 'documents.upload.connect',
+            'documents.upload.upload', 'documents.upload.upload.bytes',
+            'documents.upload.total', 'documents.upload.total.bytes',
+        ]
+
+        instrumentation.flush()
+        assert cloudwatch.put_metric_data.call_count == 1
+
+    def test_instrumentation_sends_metrics_in_as_few_requests_as_possible(self, cloudwatch):
+        self.section.get_question_ids.return_value = list(documents.ID_TO_FILE_NAME_SUFFIX)
+        request_files = ImmutableMultiDict([
+            (field, mock_file('q{}.pdf'.format(i), 100))
+            for field in documents.ID_TO_FILE_NAME_SUFFIX for i in range(2)
+        ])
+        instrumentation = UploadInstrumentation(metrics.client('region', 'namespace'), logger=mock.Mock())
+
+        with patch('boto3.s3.inject.bucket_upload_fileobj'):
+            upload_service_documents(
+                'bucket', self.documents_url, self.service,
+                request_files, self.section, instrumentation=instrumentation)
+
+        # validate, connect, 10 uploads and the total, with the size of each upload and the total
+        assert sum(len(kwargs['name']) for args, kwargs in cloudwatch.put_metric_data.call_args_list) == 24
+        assert cloudwatch.put_metric_data.call_count == 2
+
+    def test_instrumentation_sends_metrics_when_validation_fails(self):
+        request_files = ImmutableMultiDict({'pricingDocumentURL': mock_file('q1.bad', 100)})
+        metrics_client = mock.Mock()
+        instrumentation = UploadInstrumentation(metrics_client, logger=mock.Mock())
+
+        files, errors = upload_service_documents(
+            'bucket', self.documents_url, self.service,
+            request_files, self.section, instrumentation=instrumentation)
+
+        assert errors
+        metrics_client.put_metrics.assert_called_once_with([
+            Metric('documents.upload.validate', mock.ANY, 'Milliseconds', {'framework': 'g-cloud-7'}),
+        ])
+
+    def test_failed_uploads_are_not_timed(self):
+        request_files = ImmutableMultiDict({'pricingDocumentURL': mock_file('q1.pdf', 100)})
+        instrumentation = UploadInstrumentation(logger=mock.Mock())
+
+        with patch('boto3.s3.inject.bucket_upload_fileobj', side_effect=S3ResponseError(403, 'Forbidden')):
+            with patch('dmutils.documents.rollbar'):
+                files, errors = upload_service_documents(
+                    'bucket', self.documents_url, self.service,
+                    request_files, self.section, instrumentation=instrumentation)
+
+        assert errors == {'pricingDocumentURL': 'file_can_be_saved'}
+        assert [timing.stage for timing in instrumentation.timings] == ['validate', 'connect', 'total']
+
     def test_empty_files_are_filtered(self):
         request_files = ImmutableMultiDict({'pricingDocumentURL': mock_file('q1.pdf', 0)})
 
@@ -267,15 +575,29 @@ class TestUploadServiceDocuments(object):
     def test_upload_with_validation_errors(self):
         request_files = ImmutableMultiDict({'pricingDocumentURL': mock_file('q1.bad', 100)})
 
-        files, errors = upload_service_documents(
-            'bucket', self.documents_url, self.service,
-            request_files, self.section)
+        with patch('dmutils.aws.registry.s3_resource') as s3_resource:
+            files, errors = upload_service_documents(
+                'bucket', self.documents_url, self.service,
+                request_files, self.section)
 
         assert files is None
         assert 'pricingDocumentURL' in errors
+        assert not s3_resource.called
+
+
+@pytest.fixture
+def s3_client():
+    documents._signed_url_cache.clear()
+    aws.registry.clear()
+    with mock.patch('dmutils.aws.boto3.session.Session') as session:
+        client = session.return_value.client
+        client.return_value.generate_presigned_url.side_effect = lambda operation, Params, ExpiresIn: \
+            'http://example/{}?after'.format(Params['Key'])
+        yield client
+    documents._signed_url_cache.clear()
+    aws.registry.clear()
 
 
-@pytest.mark.skip
 @pytest.mark.parametrize('base_url,expected', [
     ('http://other', 'http://other/foo?after'),
     (None, 'http://example/foo?after'),
@@ -283,13 +605,264 @@ class TestUploadServiceDocuments(object):
     ('https://other:1234', 'https://other:1234/foo?after'),
     ('https://other/again', 'https://other/foo?after'),
 ])
-def test_get_signed_url(base_url, expected):
-    mock_bucket = mock.Mock()
-    mock_bucket.get_signed_url.return_value = "http://example/foo?after"
-    with patch('botocore.signers.generate_presigned_url'):
-        url = get_signed_url(mock_bucket, 'foo', base_url)
+def test_get_signed_url(s3_client, base_url, expected):
+    url = get_signed_url('bucket', 'foo', base_url)
 
     assert url == expected
+    s3_client.return_value.generate_presigned_url.assert_called_once_with(
+        'get_object', Params={'Bucket': 'bucket', 'Key': 'foo'}, ExpiresIn=120
+    )
+
+
+def test_get_signed_url_reuses_client_and_urls(s3_client):
+    for i in range(3):
+        assert get_signed_url('bucket', 'foo', None) == 'http://example/foo?after'
+    assert get_signed_url('bucket', 'bar', None) == 'http://example/bar?after'
+    assert get_signed_url('bucket', 'foo', 'https://other') == 'https://other/foo?after'
+
+    assert s3_client.call_count == 1
+    assert s3_client.return_value.generate_presigned_url.call_count == 3
+
+
+def test_get_signed_url_is_regenerated_near_expiry(s3_client):
+    with mock.patch('dmutils.s3.monotonic', return_value=1000):
+        get_signed_url('bucket', 'foo', None)
+    with mock.patch('dmutils.s3.monotonic', return_value=1089):
+        get_signed_url('bucket', 'foo', None)
+    assert s3_client.return_value.generate_presigned_url.call_count == 1
+
+    with mock.patch('dmutils.s3.monotonic', return_value=1090):
+        get_signed_url('bucket', 'foo', None)
+    assert s3_client.return_value.generate_presigned_url.call_count == 2
+
+
+def test_get_signed_urls(s3_client):
+    assert get_signed_urls('bucket', ['foo', 'bar'], 'https://other') == {
+        'foo': 'https://other/foo?after',
+        'bar': 'https://other/bar?after',
+    }
+
+
+class TestUploadPolicies(object):
+    def setup(self):
+        self.service = {'frameworkSlug': 'g-cloud-7', 'supplierCode': '12345', 'id': '654321'}
+
+    def test_generate_upload_policy(self, s3_client):
+        s3_client.return_value.generate_presigned_post.return_value = {'url': 'https://s3/bucket', 'fields': {}}
+
+        assert generate_upload_policy('bucket', 'path/file.pdf') == {
+            'url': 'https://s3/bucket', 'fields': {}
+        }
+        s3_client.return_value.generate_presigned_post.assert_called_once_with(
+            Bucket='bucket',
+            Key='path/file.pdf',
+            Fields={'acl': 'private', 'Content-Type': 'application/pdf'},
+            Conditions=[
+                {'acl': 'private'},
+                ['content-length-range', 1, 5399999],
+                {'Content-Type': 'application/pdf'},
+            ],
+            ExpiresIn=600,
+        )
+
+    def test_generate_document_upload_policy(self, s3_client):
+        s3_client.return_value.generate_presigned_post.side_effect = lambda **kwargs: {'url': 'https://s3/bucket'}
+
+        with freeze_time('2015-10-04 14:36:05'):
+            policy = generate_document_upload_policy('bucket', self.service, 'pricingDocumentURL', 'q1.pdf')
+
+        assert policy == {
+            'url': 'https://s3/bucket',
+            'path': 'g-cloud-7/documents/12345/654321-pricing-document-2015-10-04-1436.pdf',
+        }
+
+    def test_generate_document_upload_policy_for_invalid_extension(self, s3_client):
+        assert generate_document_upload_policy('bucket', self.service, 'pricingDocumentURL', 'q1.doc') is None
+        assert not s3_client.return_value.generate_presigned_post.called
+
+    PATH = 'g-cloud-7/documents/12345/654321-pricing-document-2015-10-04-1436.pdf'
+
+    def uploaded(self, s3_client, size=100, header=b'%PDF-1.4', last_modified=None, grants=()):
+        s3_client.return_value.head_object.return_value = {
+            'ContentLength': size,
+            'LastModified': last_modified or datetime.datetime(2015, 10, 4, 14, 36, 5, tzinfo=pytz.utc),
+        }
+        s3_client.return_value.get_object_acl.return_value = {'Grants': list(grants)}
+        s3_client.return_value.get_object.return_value = {'Body': BytesIO(header)}
+
+    def verify(self, path=PATH, **kwargs):
+        with freeze_time('2015-10-04 14:40:00'):
+            return verify_document_upload('bucket', self.service, 'pricingDocumentURL', path, **kwargs)
+
+    def test_verify_document_upload(self, s3_client):
+        self.uploaded(s3_client)
+
+        assert self.verify() is None
+        s3_client.return_value.get_object.assert_called_once_with(Bucket='bucket', Key=self.PATH,
+                                                                  Range='bytes=0-4095')
+        s3_client.return_value.put_object_acl.assert_called_once_with(Bucket='bucket', Key=self.PATH,
+                                                                      ACL='public-read')
+        assert not s3_client.return_value.delete_object.called
+
+    def test_verify_private_document_upload(self, s3_client):
+        self.uploaded(s3_client)
+
+        assert self.verify(public=False) is None
+        assert not s3_client.return_value.put_object_acl.called
+        assert not s3_client.return_value.delete_object.called
+
+    def test_verify_document_upload_checks_content(self, s3_client):
+        self.uploaded(s3_client, header=b'MZ\x90\x00')
+
+        assert self.verify() == 'file_is_open_document_format'
+        s3_client.return_value.delete_object.assert_called_once_with(Bucket='bucket', Key=self.PATH)
+        assert not s3_client.return_value.put_object_acl.called
+
+        assert self.verify(check_content=False) is None
+
+    def test_verify_document_upload_checks_size(self, s3_client):
+        self.uploaded(s3_client, size=5400000)
+
+        assert self.verify() == 'file_is_less_than_5mb'
+        s3_client.return_value.delete_object.assert_called_once_with(Bucket='bucket', Key=self.PATH)
+        assert not s3_client.return_value.get_object.called
+        assert not s3_client.return_value.put_object_acl.called
+
+    def test_verify_document_upload_checks_extension(self, s3_client):
+        assert self.verify(self.PATH.replace('.pdf', '.doc')) == 'file_is_open_document_format'
+        assert not s3_client.return_value.head_object.called
+        assert not s3_client.return_value.delete_object.called
+
+    @pytest.mark.parametrize('path', [
+        'g-cloud-7/documents/12345/654321-service-definition-document-2015-10-04-1436.pdf',
+        'g-cloud-7/documents/12345/654322-pricing-document-2015-10-04-1436.pdf',
+        'g-cloud-7/documents/67890/654321-pricing-document-2015-10-04-1436.pdf',
+        'g-cloud-8/documents/12345/654321-pricing-document-2015-10-04-1436.pdf',
+        'g-cloud-7/agreements/12345/654321-pricing-document-2015-10-04-1436.pdf',
+        'g-cloud-7/documents/12345/654321-pricing-document-/../other.pdf',
+        'path/file.pdf',
+    ])
+    def test_verify_document_upload_refuses_paths_for_other_documents(self, s3_client, path):
+        assert self.verify(path) == 'file_can_be_saved'
+        assert not s3_client.return_value.head_object.called
+        assert not s3_client.return_value.put_object_acl.called
+        assert not s3_client.return_value.delete_object.called
+
+    def test_verify_document_upload_refuses_objects_older_than_the_policy(self, s3_client):
+        self.uploaded(s3_client, header=b'MZ\x90\x00',
+                      last_modified=datetime.datetime(2015, 10, 4, 14, 29, 59, tzinfo=pytz.utc))
+
+        assert self.verify() == 'file_can_be_saved'
+        assert not s3_client.return_value.put_object_acl.called
+        assert not s3_client.return_value.delete_object.called
+
+    def test_verify_document_upload_refuses_objects_that_are_already_public(self, s3_client):
+        self.uploaded(s3_client, header=b'MZ\x90\x00', grants=[
+            {'Grantee': {'Type': 'CanonicalUser', 'ID': 'owner'}, 'Permission': 'FULL_CONTROL'},
+            {'Grantee': {'Type': 'Group', 'URI': 'http://acs.amazonaws.com/groups/global/AllUsers'},
+             'Permission': 'READ'},
+        ])
+
+        assert self.verify() == 'file_can_be_saved'
+        assert not s3_client.return_value.put_object_acl.called
+        assert not s3_client.return_value.delete_object.called
+
+    def test_verify_missing_document_upload(self, s3_client):
+        s3_client.return_value.head_object.side_effect = ClientError(
+            {'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject'
+        )
+
+        assert self.verify() == 'file_can_be_saved'
+
+
+class TestStreamZip(object):
+    def setup(self):
+        self.objects = {
+            'g-cloud-7/agreements/1234/1234-foo.pdf': b'%PDF-1.4 foo' * 10000,
+            'g-cloud-7/agreements/5678/5678-foo.pdf': b'%PDF-1.4 bar',
+            'g-cloud-7/agreements/9012/9012-foo.pdf': b'',
+        }
+
+    def get_object(self, Bucket, Key):
+        return {'Body': BytesIO(self.objects[Key])}
+
+    def test_stream_zip(self, s3_client):
+        s3_client.return_value.get_object.side_effect = self.get_object
+        paths = sorted(self.objects)
+
+        chunks = list(stream_zip('bucket', paths, chunk_size=1024))
+
+        assert len(chunks) > len(paths)
+        archive = zipfile.ZipFile(BytesIO(b''.join(chunks)))
+        assert archive.namelist() == ['1234-foo.pdf', '5678-foo.pdf', '9012-foo.pdf']
+        for path in paths:
+            assert archive.read(path.split('/')[-1]) == self.objects[path]
+
+    def test_stream_zip_with_names_and_compression(self, s3_client):
+        s3_client.return_value.get_object.side_effect = self.get_object
+        paths = sorted(self.objects)
+
+        archive = zipfile.ZipFile(BytesIO(b''.join(
+            stream_zip('bucket', paths, names=['a.pdf', 'b.pdf', 'c.pdf'], compression=zipfile.ZIP_DEFLATED)
+        )))
+
+        assert archive.namelist() == ['a.pdf', 'b.pdf', 'c.pdf']
+        assert archive.getinfo('a.pdf').compress_type == zipfile.ZIP_DEFLATED
+        assert archive.read('a.pdf') == self.objects[paths[0]]
+
+    def test_stream_zip_without_streaming_entries(self, s3_client):
+        s3_client.return_value.get_object.side_effect = self.get_object
+        paths = sorted(self.objects)
+
+        with mock.patch.object(documents.sys, 'version_info', (3, 5)):
+            archive = zipfile.ZipFile(BytesIO(b''.join(stream_zip('bucket', paths))))
+
+        assert archive.read('1234-foo.pdf') == self.objects[paths[0]]
+
+    def test_stream_zip_limits_downloads_ahead(self, s3_client):
+        s3_client.return_value.get_object.side_effect = self.get_object
+        paths = sorted(self.objects) * 5
+
+        stream = stream_zip('bucket', paths, names=['{}.pdf'.format(i) for i in range(len(paths))], max_workers=2)
+        next(stream)
+        # the first document and the next two
+        assert s3_client.return_value.get_object.call_count <= 3
+
+        list(stream)
+        assert s3_client.return_value.get_object.call_count == 15
+
+    def test_stream_zip_makes_repeated_names_unique(self, s3_client):
+        s3_client.return_value.get_object.side_effect = self.get_object
+        paths = sorted(self.objects)
+
+        archive = zipfile.ZipFile(BytesIO(b''.join(
+            stream_zip('bucket', paths, names=['a.pdf', 'a.pdf', 'a-2.pdf'])
+        )))
+
+        assert archive.namelist() == ['a.pdf', 'a-3.pdf', 'a-2.pdf']
+        assert archive.read('a-3.pdf') == self.objects[paths[1]]
+
+    def test_stream_zip_needs_a_name_for_each_path(self, s3_client):
+        with pytest.raises(ValueError):
+            stream_zip('bucket', sorted(self.objects), names=['a.pdf', 'b.pdf'])
+        assert not s3_client.return_value.get_object.called
+
+    def test_stream_zip_is_lazy(self, s3_client):
+        s3_client.return_value.get_object.side_effect = self.get_object
+
+        stream = stream_zip('bucket', sorted(self.objects))
+        assert not s3_client.return_value.get_object.called
+
+        next(stream)
+        stream.close()
+
+    def test_stream_zip_raises_download_errors(self, s3_client):
+        s3_client.return_value.get_object.side_effect = ClientError(
+            {'Error': {'Code': 'NoSuchKey', 'Message': 'Not Found'}}, 'GetObject'
+        )
+
+        with pytest.raises(ClientError):
+            list(stream_zip('bucket', ['missing.pdf']))
 
 
 def test_get_agreement_document_path():
@@ -302,6 +875,27 @@ def test_get_document_path():
         'g-cloud-7/agreements/1234/1234-foo.pdf'
 
 
+def test_get_agreement_document_paths():
+    assert get_agreement_document_paths('g-cloud-7', [1234, 5678], 'foo.pdf') == [
+        'g-cloud-7/agreements/1234/1234-foo.pdf',
+        'g-cloud-7/agreements/5678/5678-foo.pdf',
+    ]
+
+
+def test_get_document_paths_with_a_name_for_each_supplier():
+    assert get_document_paths('g-cloud-7', [1234, 5678], 'agreements', ['foo.pdf', 'bar.pdf']) == [
+        get_document_path('g-cloud-7', 1234, 'agreements', 'foo.pdf'),
+        get_document_path('g-cloud-7', 5678, 'agreements', 'bar.pdf'),
+    ]
+
+
+def test_get_document_paths_needs_a_name_for_each_supplier():
+    with pytest.raises(ValueError):
+        get_document_paths('g-cloud-7', [1234, 5678, 9012], 'agreements', ['foo.pdf', 'bar.pdf'])
+    with pytest.raises(ValueError):
+        get_agreement_document_paths('g-cloud-7', [1234], ['foo.pdf', 'bar.pdf'])
+
+
 def test_sanitise_supplier_name():
     assert sanitise_supplier_name(u'Kev\'s Butties') == 'Kevs_Butties'
     assert sanitise_supplier_name(u'   Supplier A   ') == 'Supplier_A'
@@ -309,3 +903,47 @@ def test_sanitise_supplier_name():
     assert sanitise_supplier_name(u'\ / : * ? \' " < > |') == '_'
     assert sanitise_supplier_name(u'kev@the*agency') == 'kevtheagency'
     assert sanitise_supplier_name(u"Ψ is a silly character") == "is_a_silly_character"
+
+
+SUPPLIER_NAMES = [
+    u'Kev\'s Butties',
+    u'   Supplier A   ',
+    u'Kev & Sons. | Ltd',
+    u'\\ / : * ? \' " < > |',
+    u'Ψ is a silly character',
+    u'Smith & Jones (UK) Ltd.',
+    u'A&B Consulting',
+    u'Acme  Cloud   Services, Inc.',
+    u'O\'Reilly & O\'Brien',
+    u'Digital #1 Agency! {Beta}',
+    u'100% Solutions + Partners = Success',
+    u'Café Digital Ltd',
+    u'name_with__underscores',
+    u'_ leading and trailing _',
+    u'Data@Scale: "The" `Company`',
+    u'\tTabbed\tName\n',
+    u'\x1cSeparated\x1f',
+    u'　 Ideographic space ',
+    u'',
+]
+
+
+def _legacy_sanitise_supplier_name(supplier_name):
+    sanitised_supplier_name = supplier_name.encode("ascii", errors="ignore").decode("ascii").strip()
+    sanitised_supplier_name = sanitised_supplier_name.replace(' ', '_').replace('&', 'and')
+    for bad_char in documents.BAD_SUPPLIER_NAME_CHARACTERS:
+        sanitised_supplier_name = sanitised_supplier_name.replace(bad_char, '')
+    while '__' in sanitised_supplier_name:
+        sanitised_supplier_name = sanitised_supplier_name.replace('__', '_')
+    return sanitised_supplier_name
+
+
+@pytest.mark.parametrize('supplier_name', SUPPLIER_NAMES)
+def test_sanitise_supplier_name_matches_previous_implementation(supplier_name):
+    assert sanitise_supplier_name(supplier_name) == _legacy_sanitise_supplier_name(supplier_name)
+
+
+def test_sanitise_supplier_names():
+    assert sanitise_supplier_names(iter(SUPPLIER_NAMES)) == [
+        _legacy_sanitise_supplier_name(supplier_name) for supplier_name in SUPPLIER_NAMES
+    ]
@@ -6,30 +6,41 @@ from __future__ import \
 
 from freezegun import freeze_time
 import pytest
+import time
 import mock
 import six
 
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, EndpointConnectionError
 from datetime import datetime
 
+from dmutils import aws
 from dmutils.config import init_app
 from dmutils.email import (
     generate_token, decode_token, send_email, EmailError, hash_email, decode_invitation_token,
-    decode_password_reset_token, parse_fernet_timestamp, InvalidToken)
+    decode_password_reset_token, parse_fernet_timestamp, InvalidToken,
+    send_bulk_emails, EmailResult, EmailThrottlingError, TokenBucket,
+    get_email_template, render_email, render_emails, get_fernet, generate_tokens)
 
 from .test_user import user_json
 
 
 TEST_SECRET_KEY = 'TestKeyTestKeyTestKeyTestKeyTestKeyTestKeyX='
+OLD_SECRET_KEY = 'OldKeyOldKeyOldKeyOldKeyOldKeyOldKeyOldKeyX='
 TEST_ARCHIVE_ADDRESS = 'marketplace+archive@digital.gov.au'
 TEST_RETURN_ADDRESS = 'marketplace+returned@digital.gov.au'
 
 
 @pytest.yield_fixture
-def email_client():
-    with mock.patch('boto3.client') as boto_client:
-        instance = boto_client.return_value
-        yield instance
+def session():
+    aws.registry.clear()
+    with mock.patch('dmutils.aws.boto3.session.Session') as session:
+        yield session
+    aws.registry.clear()
+
+
+@pytest.yield_fixture
+def email_client(session):
+    yield session.return_value.client.return_value
 
 
 @pytest.yield_fixture
@@ -132,6 +143,32 @@ def test_calls_send_email_with_alternative_reply_to(email_app, email_client):
     )
 
 
+def test_send_email_reuses_ses_client(email_app, email_client, session):
+    with email_app.app_context():
+        with mock.patch.dict('os.environ', {'AWS_REGION': 'ap-southeast-2', 'AWS_SES_URL': 'http://localhost'}):
+            for i in range(20):
+                send_email("email_address", "body", "subject", "from_email", "from_name")
+
+    assert email_client.send_email.call_count == 20
+    session.return_value.client.assert_called_once_with(
+        'ses',
+        config=None,
+        region_name='ap-southeast-2',
+        aws_access_key_id=mock.ANY,
+        aws_secret_access_key=mock.ANY,
+        endpoint_url='http://localhost',
+    )
+
+
+def test_send_email_uses_a_new_client_when_the_region_changes(email_app, email_client, session):
+    with email_app.app_context():
+        for region in ['ap-southeast-2', 'us-east-1', 'ap-southeast-2']:
+            with mock.patch.dict('os.environ', {'AWS_REGION': region}):
+                send_email("email_address", "body", "subject", "from_email", "from_name")
+
+    assert session.return_value.client.call_count == 2
+
+
 def test_should_throw_exception_if_email_client_fails(email_app, email_client):
     with email_app.app_context():
         email_client.send_email.side_effect = ClientError(
@@ -148,6 +185,197 @@ def test_should_throw_exception_if_email_client_fails(email_app, email_client):
             )
 
 
+def test_should_throw_throttling_exception_if_sending_rate_is_exceeded(email_app, email_client):
+    with email_app.app_context():
+        email_client.send_email.side_effect = ClientError(
+            {'Error': {'Code': 'Throttling', 'Message': "Maximum sending rate exceeded."}}, ""
+        )
+
+        with pytest.raises(EmailThrottlingError):
+            send_email("email_address", "body", "subject", "from_email", "from_name")
+
+
+def bulk_message(to_email_address):
+    return {
+        'to_email_addresses': to_email_address,
+        'email_body': 'body',
+        'subject': 'subject',
+        'from_email': 'from_email',
+        'from_name': 'from_name',
+    }
+
+
+def ses_response(Destination, **kwargs):
+    return {'MessageId': 'id-{}'.format(Destination['ToAddresses'][0]), 'ResponseMetadata': {'RequestId': 'r'}}
+
+
+def throttling_error():
+    return ClientError({'Error': {'Code': 'Throttling', 'Message': "Maximum sending rate exceeded."}}, "SendEmail")
+
+
+class TestSendBulkEmails(object):
+    @pytest.fixture(autouse=True)
+    def sleep(self):
+        with mock.patch('dmutils.email.time.sleep') as sleep:
+            yield sleep
+
+    def test_send_bulk_emails(self, email_app, email_client):
+        email_client.send_email.side_effect = ses_response
+
+        with email_app.app_context():
+            results = send_bulk_emails(
+                [bulk_message('email{}'.format(i)) for i in range(20)], max_rate_per_sec=1000, workers=4
+            )
+
+        assert results == [EmailResult('email{}'.format(i), 'id-email{}'.format(i), None) for i in range(20)]
+        assert email_client.send_email.call_count == 20
+
+    def test_throttled_emails_are_retried(self, email_app, email_client, sleep):
+        email_client.send_email.side_effect = [throttling_error(), throttling_error(), ses_response(
+            Destination={'ToAddresses': ['email']}
+        )]
+
+        with email_app.app_context():
+            results = send_bulk_emails([bulk_message('email')], backoff=1)
+
+        assert results == [EmailResult('email', 'id-email', None)]
+        assert sleep.call_args_list == [mock.call(1), mock.call(2)]
+
+    def test_throttled_emails_fail_after_retries(self, email_app, email_client):
+        email_client.send_email.side_effect = throttling_error()
+
+        with email_app.app_context():
+            results = send_bulk_emails([bulk_message('email')], retries=2)
+
+        assert isinstance(results[0].error, EmailThrottlingError)
+        assert email_client.send_email.call_count == 3
+
+    def test_other_errors_are_not_retried(self, email_app, email_client):
+        email_client.send_email.side_effect = [
+            ClientError({'Error': {'Code': 'MessageRejected', 'Message': "Email address is not verified."}}, ""),
+            ses_response(Destination={'ToAddresses': ['email2']}),
+        ]
+
+        with email_app.app_context():
+            results = send_bulk_emails([bulk_message('email1'), bulk_message('email2')], workers=1)
+
+        assert isinstance(results[0].error, EmailError)
+        assert results[1] == EmailResult('email2', 'id-email2', None)
+        assert email_client.send_email.call_count == 2
+
+    def test_unexpected_errors_are_returned_for_each_message(self, email_app, email_client):
+        email_client.send_email.side_effect = ses_response
+        messages = [bulk_message('email{}'.format(i)) for i in range(20)]
+        messages.insert(10, {'to_email_addresses': 'bad', 'subject': 'subject'})
+
+        with email_app.app_context():
+            results = send_bulk_emails(messages, max_rate_per_sec=1000, workers=4)
+
+        assert len(results) == 21
+        assert results[10].to_email_addresses == 'bad'
+        assert isinstance(results[10].error, TypeError)
+        assert [result.message_id for result in results[:10]] == ['id-email{}'.format(i) for i in range(10)]
+        assert email_client.send_email.call_count == 20
+
+    def test_connection_errors_are_returned(self, email_app, email_client):
+        email_client.send_email.side_effect = EndpointConnectionError(endpoint_url='http://localhost')
+
+        with email_app.app_context():
+            results = send_bulk_emails([bulk_message('email')])
+
+        assert isinstance(results[0].error, EndpointConnectionError)
+
+    def test_no_emails_are_sent_after_raising(self, email_app):
+        sent = []
+
+        def send(message, *args):
+            if message['to_email_addresses'] == 'email0':
+                raise KeyboardInterrupt()
+            sent.append(message)
+
+        with email_app.app_context():
+            with mock.patch('dmutils.email._send_with_retries', side_effect=send):
+                with pytest.raises(KeyboardInterrupt):
+                    send_bulk_emails([bulk_message('email{}'.format(i)) for i in range(50)], workers=2)
+                sent_when_raised = len(sent)
+                time.sleep(0.05)
+
+        assert len(sent) == sent_when_raised < 49
+
+
+class TestTokenBucket(object):
+    def test_token_bucket_limits_rate(self):
+        clock = [0.0]
+
+        def sleep(seconds):
+            clock[0] += seconds
+
+        with mock.patch('dmutils.email.monotonic', side_effect=lambda: clock[0]):
+            with mock.patch('dmutils.email.time.sleep', side_effect=sleep):
+                bucket = TokenBucket(2)
+                for i in range(6):
+                    bucket.acquire()
+
+        # a burst of 2, then 2 a second
+        assert clock[0] == pytest.approx(2)
+
+    def test_token_bucket_refills_up_to_capacity(self):
+        clock = [0.0]
+
+        def advance(seconds):
+            clock[0] += seconds
+
+        with mock.patch('dmutils.email.monotonic', side_effect=lambda: clock[0]):
+            with mock.patch('dmutils.email.time.sleep', side_effect=advance) as sleep:
+                bucket = TokenBucket(10, capacity=1)
+                clock[0] = 60
+                bucket.acquire()
+                bucket.acquire()
+
+        sleep.assert_called_once_with(pytest.approx(0.1))
+
+
+def test_render_email(app):
+    with app.app_context():
+        assert render_email('<p>Hello {{ name }}</p>', name='Kev & Sons') == '<p>Hello Kev &amp; Sons</p>'
+
+
+def test_email_templates_are_compiled_once(app):
+    with app.app_context():
+        with mock.patch.object(app.jinja_env, 'from_string', wraps=app.jinja_env.from_string) as from_string:
+            for name in ['a', 'b', 'c']:
+                render_email('<p>Hello {{ name }} {{ config.DM_TEST }}</p>', name=name)
+
+        assert from_string.call_count == 1
+        assert get_email_template('<p>Hello {{ name }} {{ config.DM_TEST }}</p>') is \
+            get_email_template('<p>Hello {{ name }} {{ config.DM_TEST }}</p>')
+
+
+def test_email_template_cache_is_bounded(app):
+    with app.app_context():
+        with mock.patch('dmutils.email.EMAIL_TEMPLATE_CACHE_SIZE', 2):
+            first = get_email_template('first')
+            get_email_template('second')
+            assert get_email_template('first') is first
+
+            get_email_template('third')  # 'second' is the least recently used
+
+            assert get_email_template('first') is first
+            with mock.patch.object(app.jinja_env, 'from_string', wraps=app.jinja_env.from_string) as from_string:
+                get_email_template('second')
+            assert from_string.call_count == 1
+
+
+def test_render_emails(app):
+    with app.app_context():
+        with mock.patch.object(app, 'logger') as logger:
+            bodies = render_emails('Dear {{ name }}', ({'name': name} for name in ['a', 'b', 'c']))
+
+    assert bodies == ['Dear a', 'Dear b', 'Dear c']
+    logger.info.assert_called_once_with("Rendered {email_count} emails in {duration}ms",
+                                        extra={'email_count': 3, 'duration': mock.ANY})
+
+
 def test_can_generate_token():
     token = generate_token({
         "key1": "value1",
@@ -192,6 +420,31 @@ def test_cant_decode_token_with_wrong_key():
         decode_token(token, 'WrongKeyWrongKeyWrongKeyWrongKeyWrongKeyXXX=', '1234567890')
 
 
+def test_fernets_are_cached():
+    assert get_fernet(TEST_SECRET_KEY) is get_fernet(TEST_SECRET_KEY.encode('utf-8'))
+    assert get_fernet([TEST_SECRET_KEY, OLD_SECRET_KEY]) is get_fernet((TEST_SECRET_KEY, OLD_SECRET_KEY))
+    assert get_fernet([TEST_SECRET_KEY, OLD_SECRET_KEY]) is not get_fernet(TEST_SECRET_KEY)
+
+
+def test_decode_token_with_rotated_keys():
+    old_token = generate_token({"key1": "value1"}, OLD_SECRET_KEY, '1234567890')
+    new_token = generate_token({"key1": "value2"}, [TEST_SECRET_KEY, OLD_SECRET_KEY], '1234567890')
+
+    assert decode_token(old_token, [TEST_SECRET_KEY, OLD_SECRET_KEY], '1234567890') == {"key1": "value1"}
+    assert decode_token(new_token, TEST_SECRET_KEY, '1234567890') == {"key1": "value2"}
+    with pytest.raises(InvalidToken):
+        decode_token(old_token, TEST_SECRET_KEY, '1234567890')
+
+
+def test_generate_tokens():
+    batch = [{"email_address": "user{}@example.com".format(i)} for i in range(5)]
+
+    tokens = generate_tokens(iter(batch), TEST_SECRET_KEY, '1234567890')
+
+    assert [decode_token(token, TEST_SECRET_KEY, '1234567890') for token in tokens] == batch
+    assert len(set(tokens)) == 5
+
+
 def test_hash_email():
     tests = [
         (u'test@example.com', six.b('lz3-Rj7IV4X1-Vr1ujkG7tstkxwk5pgkqJ6mXbpOgTs=')),
@@ -264,6 +517,14 @@ def test_decode_invitation_token_decodes_ok_for_buyer(email_app):
         assert decode_invitation_token(token, role='buyer') == data
 
 
+def test_decode_invitation_token_decodes_token_made_with_a_previous_key(email_app):
+    email_app.config['DM_PREVIOUS_SHARED_EMAIL_KEYS'] = [OLD_SECRET_KEY]
+    with email_app.app_context():
+        data = {'email_address': 'test-user@email.com'}
+        token = generate_token(data, OLD_SECRET_KEY, 'Salt')
+        assert decode_invitation_token(token, role='buyer') == data
+
+
 def test_decode_invitation_token_decodes_ok_for_supplier(email_app):
     with email_app.app_context():
         data = {'email_address': 'test-user@email.com', 'supplier_code': 1234, 'supplier_name': 'A. Supplier'}
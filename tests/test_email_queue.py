@@ -0,0 +1,257 @@
+from __future__ import absolute_import, unicode_literals
+
+import os
+import threading
+import time
+
+import mock
+import pytest
+from botocore.exceptions import ClientError
+
+from dmutils import aws
+from dmutils.email_queue import EmailQueue, EmailSpool, EMAIL_SPOOL_LEASE
+from dmutils.logging import notify_team
+
+
+class FakeSES(object):
+    """A local stand-in for the SES client, recording the emails it's asked to send."""
+    def __init__(self):
+        self.sent = []
+        self.throttle = False
+        self.release = threading.Event()
+        self.release.set()
+
+    def send_email(self, **kwargs):
+        self.release.wait(5)
+        if self.throttle:
+            raise ClientError({'Error': {'Code': 'Throttling', 'Message': "Maximum sending rate exceeded."}}, "")
+        self.sent.append(kwargs)
+        return {'MessageId': str(len(self.sent)), 'ResponseMetadata': {'RequestId': 'request-id'}}
+
+
+@pytest.yield_fixture
+def ses():
+    ses = FakeSES()
+    aws.registry.clear()
+    with mock.patch('dmutils.aws.boto3.session.Session') as session:
+        session.return_value.client.return_value = ses
+        yield ses
+    ses.release.set()
+    aws.registry.clear()
+
+
+@pytest.fixture
+def spool_path(tmpdir):
+    return str(tmpdir.join('emails.sqlite'))
+
+
+@pytest.yield_fixture
+def queues():
+    queues = []
+    yield queues
+    for email_queue in queues:
+        email_queue.shutdown(timeout=1)
+
+
+def make_queue(app, queues, **config):
+    app.config.update(config)
+    email_queue = EmailQueue(app)
+    queues.append(email_queue)
+    return email_queue
+
+
+def send(email_queue, subject='subject'):
+    email_queue.send_email('email_address', 'body', subject, 'from_email', 'from_name')
+
+
+def test_emails_are_sent_in_the_background(app, ses, queues):
+    email_queue = make_queue(app, queues)
+
+    for i in range(10):
+        send(email_queue, 'subject {}'.format(i))
+    email_queue.join()
+
+    assert sorted(email['Message']['Subject']['Data'] for email in ses.sent) == sorted(
+        'subject {}'.format(i).encode('utf-8') for i in range(10)
+    )
+    assert app.extensions['email_queue'] is email_queue
+
+
+def test_shutdown_sends_queued_emails(app, ses, queues):
+    email_queue = make_queue(app, queues)
+
+    for i in range(5):
+        send(email_queue)
+    email_queue.shutdown()
+
+    assert len(ses.sent) == 5
+
+
+def test_emails_sent_while_shutting_down_are_spooled(app, ses, queues, spool_path):
+    email_queue = make_queue(app, queues, DM_EMAIL_SPOOL_PATH=spool_path)
+    email_queue.shutdown()
+
+    send(email_queue)
+
+    assert len(email_queue.spool) == 1
+    assert not ses.sent
+
+
+def test_unsent_emails_survive_a_restart(app, ses, queues, spool_path):
+    email_queue = make_queue(app, queues, DM_EMAIL_SPOOL_PATH=spool_path, DM_EMAIL_QUEUE_WORKERS=1)
+    ses.release.clear()
+
+    for i in range(3):
+        send(email_queue, 'subject {}'.format(i))
+    email_queue.shutdown(timeout=0.1)
+
+    # the first email is being sent when the queue is shut down
+    assert len(EmailSpool(spool_path)) == 2
+
+    ses.release.set()
+    restarted_queue = make_queue(app, queues, DM_EMAIL_SPOOL_PATH=spool_path)
+    restarted_queue.join()
+
+    email_queue._workers[0].join(1)
+
+    assert sorted(email['Message']['Subject']['Data'] for email in ses.sent) == [
+        b'subject 0', b'subject 1', b'subject 2'
+    ]
+    assert len(restarted_queue.spool) == 0
+
+
+def test_emails_are_spooled_when_the_queue_is_full(app, ses, queues, spool_path):
+    email_queue = make_queue(app, queues, DM_EMAIL_SPOOL_PATH=spool_path,
+                             DM_EMAIL_QUEUE_SIZE=1, DM_EMAIL_QUEUE_WORKERS=0)
+
+    for i in range(3):
+        send(email_queue)
+
+    assert email_queue._queue.qsize() == 1
+    assert len(email_queue.spool) == 2
+
+
+def test_throttled_emails_are_spooled_and_retried(app, ses, queues, spool_path):
+    email_queue = make_queue(app, queues, DM_EMAIL_SPOOL_PATH=spool_path)
+    ses.throttle = True
+
+    send(email_queue)
+    email_queue.join()
+
+    assert len(email_queue.spool) == 1
+
+    ses.throttle = False
+    email_queue.requeue_spooled()
+    email_queue.join()
+
+    assert len(ses.sent) == 1
+    assert len(email_queue.spool) == 0
+
+
+def test_spooled_emails_stay_in_the_spool_until_they_are_sent(app, ses, queues, spool_path):
+    EmailSpool(spool_path).append({
+        'to_email_addresses': 'email_address', 'email_body': 'body', 'subject': 'subject',
+        'from_email': 'from_email', 'from_name': 'from_name', 'reply_to': None,
+    })
+    ses.release.clear()
+    email_queue = make_queue(app, queues, DM_EMAIL_SPOOL_PATH=spool_path)
+    email_queue.start()
+
+    assert len(email_queue.spool) == 1
+
+    ses.release.set()
+    email_queue.join()
+
+    assert len(ses.sent) == 1
+    assert len(email_queue.spool) == 0
+
+
+def test_leased_emails_are_only_leased_again_when_the_lease_expires(spool_path):
+    spool = EmailSpool(spool_path)
+    for i in range(3):
+        spool.append({'subject': 'subject {}'.format(i)})
+
+    assert [message['subject'] for _, message in spool.lease('owner-1', 2)] == ['subject 0', 'subject 1']
+    assert [message['subject'] for _, message in spool.lease('owner-2', 10)] == ['subject 2']
+    assert spool.lease('owner-3', 10) == []
+
+    with mock.patch('dmutils.email_queue.time.time', return_value=time.time() + EMAIL_SPOOL_LEASE + 1):
+        assert len(spool.lease('owner-3', 10)) == 3
+
+
+def test_released_emails_can_be_leased_again(spool_path):
+    spool = EmailSpool(spool_path)
+    spool.append({'subject': 'subject'})
+    [(spool_id, _)] = spool.lease('owner-1', 10)
+
+    spool.release(spool_id, 'owner-2')
+    assert spool.lease('owner-2', 10) == []
+
+    spool.release(spool_id, 'owner-1')
+    assert spool.lease('owner-2', 10) == [(spool_id, {'subject': 'subject'})]
+
+
+def test_requeue_only_takes_as_many_spooled_emails_as_fit_in_the_queue(app, ses, queues, spool_path):
+    spool = EmailSpool(spool_path)
+    for i in range(5):
+        spool.append({'subject': 'subject {}'.format(i)})
+    email_queue = make_queue(app, queues, DM_EMAIL_SPOOL_PATH=spool_path,
+                             DM_EMAIL_QUEUE_SIZE=2, DM_EMAIL_QUEUE_WORKERS=0)
+
+    email_queue.start()
+
+    assert email_queue._queue.qsize() == 2
+    assert len(spool.lease('another-queue', 10)) == 3
+
+
+def test_workers_are_started_when_the_queue_is_first_used(app, ses, queues):
+    email_queue = make_queue(app, queues)
+
+    assert email_queue._workers == []
+
+    send(email_queue)
+    email_queue.join()
+
+    assert len(email_queue._workers) == 2
+    assert len(ses.sent) == 1
+
+
+def test_workers_are_started_again_after_a_fork(app, ses, queues):
+    email_queue = make_queue(app, queues)
+    send(email_queue)
+    email_queue.join()
+    parent_workers = email_queue._workers
+
+    with mock.patch('dmutils.email_queue.os.getpid', return_value=os.getpid() + 1):
+        send(email_queue)
+        email_queue.join()
+
+        assert email_queue._workers != parent_workers
+        assert len(ses.sent) == 2
+
+        email_queue.shutdown(timeout=1)
+
+
+def test_notify_team_uses_the_email_queue(app, queues):
+    sender = mock.Mock()
+    app.config.update({
+        'DM_TEAM_EMAIL': 'team@example.com',
+        'DM_GENERIC_NOREPLY_EMAIL': 'noreply@example.com',
+        'DM_GENERIC_ADMIN_NAME': 'Marketplace Admin',
+    })
+    email_queue = EmailQueue(sender=sender)
+    email_queue.init_app(app)
+    queues.append(email_queue)
+
+    with app.app_context():
+        notify_team('Something Happened', 'It happened')
+    email_queue.join()
+
+    sender.assert_called_once_with(
+        to_email_addresses='team@example.com',
+        email_body=mock.ANY,
+        subject='Something Happened',
+        from_email='noreply@example.com',
+        from_name='Marketplace Admin',
+        reply_to=None,
+    )
@@ -1,12 +1,16 @@
 import pytest
 import mock
 from dmutils.config import init_app
-from dmutils.file import s3_upload_fileObj, s3_upload_file_from_request, s3_download_file
+from io import BytesIO
+from dmutils.file import (
+    s3_upload_fileObj, s3_upload_file_from_request, s3_download_file,
+    s3_stream_file, s3_download_file_to_tempfile, s3_generate_upload_policy
+)
 
 
 @pytest.fixture
 def s3_resource():
-    with mock.patch('boto3.resource') as boto_resource:
+    with mock.patch('dmutils.aws.registry.s3_resource') as boto_resource:
         instance = boto_resource.return_value
         yield instance
 
@@ -52,6 +56,22 @@ def test_s3_upload_with_uppercase_extension(file_app, s3_resource):
     )
 
 
+@mock.patch('dmutils.file.generate_upload_policy')
+def test_s3_generate_upload_policy(generate_upload_policy, file_app):
+    generate_upload_policy.return_value = {'url': 'https://s3/bucket', 'fields': {}}
+    with file_app.app_context():
+        policy = s3_generate_upload_policy('my test.pdf', 'path')
+
+    assert policy == {'url': 'https://s3/bucket', 'fields': {}, 'filename': 'my_test.pdf'}
+    generate_upload_policy.assert_called_once_with(['testbucket'], 'path/my_test.pdf')
+
+
+def test_s3_generate_upload_policy_with_invalid_extension(file_app):
+    with file_app.app_context():
+        with pytest.raises(Exception):
+            s3_generate_upload_policy('test.txt', 'path')
+
+
 def test_s3_upload_no_request_files():
     request = mock.MagicMock()
     request.files = None
@@ -83,3 +103,60 @@ def test_s3_download_with_correct_params(file_app, s3_resource):
         'path/file.txt',
         mock.ANY
     )
+
+
+@pytest.fixture
+def s3_object(s3_resource):
+    s3_object = s3_resource.Bucket.return_value.Object.return_value
+    s3_object.get.side_effect = lambda **kwargs: {'Body': BytesIO(b'0123456789')}
+    yield s3_object
+
+
+def test_s3_stream_file(file_app, s3_resource, s3_object):
+    with file_app.app_context():
+        chunks = list(s3_stream_file('file.csv', 'path', chunk_size=4))
+
+    assert chunks == [b'0123', b'4567', b'89']
+    s3_resource.Bucket().Object.assert_called_once_with('path/file.csv')
+    s3_object.get.assert_called_once_with()
+
+
+def test_s3_stream_file_range(file_app, s3_object):
+    with file_app.app_context():
+        list(s3_stream_file('file.csv', 'path', byte_range=(10, 19)))
+        list(s3_stream_file('file.csv', 'path', byte_range=(10, None)))
+
+    assert s3_object.get.call_args_list == [mock.call(Range='bytes=10-19'), mock.call(Range='bytes=10-')]
+
+
+def test_s3_stream_file_requests_object_before_iterating(file_app, s3_object):
+    with file_app.app_context():
+        s3_stream_file('file.csv', 'path')
+
+    assert s3_object.get.called
+
+
+def test_s3_download_file_range(file_app, s3_resource, s3_object):
+    with file_app.app_context():
+        assert s3_download_file('file.csv', 'path', byte_range=(0, 9)) == b'0123456789'
+
+    s3_object.get.assert_called_once_with(Range='bytes=0-9')
+    assert not s3_resource.Bucket().download_fileobj.called
+
+
+def test_s3_download_file_to_tempfile(file_app, s3_object):
+    with file_app.app_context():
+        spooled = s3_download_file_to_tempfile('file.csv', 'path', max_memory=5)
+
+    with spooled:
+        assert spooled.read() == b'0123456789'
+        assert spooled._rolled
+
+
+def test_s3_download_file_to_tempfile_in_memory(file_app, s3_object):
+    with file_app.app_context():
+        spooled = s3_download_file_to_tempfile('file.csv', 'path')
+
+    with spooled:
+        assert spooled.read() == b'0123456789'
+        assert not spooled._rolled
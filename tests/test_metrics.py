@@ -46,6 +46,65 @@ def test_timer(cloudwatch):
     assert kwargs['unit'] == "Milliseconds"
 
 
+def test_timer_with_dimensions(cloudwatch):
+    client = metrics.client("myregion", "mynamespace", {"app": "test"})
+    timer = client.timer("mytimer", {"framework": "g-cloud-9"})
+    with timer:
+        pass
+
+    args, kwargs = cloudwatch.put_metric_data.call_args
+
+    assert kwargs['dimensions'] == {"app": "test", "framework": "g-cloud-9"}
+    assert kwargs['value'] == int(timer.elapsed * 1000)
+
+
+def test_timing(cloudwatch):
+    client = metrics.client("myregion", "mynamespace")
+    client.timing("mytimer", 0.25)
+
+    args, kwargs = cloudwatch.put_metric_data.call_args
+
+    assert kwargs['name'] == "mytimer"
+    assert kwargs['value'] == 250
+    assert kwargs['unit'] == "Milliseconds"
+
+
+def test_size(cloudwatch):
+    client = metrics.client("myregion", "mynamespace")
+    client.size("mysize", 1024, {"framework": "g-cloud-9"})
+
+    args, kwargs = cloudwatch.put_metric_data.call_args
+
+    assert kwargs['name'] == "mysize"
+    assert kwargs['value'] == 1024
+    assert kwargs['unit'] == "Bytes"
+    assert kwargs['dimensions'] == {"framework": "g-cloud-9"}
+
+
+def test_put_metrics(cloudwatch):
+    client = metrics.client("myregion", "mynamespace", {"app": "test"})
+    client.put_metrics([
+        metrics.Metric("mytimer", 250, "Milliseconds", {"framework": "g-cloud-9"}),
+        metrics.Metric("mysize", 1024, "Bytes", None),
+    ])
+
+    cloudwatch.put_metric_data.assert_called_once_with(
+        namespace="mynamespace",
+        name=["mytimer", "mysize"],
+        value=[250, 1024],
+        timestamp=IsDatetime(),
+        unit=["Milliseconds", "Bytes"],
+        dimensions=[{"app": "test", "framework": "g-cloud-9"}, {"app": "test"}],
+        statistics=None)
+
+
+def test_put_metrics_sends_up_to_20_metrics_in_each_request(cloudwatch):
+    client = metrics.client("myregion", "mynamespace")
+    client.put_metrics(metrics.Metric("metric{}".format(i), i, "Count", None) for i in range(45))
+
+    assert [len(kwargs['name']) for args, kwargs in cloudwatch.put_metric_data.call_args_list] == [20, 20, 5]
+
+
 def test_flask_client_returns_none_before_init():
     client = metrics.flask_client()
 
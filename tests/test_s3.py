@@ -1,11 +1,19 @@
 import unittest
 import datetime
+import threading
+from concurrent.futures import TimeoutError
+from io import BytesIO
 
 import mock
 import pytest
+from dateutil.parser import parse
 from freezegun import freeze_time
+from monotonic import monotonic
 from .helpers import mock_file
-from dmutils.s3 import S3, get_file_size_up_to_maximum
+from dmutils.s3 import (
+    S3, S3ResponseError, KeyCache, CacheInfo, KeyRecord, BucketRegistry, bucket_registry,
+    get_file_size, get_file_size_up_to_maximum, parse_timestamp
+)
 
 
 class TestS3Uploader(unittest.TestCase):
@@ -22,7 +30,11 @@ class TestS3Uploader(unittest.TestCase):
 
     def test_get_bucket(self):
         S3('test-bucket')
-        self.s3_mock.get_bucket.assert_called_with('test-bucket')
+        self.s3_mock.get_bucket.assert_called_with('test-bucket', validate=True)
+
+    def test_get_bucket_without_validation(self):
+        S3('test-bucket', validate=False)
+        self.s3_mock.get_bucket.assert_called_with('test-bucket', validate=False)
 
     def test_path_exists(self):
         mock_bucket = FakeBucket()
@@ -89,6 +101,44 @@ class TestS3Uploader(unittest.TestCase):
 
         assert 'folder/2015-10-10T00:00:00-test-file.pdf' in mock_bucket.keys
 
+    @freeze_time('2015-10-10')
+    def test_delete_keys(self):
+        mock_bucket = FakeBucket(['folder/a.pdf', 'folder/b.pdf', 'folder/c.pdf'])
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        assert S3('test-bucket').delete_keys(['folder/a.pdf', 'folder/b.pdf']) == []
+
+        assert mock_bucket.keys == set([
+            'folder/c.pdf',
+            'folder/2015-10-10T00:00:00-a.pdf',
+            'folder/2015-10-10T00:00:00-b.pdf',
+        ])
+        assert mock_bucket.delete_requests == [['folder/a.pdf', 'folder/b.pdf']]
+
+    def test_delete_keys_without_archiving(self):
+        mock_bucket = FakeBucket(['folder/a.pdf', 'folder/b.pdf'])
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        S3('test-bucket').delete_keys(['folder/a.pdf', 'folder/b.pdf'], archive=False)
+
+        assert mock_bucket.keys == set()
+
+    @mock.patch('dmutils.s3.MULTI_DELETE_BATCH_SIZE', 2)
+    def test_delete_keys_in_batches(self):
+        mock_bucket = FakeBucket()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        S3('test-bucket').delete_keys(['a', 'b', 'c'], archive=False)
+
+        assert mock_bucket.delete_requests == [['a', 'b'], ['c']]
+
+    def test_delete_keys_returns_failed_paths(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.delete_keys.return_value.errors = [mock.Mock(key='b', code='AccessDenied', message='Denied')]
+
+        assert S3('test-bucket').delete_keys(['a', 'b'], archive=False) == ['b']
+
     def test_list_files(self):
         mock_bucket = mock.Mock()
         self.s3_mock.get_bucket.return_value = mock_bucket
@@ -130,6 +180,66 @@ class TestS3Uploader(unittest.TestCase):
 
         self.assertEqual(S3('test-bucket').list(), expected)
 
+    def test_list_files_with_limit_returns_most_recent(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        fake_keys = [
+            FakeKey('dir/file 2.odt', last_modified='2015-08-17T14:00:00.000000Z'),
+            FakeKey('dir/file 1.odt', last_modified='2014-08-17T14:00:00.000000Z'),
+            FakeKey('dir/file 3.odt', last_modified='2016-08-17T14:00:00.000000Z'),
+        ]
+        mock_bucket.list.return_value = fake_keys
+
+        results = S3('test-bucket').list(limit=2)
+        assert [key['filename'] for key in results] == ['file 2', 'file 3']
+
+    def test_iter_keys_is_lazy(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        def listing(prefix, delimiter):
+            yield FakeKey('dir/file 1.odt')
+            raise AssertionError('listing consumed past the first key')
+
+        mock_bucket.list.side_effect = listing
+
+        keys = S3('test-bucket').iter_keys('dir/')
+        assert next(keys) == FakeKey('dir/file 1.odt').fake_format_key(filename='file 1', ext='odt')
+
+    def test_iter_keys_removes_directories(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        mock_bucket.list.return_value = [FakeKey('dir/', size=0), FakeKey('dir/file 1.odt')]
+
+        assert [key['path'] for key in S3('test-bucket').iter_keys()] == ['dir/file 1.odt']
+
+    def test_list_files_as_records(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        fake_key_later = FakeKey('dir/file 1.odt')
+        fake_key_earlier = FakeKey('dir/file 2.odt', last_modified='2014-08-17T14:00:00.000Z')
+        mock_bucket.list.return_value = [fake_key_later, fake_key_earlier]
+
+        results = S3('test-bucket').list(records=True)
+
+        assert [key.filename for key in results] == ['file 2', 'file 1']
+        assert results[0].timestamp == datetime.datetime(2014, 8, 17, 14)
+        assert results[0]['last_modified'] == '2014-08-17T14:00:00.000000Z'
+        assert results[1].to_dict() == fake_key_later.fake_format_key(filename='file 1', ext='odt')
+
+    def test_iter_keys_as_records(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.list.return_value = [FakeKey('dir/file 1.odt')]
+
+        record, = S3('test-bucket').iter_keys(records=True)
+
+        assert isinstance(record, KeyRecord)
+        assert record['path'] == 'dir/file 1.odt'
+
     def test_list_files_with_loading_custom_timestamps(self):
         mock_bucket = mock.Mock()
         self.s3_mock.get_bucket.return_value = mock_bucket
@@ -157,6 +267,59 @@ class TestS3Uploader(unittest.TestCase):
         assert results[1]['last_modified'] == '2015-11-10T15:00:00.000000Z'
         assert results[2]['last_modified'] == '2015-12-10T15:00:00.000000Z'
 
+    def test_list_files_loads_custom_timestamps_concurrently(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.list.return_value = [FakeKey('dir/file {}.odt'.format(i)) for i in range(3)]
+
+        in_flight = []
+        all_in_flight = threading.Condition()
+
+        def get_key(name):
+            # only returns once all three requests are in flight at the same time. Condition.wait
+            # returns None on Python 2, so the deadline is checked here.
+            deadline = monotonic() + 1
+            with all_in_flight:
+                in_flight.append(name)
+                all_in_flight.notify_all()
+                while len(in_flight) < 3:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise AssertionError('timestamps were not loaded concurrently')
+                    all_in_flight.wait(remaining)
+            return FakeKey(name, timestamp='2015-10-10T15:00:00.0000Z')
+
+        mock_bucket.get_key.side_effect = get_key
+
+        results = S3('test-bucket').list(load_timestamps=True, max_workers=3)
+        assert [key['last_modified'] for key in results] == ['2015-10-10T15:00:00.000000Z'] * 3
+
+    def test_list_files_with_loading_custom_timestamps_times_out(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.list.return_value = [FakeKey('dir/file 1.odt')]
+
+        release = threading.Event()
+        mock_bucket.get_key.side_effect = lambda name: release.wait(1)
+
+        try:
+            with pytest.raises(TimeoutError):
+                S3('test-bucket').list(load_timestamps=True, timeout=0.01)
+        finally:
+            release.set()
+
+    def test_list_files_with_loading_custom_timestamps_for_deleted_key(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        fake_key = FakeKey('dir/file 1.odt')
+        mock_bucket.list.return_value = [fake_key]
+        mock_bucket.get_key.return_value = None
+
+        assert S3('test-bucket').list(load_timestamps=True) == [
+            fake_key.fake_format_key(filename='file 1', ext='odt')
+        ]
+
     def test_save_file(self):
         mock_bucket = FakeBucket()
         self.s3_mock.get_bucket.return_value = mock_bucket
@@ -193,8 +356,8 @@ class TestS3Uploader(unittest.TestCase):
         self.assertEqual(mock_bucket.keys, set(['folder/test-file.pdf']))
 
         mock_bucket.s3_key_mock.set_contents_from_file.assert_called_with(
-            mock.ANY, headers={'Content-Type': 'application/pdf'})
-        mock_bucket.s3_key_mock.set_acl.assert_called_with('public-read')
+            mock.ANY, headers={'Content-Type': 'application/pdf'}, policy='public-read')
+        assert not mock_bucket.s3_key_mock.set_acl.called
 
     def test_save_sets_content_type_and_content_disposition_header(self):
         mock_bucket = FakeBucket()
@@ -207,7 +370,92 @@ class TestS3Uploader(unittest.TestCase):
             mock.ANY, headers={
                 'Content-Type': 'application/pdf',
                 'Content-Disposition': 'attachment; filename="new-test-file.pdf"'.encode('utf-8')
-            })
+            }, policy='public-read')
+
+    def test_save_small_file_in_a_single_request(self):
+        mock_bucket = FakeBucket()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        S3('test-bucket').save('folder/test-file.pdf', BytesIO(b'*' * 20), multipart_threshold=20)
+
+        assert mock_bucket.s3_key_mock.set_contents_from_file.called
+        assert mock_bucket.multipart_uploads == []
+
+    @mock.patch('dmutils.s3.MULTIPART_CHUNKSIZE', 8)
+    def test_save_large_file_in_parts(self):
+        mock_bucket = FakeBucket()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        S3('test-bucket').save('folder/test-file.pdf', BytesIO(b'0123456789' * 2), multipart_threshold=10)
+
+        upload, = mock_bucket.multipart_uploads
+        assert sorted(upload.parts) == [(1, b'01234567'), (2, b'89012345'), (3, b'6789')]
+        assert upload.completed and not upload.cancelled
+        assert upload.policy == 'public-read'
+        assert not mock_bucket.s3_key_mock.set_contents_from_file.called
+
+    def test_save_uploads_a_file_that_hasnt_been_rewound(self):
+        mock_bucket = FakeBucket()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        file = BytesIO()
+        file.write(b'*' * 100)
+        positions = []
+        mock_bucket.s3_key_mock.set_contents_from_file.side_effect = lambda f, **kwargs: positions.append(f.tell())
+
+        S3('test-bucket').save('folder/test-file.pdf', file)
+
+        assert positions == [0]
+
+    @mock.patch('dmutils.s3.MULTIPART_CHUNKSIZE', 8)
+    def test_save_uploads_all_parts_of_a_file_that_hasnt_been_rewound(self):
+        mock_bucket = FakeBucket()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        file = BytesIO()
+        file.write(b'0123456789' * 2)
+
+        S3('test-bucket').save('folder/test-file.pdf', file, multipart_threshold=10)
+
+        upload, = mock_bucket.multipart_uploads
+        assert sorted(upload.parts) == [(1, b'01234567'), (2, b'89012345'), (3, b'6789')]
+
+    @mock.patch('dmutils.s3.MULTIPART_CHUNKSIZE', 8)
+    def test_save_cancels_failed_multipart_upload(self):
+        mock_bucket = FakeBucket(multipart_error=IOError('connection reset'))
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        with pytest.raises(IOError):
+            S3('test-bucket').save('folder/test-file.pdf', BytesIO(b'0123456789' * 2), multipart_threshold=10)
+
+        upload, = mock_bucket.multipart_uploads
+        assert upload.cancelled and not upload.completed
+
+    def test_save_many(self):
+        mock_bucket = FakeBucket()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        results = S3('test-bucket').save_many([
+            ('folder/a.pdf', mock_file('blah', 123)),
+            ('folder/b.pdf', mock_file('blah', 123)),
+        ], acl='private')
+
+        assert [(result.path, result.error) for result in results] == [('folder/a.pdf', None), ('folder/b.pdf', None)]
+        assert mock_bucket.keys == set(['folder/a.pdf', 'folder/b.pdf'])
+        mock_bucket.s3_key_mock.set_contents_from_file.assert_called_with(mock.ANY, headers=mock.ANY, policy='private')
+
+    def test_save_many_returns_errors(self):
+        mock_bucket = FakeBucket()
+        mock_bucket.s3_key_mock.set_contents_from_file.side_effect = [None, S3ResponseError(403, 'Forbidden')]
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        results = S3('test-bucket').save_many([
+            ('folder/a.pdf', mock_file('blah', 123)),
+            ('folder/b.pdf', mock_file('blah', 123)),
+        ], max_workers=1)
+
+        assert results[0].error is None
+        assert results[0].key is mock_bucket.s3_key_mock
+        assert isinstance(results[1].error, S3ResponseError)
+        assert results[1].key is None
 
     def test_save_strips_leading_slash(self):
         mock_bucket = FakeBucket()
@@ -247,6 +495,39 @@ class TestS3Uploader(unittest.TestCase):
             'folder/OLD-test-file.pdf'
         ]))
 
+    def test_save_without_archiving_existing_file(self):
+        mock_bucket = FakeBucket(['folder/test-file.pdf'])
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        S3('test-bucket').save(
+            'folder/test-file.pdf', mock_file('blah', 123),
+            move_prefix='OLD', archive_existing=False
+        )
+
+        self.assertEqual(mock_bucket.keys, set(['folder/test-file.pdf']))
+
+    def test_move_existing_with_missing_file(self):
+        mock_bucket = FakeBucket()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        S3('test-bucket')._move_existing(
+            existing_path='folder/test-file.odt',
+            move_prefix='OLD'
+        )
+
+        assert mock_bucket.keys == set()
+
+    def test_move_existing_raises_other_errors(self):
+        mock_bucket = mock.Mock()
+        mock_bucket.copy_key.side_effect = S3ResponseError(403, 'Forbidden')
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        with pytest.raises(S3ResponseError):
+            S3('test-bucket')._move_existing(
+                existing_path='folder/test-file.odt',
+                move_prefix='OLD'
+            )
+
     def test_move_existing_doesnt_delete_file(self):
         mock_bucket = FakeBucket(['folder/test-file.odt'])
         self.s3_mock.get_bucket.return_value = mock_bucket
@@ -280,26 +561,336 @@ class TestS3Uploader(unittest.TestCase):
                          'application/vnd.oasis.opendocument.presentation')
 
 
+class TestS3KeyCache(unittest.TestCase):
+    def setUp(self):
+        self.s3_mock = mock.Mock()
+        self._boto_patch = mock.patch(
+            'dmutils.s3.boto.connect_s3',
+            return_value=self.s3_mock
+        )
+        self._boto_patch.start()
+        self.key_cache = KeyCache()
+
+    def tearDown(self):
+        self._boto_patch.stop()
+
+    def test_path_exists_is_cached(self):
+        mock_bucket = FakeBucket(['foo'])
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        s3 = S3('test-bucket', key_cache=self.key_cache)
+
+        assert s3.path_exists('foo') is True
+        assert s3.path_exists('foo') is True
+        assert s3.path_exists('bar') is False
+        assert s3.path_exists('bar') is False
+
+        assert mock_bucket.get_key_calls == ['foo', 'bar']
+        assert self.key_cache.info() == CacheInfo(hits=2, misses=2, maxsize=1024, currsize=2)
+
+    def test_cache_is_shared_between_instances_of_the_same_bucket(self):
+        mock_bucket = FakeBucket(['foo'])
+        self.s3_mock.get_bucket.return_value = mock_bucket
+
+        S3('test-bucket', key_cache=self.key_cache).get_signed_url('foo')
+        S3('test-bucket', key_cache=self.key_cache).get_signed_url('foo')
+        S3('other-bucket', key_cache=self.key_cache).get_signed_url('foo')
+
+        assert mock_bucket.get_key_calls == ['foo', 'foo']
+
+    def test_save_invalidates_cached_key(self):
+        mock_bucket = FakeBucket()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        s3 = S3('test-bucket', key_cache=self.key_cache)
+
+        assert s3.path_exists('folder/test-file.pdf') is False
+        s3.save('folder/test-file.pdf', mock_file('blah', 123))
+
+        assert s3.path_exists('folder/test-file.pdf') is True
+
+    def test_delete_key_invalidates_cached_key_and_archive_path(self):
+        mock_bucket = FakeBucket(['folder/test-file.pdf'])
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        s3 = S3('test-bucket', key_cache=self.key_cache)
+
+        assert s3.path_exists('folder/OLD-test-file.pdf') is False
+        s3.save('folder/test-file.pdf', mock_file('blah', 123), move_prefix='OLD')
+        s3.delete_key('folder/test-file.pdf')
+
+        assert s3.path_exists('folder/test-file.pdf') is False
+        assert s3.path_exists('folder/OLD-test-file.pdf') is True
+
+    def test_listing_populates_cache(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.list.return_value = [FakeKey('dir/file 1.odt')]
+        s3 = S3('test-bucket', key_cache=self.key_cache)
+
+        s3.list()
+
+        assert s3.path_exists('dir/file 1.odt') is True
+        assert mock_bucket.get_key.called is False
+
+    def test_listed_keys_without_metadata_are_loaded_by_get_key(self):
+        mock_bucket = mock.Mock()
+        self.s3_mock.get_bucket.return_value = mock_bucket
+        mock_bucket.list.return_value = [FakeKey('dir/file 1.odt')]
+        mock_bucket.get_key.return_value = FakeKey('dir/file 1.odt', timestamp='2015-10-10T15:00:00.0000Z')
+        s3 = S3('test-bucket', key_cache=self.key_cache)
+
+        s3.list()
+        assert s3.get_key('dir/file 1.odt')['last_modified'] == '2015-10-10T15:00:00.000000Z'
+        assert s3.get_key('dir/file 1.odt')['last_modified'] == '2015-10-10T15:00:00.000000Z'
+
+        mock_bucket.get_key.assert_called_once_with('dir/file 1.odt')
+
+
+class TestS3SaveRequestCounts(unittest.TestCase):
+    """Benchmarks the number of S3 requests made by each save."""
+    def setUp(self):
+        self.s3_mock = mock.Mock()
+        self._boto_patch = mock.patch(
+            'dmutils.s3.boto.connect_s3',
+            return_value=self.s3_mock
+        )
+        self._boto_patch.start()
+
+    def tearDown(self):
+        self._boto_patch.stop()
+
+    def save(self, bucket, **kwargs):
+        self.s3_mock.get_bucket.return_value = bucket
+        S3('test-bucket', **kwargs).save('folder/test-file.pdf', mock_file('blah', 123))
+        return bucket.requests
+
+    def test_save_new_file(self):
+        assert self.save(CountingBucket()) == ['COPY', 'PUT']
+
+    def test_save_existing_file(self):
+        assert self.save(CountingBucket(['folder/test-file.pdf'])) == ['COPY', 'PUT']
+
+    def test_save_without_archiving(self):
+        self.s3_mock.get_bucket.return_value = bucket = CountingBucket(['folder/test-file.pdf'])
+        S3('test-bucket').save('folder/test-file.pdf', mock_file('blah', 123), archive_existing=False)
+
+        assert bucket.requests == ['PUT']
+
+    def test_save_file_cached_as_missing_is_still_archived(self):
+        key_cache = KeyCache()
+        key_cache.set('test-bucket', 'folder/test-file.pdf', None)
+
+        assert self.save(CountingBucket(['folder/test-file.pdf']), key_cache=key_cache) == ['COPY', 'PUT']
+        assert key_cache.info() == CacheInfo(hits=0, misses=0, maxsize=1024, currsize=0)
+
+
+class TestS3SharedConnection(unittest.TestCase):
+    def setUp(self):
+        self._boto_patch = mock.patch('dmutils.s3.boto.connect_s3')
+        self.connect_s3 = self._boto_patch.start()
+        bucket_registry.clear()
+
+    def tearDown(self):
+        self._boto_patch.stop()
+        bucket_registry.clear()
+
+    def test_connection_and_bucket_are_reused(self):
+        first = S3('test-bucket', shared_connection=True)
+        second = S3('test-bucket', shared_connection=True)
+
+        assert first.bucket is second.bucket
+        self.connect_s3.assert_called_once_with(host='s3-eu-west-1.amazonaws.com')
+        self.connect_s3.return_value.get_bucket.assert_called_once_with('test-bucket', validate=True)
+
+    def test_connection_is_reused_for_other_buckets_on_the_same_host(self):
+        S3('test-bucket', shared_connection=True)
+        S3('other-bucket', shared_connection=True, validate=False)
+        S3('test-bucket', host='localhost', shared_connection=True)
+
+        assert self.connect_s3.call_args_list == [
+            mock.call(host='s3-eu-west-1.amazonaws.com'),
+            mock.call(host='localhost'),
+        ]
+        assert self.connect_s3.return_value.get_bucket.call_args_list == [
+            mock.call('test-bucket', validate=True),
+            mock.call('other-bucket', validate=False),
+            mock.call('test-bucket', validate=True),
+        ]
+
+    def test_unvalidated_bucket_is_validated_when_asked_for(self):
+        registry = BucketRegistry()
+        registry.get_bucket('localhost', 'test-bucket', validate=False)
+        registry.get_bucket('localhost', 'test-bucket', validate=True)
+        registry.get_bucket('localhost', 'test-bucket', validate=True)
+        registry.get_bucket('localhost', 'test-bucket', validate=False)
+
+        assert self.connect_s3.call_count == 1
+        assert self.connect_s3.return_value.get_bucket.call_args_list == [
+            mock.call('test-bucket', validate=False),
+            mock.call('test-bucket', validate=True),
+        ]
+
+    def test_failed_validation_is_raised_every_time(self):
+        registry = BucketRegistry()
+        registry.get_bucket('localhost', 'test-bucket', validate=False)
+        self.connect_s3.return_value.get_bucket.side_effect = S3ResponseError(404, 'Not Found')
+
+        for i in range(2):
+            with pytest.raises(S3ResponseError):
+                registry.get_bucket('localhost', 'test-bucket', validate=True)
+
+    def test_registry_is_reset_after_fork(self):
+        registry = BucketRegistry()
+        registry.get_bucket('localhost', 'test-bucket')
+        registry.get_bucket('localhost', 'test-bucket')
+        assert self.connect_s3.call_count == 1
+
+        with mock.patch('dmutils.s3.os.getpid', return_value=-1):
+            registry.get_bucket('localhost', 'test-bucket')
+
+        assert self.connect_s3.call_count == 2
+
+    def test_connections_are_not_shared_by_default(self):
+        S3('test-bucket')
+        S3('test-bucket')
+
+        assert self.connect_s3.call_count == 2
+
+
+class TestKeyCache(object):
+    def test_least_recently_used_entry_is_evicted(self):
+        key_cache = KeyCache(maxsize=2)
+        key_cache.set('bucket', 'a', 'key-a')
+        key_cache.set('bucket', 'b', 'key-b')
+        key_cache.get('bucket', 'a')
+        key_cache.set('bucket', 'c', 'key-c')
+
+        assert key_cache.get('bucket', 'a') == 'key-a'
+        assert key_cache.get('bucket', 'b') != 'key-b'
+        assert key_cache.info().currsize == 2
+
+    def test_entries_expire(self):
+        key_cache = KeyCache(ttl=10)
+        with mock.patch('dmutils.s3.monotonic', return_value=100):
+            key_cache.set('bucket', 'a', 'key-a')
+        with mock.patch('dmutils.s3.monotonic', return_value=109):
+            assert key_cache.get('bucket', 'a') == 'key-a'
+        with mock.patch('dmutils.s3.monotonic', return_value=110):
+            assert key_cache.get('bucket', 'a') != 'key-a'
+
+        assert key_cache.info() == CacheInfo(hits=1, misses=1, maxsize=1024, currsize=0)
+
+
+class TestKeyRecord(object):
+    def test_record_has_no_instance_dict(self):
+        record = KeyRecord('dir/file 1.odt', 'file 1', 'odt', datetime.datetime(2015, 8, 17, 14), 1)
+
+        assert not hasattr(record, '__dict__')
+
+    def test_unknown_items_raise_key_error(self):
+        record = KeyRecord('dir/file 1.odt', 'file 1', 'odt', datetime.datetime(2015, 8, 17, 14), 1)
+
+        with pytest.raises(KeyError):
+            record['to_dict']
+
+
+@pytest.mark.parametrize('value', [
+    '2015-08-17T14:00:00.000Z',
+    '2015-08-17T14:00:00.000000Z',
+    '2015-10-10T15:00:00.0000Z',
+    '2015-10-10T15:00:00.123456Z',
+    '2015-10-10T15:00:00Z',
+    'Mon, 17 Aug 2015 14:00:00 GMT',
+    'Thu, 31 Dec 2015 23:59:59 GMT',
+    '2015-08-17 14:00:00',
+    '2015-08-17T14:00:00+00:00',
+])
+def test_parse_timestamp_matches_dateutil(value):
+    assert parse_timestamp(value) == parse(value).replace(tzinfo=None)
+    assert parse_timestamp(value).tzinfo is None
+
+
+@pytest.mark.parametrize('value', [
+    '2015-08-18T00:00:00+10:00',
+    '2015-08-17T09:00:00-05:00',
+    'Mon, 17 Aug 2015 16:00:00 +0200',
+])
+def test_parse_timestamp_converts_other_offsets_to_utc(value):
+    assert parse_timestamp(value) == datetime.datetime(2015, 8, 17, 14, 0, 0)
+
+
+class FakeMultiPartUpload(object):
+    def __init__(self, policy, error=None):
+        self.policy = policy
+        self.error = error
+        self.parts = []
+        self.completed = False
+        self.cancelled = False
+
+    def upload_part_from_file(self, fp, part_num):
+        if self.error:
+            raise self.error
+        self.parts.append((part_num, fp.read()))
+
+    def complete_upload(self):
+        self.completed = True
+
+    def cancel_upload(self):
+        self.cancelled = True
+
+
 class FakeBucket(object):
-    def __init__(self, keys=None):
+    def __init__(self, keys=None, multipart_error=None):
         self.keys = set(keys or [])
+        self.multipart_error = multipart_error
+        self.multipart_uploads = []
+        self.delete_requests = []
         self.s3_key_mock = mock.Mock()
         self.s3_key_mock.name = "test-file.pdf"
+        self.get_key_calls = []
 
     def get_key(self, key):
+        self.get_key_calls.append(key)
         if key in self.keys:
             return self.s3_key_mock
 
     def delete_key(self, key):
         self.keys.remove(key)
 
+    def delete_keys(self, keys):
+        self.delete_requests.append(list(keys))
+        self.keys.difference_update(keys)
+        return mock.Mock(errors=[])
+
     def new_key(self, key):
         self.keys.add(key)
         return self.s3_key_mock
 
-    def copy_key(self, new_key, *args, **kwargs):
+    def copy_key(self, new_key, src_bucket_name, src_key_name):
+        if src_key_name not in self.keys:
+            raise S3ResponseError(404, 'Not Found')
         self.keys.add(new_key)
 
+    def initiate_multipart_upload(self, key, headers=None, metadata=None, policy=None):
+        self.keys.add(key)
+        self.multipart_uploads.append(FakeMultiPartUpload(policy, self.multipart_error))
+        return self.multipart_uploads[-1]
+
+
+class CountingBucket(FakeBucket):
+    """A stub bucket that records the S3 API requests made against it."""
+    def __init__(self, keys=None):
+        super(CountingBucket, self).__init__(keys)
+        self.requests = []
+        self.s3_key_mock.set_contents_from_file.side_effect = lambda *args, **kwargs: self.requests.append('PUT')
+        self.s3_key_mock.set_acl.side_effect = lambda *args, **kwargs: self.requests.append('PUT acl')
+
+    def get_key(self, key):
+        self.requests.append('HEAD')
+        return super(CountingBucket, self).get_key(key)
+
+    def copy_key(self, *args, **kwargs):
+        self.requests.append('COPY')
+        return super(CountingBucket, self).copy_key(*args, **kwargs)
+
 
 class FakeKey(object):
     def __init__(self, name, last_modified=None, size=None, timestamp=None):
@@ -321,6 +912,19 @@ class FakeKey(object):
         return self.timestamp if key == 'timestamp' and self.timestamp else None
 
 
+def test_get_file_size_uses_seek_and_tell():
+    file_contents = BytesIO(b'*' * 10)
+    file_contents.read(3)
+
+    assert get_file_size(file_contents) == 7
+    assert file_contents.tell() == 3
+
+
+def test_get_file_size_without_seek_and_tell():
+    assert get_file_size(object()) is None
+    assert get_file_size(mock_file('', 10)) is None
+
+
 def test_get_file_size_just_below_maximum():
     assert get_file_size_up_to_maximum(mock_file('', 5399999)) == 5399999
 